@@ -1,10 +1,12 @@
 import streamlit as st
 from client import Client
+import itertools
 import os
 import tkinter as tk
 from tkinter import filedialog
 
-client = Client()
+client = Client.from_config()  # 按 servers.conf 中的 Master 分片路由
+PAGE_SIZE = 100  # 文件管理页每页显示的文件数
 
 
 # 页面配置
@@ -42,8 +44,31 @@ elif tab == "File Management":
     st.title("File Management")
     st.subheader("Manage your files in the Distributed File System")
 
-    files = client.get_master_file_namespace()
+    prefix = st.text_input("Filter by prefix")
+    if st.session_state.get("prefix") != prefix:
+        # 过滤条件变化时回到第一页; cursors 保存每一页之前的游标
+        st.session_state["prefix"] = prefix
+        st.session_state["cursors"] = [None]
+    cursors = st.session_state["cursors"]
+
+    # 只取一页 (多取一个以判断是否还有下一页), 不遍历整个命名空间
+    page = list(itertools.islice(client.list_files(prefix=prefix, after=cursors[-1], page_size=PAGE_SIZE),
+                                 PAGE_SIZE + 1))
+    has_next = len(page) > PAGE_SIZE
+    page = page[:PAGE_SIZE]
+    files = [entry["fileID"] for entry in page]
+
+    previous_col, next_col = st.columns(2)
+    if previous_col.button("Previous page", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    if next_col.button("Next page", disabled=not has_next):
+        cursors.append(files[-1])
+        st.rerun()
+
     if files:
+        st.dataframe([{"File": entry["fileID"], "Size": entry["size"], "Blocks": entry["blocks"]} for entry in page],
+                     use_container_width=True)
         selected_file = st.selectbox("Select a file to manage", files)
         action = st.radio("Choose an action", ["Download", "Delete"])
 
@@ -71,7 +96,7 @@ elif tab == "File Management":
                 st.success(
                     f"File {selected_file} deleted successfully from DFS")
                 # 刷新文件列表
-                files = client.get_master_file_namespace()
+                st.rerun()
 
     else:
         st.warning("No files found in DFS")
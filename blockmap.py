@@ -0,0 +1,449 @@
+import base64
+import binascii
+import sys
+import threading
+from array import array
+
+NO_SERVER = 0xFFFF  # 位置数组中的空位 (该块的副本数少于文件中的最大副本数)
+BLOCK_KEYS = {"blockID", "primary", "replica", "checksum", "codec"}
+
+
+class ServerTable:
+    def __init__(self):
+        """_summary_: 服务器地址驻留表, 进程内每个 "host:port" 只保存一次, 块位置中只记录两字节的编号
+        """
+        self.ids = {}  # "host:port" -> 编号
+        self.addresses = []  # 编号 -> (host, port)
+        self.lock = threading.Lock()
+
+    def intern(self, host, port):
+        key = f"{host}:{port}"
+        server_id = self.ids.get(key)
+        if server_id is None:
+            with self.lock:
+                server_id = self.ids.get(key)
+                if server_id is None:
+                    if len(self.addresses) >= NO_SERVER:
+                        raise OverflowError("Too many storage servers")
+                    server_id = len(self.addresses)
+                    self.addresses.append((host, port))
+                    self.ids[key] = server_id
+        return server_id
+
+    def lookup(self, server):
+        # "host:port" -> 编号, 从未出现过的服务器返回 None
+        return self.ids.get(server)
+
+    def address(self, server_id):
+        host, port = self.addresses[server_id]
+        return {"host": host, "port": port}
+
+
+class ChecksumTable:
+    def __init__(self):
+        """_summary_: 校验和算法驻留表, 校验和 "算法:十六进制" 拆成一字节的算法编号和 64 位整数
+        """
+        self.ids = {}  # (算法名, 十六进制位数) -> 编号, 0 表示没有校验和
+        self.algorithms = [None]
+        self.lock = threading.Lock()
+
+    def intern(self, name, digits):
+        algorithm_id = self.ids.get((name, digits))
+        if algorithm_id is None:
+            with self.lock:
+                algorithm_id = self.ids.setdefault((name, digits), len(self.algorithms))
+                if algorithm_id == len(self.algorithms):
+                    self.algorithms.append((name, digits))
+        return algorithm_id
+
+
+class CodecTable:
+    def __init__(self):
+        """_summary_: 压缩算法驻留表, 每个块只记录一字节的算法编号
+        """
+        self.ids = {None: 0}  # 算法名 -> 编号, 0 表示未压缩
+        self.names = [None]
+        self.lock = threading.Lock()
+
+    def intern(self, name):
+        codec_id = self.ids.get(name)
+        if codec_id is None:
+            with self.lock:
+                codec_id = self.ids.setdefault(name, len(self.names))
+                if codec_id == len(self.names):
+                    self.names.append(name)
+        return codec_id
+
+
+SERVERS = ServerTable()
+CHECKSUMS = ChecksumTable()
+CODECS = CodecTable()
+
+
+class BlockMap:
+    __slots__ = ('width', 'locations', 'algorithms', 'digests', 'extra', 'codecs')
+
+    def __init__(self, width, locations, algorithms, digests, extra=None, codecs=None):
+        """_summary_: 文件块映射的紧凑表示
+
+        块ID就是下标; 每个块的位置是 width 个服务器编号 (array('H'), 主服务器在前),
+        校验和是算法编号 (array('B')) 加 64 位摘要 (array('Q')), 块数据的压缩算法
+        是一字节的编号 (array('B'), 没有压缩的块时为 None). 无法压缩的块
+        (带其他字段或更长的摘要) 原样保存在 extra 中.
+
+        BlockMap 表现为块字典的只读序列, 按下标取出时才展开为原来的
+        {"blockID", "primary", "replica", "checksum", "codec"} 结构; 在协议边界通过 to_json 展开.
+
+        Args:
+            width (int):    每个块的最大位置数
+            locations (array):  len(blocks) * width 个服务器编号
+            algorithms (array): 每个块的校验和算法编号
+            digests (array):    每个块的校验和摘要
+            extra (dict, optional): 下标 -> 原样保存的块字典. Defaults to None.
+            codecs (array, optional):   每个块的压缩算法编号. Defaults to None (都未压缩).
+        """
+        self.width = width
+        self.locations = locations
+        self.algorithms = algorithms
+        self.digests = digests
+        self.extra = extra or {}
+        self.codecs = codecs
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """_summary_    由块字典列表构造
+
+        Args:
+            blocks (list):  [{"blockID", "primary", "replica", "checksum", "codec"}, ...], blockID 等于下标
+
+        Returns:
+            BlockMap:   只有一个块时为更小的 SingleBlockMap
+        """
+        if isinstance(blocks, (BlockMap, SingleBlockMap)):
+            return blocks
+        if len(blocks) == 1:
+            single = SingleBlockMap.from_block(blocks[0])
+            if single is not None:
+                return single
+        width = max((1 + len(block["replica"]) for block in blocks), default=1)
+        locations = array('H', [NO_SERVER]) * (len(blocks) * width)
+        algorithms = array('B', bytes(len(blocks)))
+        digests = array('Q', [0]) * len(blocks)
+        codecs = None
+        extra = {}
+        for index, block in enumerate(blocks):
+            encoded = cls._encode_checksum(block.get("checksum"))
+            if block["blockID"] != index or not BLOCK_KEYS.issuperset(block) or encoded is None:
+                extra[index] = dict(block)
+                continue
+            base = index * width
+            for offset, server in enumerate([block["primary"]] + block["replica"]):
+                locations[base + offset] = SERVERS.intern(server["host"], server["port"])
+            algorithms[index], digests[index] = encoded
+            if block.get("codec"):
+                if codecs is None:
+                    codecs = array('B', bytes(len(blocks)))
+                codecs[index] = CODECS.intern(block["codec"])
+        return cls(width, locations, algorithms, digests, extra, codecs)
+
+    @staticmethod
+    def _encode_checksum(value):
+        if value is None:
+            return 0, 0
+        name, _, digest = value.partition(':')
+        if not digest or len(digest) > 16:
+            return None
+        try:
+            return CHECKSUMS.intern(name, len(digest)), int(digest, 16)
+        except ValueError:
+            return None
+
+    def __len__(self):
+        return len(self.algorithms)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        if index in self.extra:
+            return dict(self.extra[index])
+        base = index * self.width
+        servers = [SERVERS.address(server_id) for server_id in self.locations[base:base + self.width]
+                   if server_id != NO_SERVER]
+        block = {"blockID": index, "primary": servers[0], "replica": servers[1:]}
+        if self.algorithms[index]:
+            name, digits = CHECKSUMS.algorithms[self.algorithms[index]]
+            block["checksum"] = f"{name}:{self.digests[index]:0{digits}x}"
+        if self.codecs is not None and self.codecs[index]:
+            block["codec"] = CODECS.names[self.codecs[index]]
+        return block
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def to_json(self):
+        return list(self)
+
+    def server_ids(self):
+        """_summary_    文件的块所在的全部服务器编号
+        """
+        servers = set(self.locations)
+        servers.discard(NO_SERVER)
+        for block in self.extra.values():
+            for server in [block["primary"]] + block["replica"]:
+                servers.add(SERVERS.intern(server["host"], server["port"]))
+        return servers
+
+    def blocks_on(self, server_id):
+        """_summary_    存放在某台服务器上的块ID
+        """
+        block_ids = {index // self.width for index, location in enumerate(self.locations)
+                     if location == server_id}
+        for index, block in self.extra.items():
+            if any(SERVERS.intern(server["host"], server["port"]) == server_id
+                   for server in [block["primary"]] + block["replica"]):
+                block_ids.add(index)
+        return sorted(block_ids)
+
+    def replace(self, index, block):
+        """_summary_    返回替换了一个块的新 BlockMap (元数据不可原地修改)
+        """
+        if len(block["replica"]) + 1 > self.width or not BLOCK_KEYS.issuperset(block):
+            blocks = list(self)
+            blocks[index] = block
+            return BlockMap.from_blocks(blocks)
+        codecs = array('B', self.codecs) if self.codecs is not None else None
+        if block.get("codec") and codecs is None:
+            codecs = array('B', bytes(len(self)))
+        replaced = BlockMap(self.width, array('H', self.locations), array('B', self.algorithms),
+                            array('Q', self.digests), dict(self.extra), codecs)
+        replaced.extra.pop(index, None)
+        encoded = self._encode_checksum(block.get("checksum"))
+        if encoded is None:
+            replaced.extra[index] = dict(block)
+            return replaced
+        base = index * self.width
+        servers = [SERVERS.intern(server["host"], server["port"])
+                   for server in [block["primary"]] + block["replica"]]
+        servers += [NO_SERVER] * (self.width - len(servers))
+        replaced.locations[base:base + self.width] = array('H', servers)
+        replaced.algorithms[index], replaced.digests[index] = encoded
+        if codecs is not None:
+            codecs[index] = CODECS.intern(block.get("codec"))
+        return replaced
+
+    def with_checksums(self, checksums, codecs=None):
+        """_summary_    返回记录了每个块校验和 (及压缩算法) 的新 BlockMap
+
+        Args:
+            checksums (list):   每个块的校验和
+            codecs (list, optional):    每个块的压缩算法, 未压缩的块为 None. Defaults to None (都未压缩).
+        """
+        codecs = list(codecs or [])[:len(checksums)]
+        codecs += [None] * (len(checksums) - len(codecs))
+
+        def expanded():
+            blocks = [dict(block, checksum=value) for block, value in zip(self, checksums)]
+            for block, codec in zip(blocks, codecs):
+                block.pop("codec", None)
+                if codec:
+                    block["codec"] = codec
+            return BlockMap.from_blocks(blocks)
+
+        if self.extra:
+            return expanded()
+        algorithms = array('B', bytes(len(self)))
+        digests = array('Q', [0]) * len(self)
+        for index, value in enumerate(checksums):
+            encoded = self._encode_checksum(value)
+            if encoded is None:
+                return expanded()
+            algorithms[index], digests[index] = encoded
+        codec_ids = None
+        if any(codecs):
+            codec_ids = array('B', bytes(len(self)))
+            for index, codec in enumerate(codecs):
+                codec_ids[index] = CODECS.intern(codec)
+        return BlockMap(self.width, self.locations, algorithms, digests, None, codec_ids)
+
+    def encode(self):
+        """_summary_    快照中的紧凑编码; 服务器和算法编号引用快照顶层的驻留表
+        """
+        encoded = {
+            "width": self.width,
+            "locations": base64.b64encode(self.locations.tobytes()).decode('ascii'),
+            "algorithms": base64.b64encode(self.algorithms.tobytes()).decode('ascii'),
+            "digests": base64.b64encode(self.digests.tobytes()).decode('ascii'),
+            "extra": {str(index): block for index, block in self.extra.items()},
+        }
+        if self.codecs is not None:
+            encoded["codecs"] = base64.b64encode(self.codecs.tobytes()).decode('ascii')
+        return encoded
+
+    @classmethod
+    def decode(cls, encoded, server_ids=None, algorithm_ids=None, byteorder=sys.byteorder, codec_ids=None):
+        """_summary_    解码快照中的紧凑编码
+
+        Args:
+            encoded (dict): encode 的结果
+            server_ids (list, optional):    快照中的服务器编号 -> 本进程的编号, 相同时为 None. Defaults to None.
+            algorithm_ids (list, optional): 快照中的算法编号 -> 本进程的编号, 相同时为 None. Defaults to None.
+            byteorder (str, optional):  写快照的机器的字节序. Defaults to sys.byteorder.
+            codec_ids (list, optional): 快照中的压缩算法编号 -> 本进程的编号, 相同时为 None. Defaults to None.
+        """
+        if "block" in encoded:
+            return SingleBlockMap.decode(encoded, server_ids, algorithm_ids, codec_ids)
+        # binascii 直接接受 str, 比 base64.b64decode 少一次参数检查和编码, 加载快照时每个文件调用三次
+        locations, algorithms, digests = array('H'), array('B'), array('Q')
+        locations.frombytes(binascii.a2b_base64(encoded["locations"]))
+        algorithms.frombytes(binascii.a2b_base64(encoded["algorithms"]))
+        digests.frombytes(binascii.a2b_base64(encoded["digests"]))
+        if byteorder != sys.byteorder:
+            locations.byteswap()
+            digests.byteswap()
+        if server_ids is not None:
+            locations = array('H', [NO_SERVER if server_id == NO_SERVER else server_ids[server_id]
+                                    for server_id in locations])
+        if algorithm_ids is not None:
+            algorithms = array('B', [algorithm_ids[algorithm_id] for algorithm_id in algorithms])
+        extra = {int(index): block for index, block in encoded.get("extra", {}).items()}
+        codecs = None
+        if "codecs" in encoded:
+            codecs = array('B')
+            codecs.frombytes(binascii.a2b_base64(encoded["codecs"]))
+            if codec_ids is not None:
+                codecs = array('B', [codec_ids[codec_id] for codec_id in codecs])
+        blocks = cls(encoded["width"], locations, algorithms, digests, extra, codecs)
+        if len(algorithms) == 1 and not extra:
+            return BlockMap.from_blocks(list(blocks))  # 旧快照中的单块文件
+        return blocks
+
+
+class SingleBlockMap:
+    __slots__ = ('servers', 'algorithm', 'digest', 'codec')
+
+    def __init__(self, servers, algorithm, digest, codec=0):
+        """_summary_: 只有一个块的文件的块映射, 接口与 BlockMap 相同
+
+        小文件 (以及去重块, 打包容器) 都只有一个块, 这时 BlockMap 的四个数组和 extra 字典的
+        对象头比数据本身大得多. 这里服务器编号保存在元组中, 校验和算法、摘要和压缩算法直接
+        保存为整数, 一个文件的块映射从约 440 字节降到约 160 字节.
+
+        Args:
+            servers (tuple):    服务器编号, 主服务器在前
+            algorithm (int):    校验和算法编号, 0 表示没有校验和
+            digest (int):   校验和摘要
+            codec (int, optional):  压缩算法编号. Defaults to 0 (未压缩).
+        """
+        self.servers = servers
+        self.algorithm = algorithm
+        self.digest = digest
+        self.codec = codec
+
+    @classmethod
+    def from_block(cls, block):
+        """_summary_    由块字典构造, 块带其他字段或校验和无法压缩时返回 None (由 BlockMap 原样保存)
+        """
+        encoded = BlockMap._encode_checksum(block.get("checksum"))
+        if block["blockID"] != 0 or not BLOCK_KEYS.issuperset(block) or encoded is None:
+            return None
+        servers = tuple(SERVERS.intern(server["host"], server["port"])
+                        for server in [block["primary"]] + block["replica"])
+        return cls(servers, encoded[0], encoded[1], CODECS.intern(block.get("codec")))
+
+    def __len__(self):
+        return 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(1))]
+        if index not in (0, -1):
+            raise IndexError("block index out of range")
+        servers = [SERVERS.address(server_id) for server_id in self.servers]
+        block = {"blockID": 0, "primary": servers[0], "replica": servers[1:]}
+        if self.algorithm:
+            name, digits = CHECKSUMS.algorithms[self.algorithm]
+            block["checksum"] = f"{name}:{self.digest:0{digits}x}"
+        if self.codec:
+            block["codec"] = CODECS.names[self.codec]
+        return block
+
+    def __iter__(self):
+        yield self[0]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def to_json(self):
+        return list(self)
+
+    def server_ids(self):
+        return set(self.servers)
+
+    def blocks_on(self, server_id):
+        return [0] if server_id in self.servers else []
+
+    def replace(self, index, block):
+        blocks = list(self)
+        blocks[index] = block
+        return BlockMap.from_blocks(blocks)
+
+    def with_checksums(self, checksums, codecs=None):
+        block = self[0]
+        block.pop("checksum", None)
+        block.pop("codec", None)
+        if checksums and checksums[0] is not None:
+            block["checksum"] = checksums[0]
+        if checksums and codecs and codecs[0]:
+            block["codec"] = codecs[0]
+        return BlockMap.from_blocks([block])
+
+    def encode(self):
+        """_summary_    快照中的紧凑编码: [校验和算法, 摘要, 压缩算法, 服务器编号...], 不需要 base64
+        """
+        return {"block": [self.algorithm, self.digest, self.codec, *self.servers]}
+
+    @classmethod
+    def decode(cls, encoded, server_ids=None, algorithm_ids=None, codec_ids=None):
+        algorithm, digest, codec, *servers = encoded["block"]
+        if server_ids is not None:
+            servers = [server_ids[server_id] for server_id in servers]
+        if algorithm_ids is not None:
+            algorithm = algorithm_ids[algorithm]
+        if codec_ids is not None:
+            codec = codec_ids[codec]
+        return cls(tuple(servers), algorithm, digest, codec)
+
+
+def encode_tables():
+    """_summary_    快照顶层保存的驻留表
+    """
+    return {"servers": [f"{host}:{port}" for host, port in SERVERS.addresses],
+            "checksums": [list(algorithm) for algorithm in CHECKSUMS.algorithms[1:]],
+            "codecs": CODECS.names[1:],
+            "byteorder": sys.byteorder}
+
+
+def decode_tables(tables):
+    """_summary_    把快照中的驻留表并入本进程, 返回服务器、校验和算法、压缩算法的编号映射 (与本进程一致时为 None)
+    """
+    server_ids = []
+    for server in tables.get("servers", []):
+        host, port = server.rsplit(':', 1)
+        server_ids.append(SERVERS.intern(host, int(port)))
+    algorithm_ids = [0] + [CHECKSUMS.intern(name, digits) for name, digits in tables.get("checksums", [])]
+    codec_ids = [0] + [CODECS.intern(name) for name in tables.get("codecs", [])]
+    if server_ids == list(range(len(server_ids))):
+        server_ids = None
+    if algorithm_ids == list(range(len(algorithm_ids))):
+        algorithm_ids = None
+    if codec_ids == list(range(len(codec_ids))):
+        codec_ids = None
+    return server_ids, algorithm_ids, codec_ids
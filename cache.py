@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, capacity, ttl=None, sizeof=None):
+        """_summary_: 线程安全的 LRU 缓存, 按容量淘汰最久未使用的条目, 可选过期时间
+
+        Args:
+            capacity (int): 容量, 单位由 sizeof 决定 (缺省为条目数)
+            ttl (float, optional):  条目的有效期(秒), None 表示不过期. Defaults to None.
+            sizeof (callable, optional):    计算条目大小的函数, 例如按字节计时用 len. Defaults to None.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.entries = OrderedDict()  # key -> (value, size, 过期时间)
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.capacity:
+            return  # 单个条目超过容量时不缓存
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.size += size
+            while self.size > self.capacity:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def stats(self):
+        """_summary_    命中/未命中/淘汰计数和当前占用
+
+        Returns:
+            dict:   统计信息
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "size": self.size, "capacity": self.capacity}
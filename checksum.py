@@ -0,0 +1,104 @@
+import zlib
+
+try:
+    import crc32c as _crc32c  # 可选依赖, 提供硬件加速的 CRC32C
+except ImportError:
+    _crc32c = None
+
+try:
+    import xxhash as _xxhash  # 可选依赖
+except ImportError:
+    _xxhash = None
+
+
+class _Crc32:
+    name = 'crc32'
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+
+class _Crc32c(_Crc32):
+    name = 'crc32c'
+
+    def update(self, data):
+        self.value = _crc32c.crc32c(data, self.value)
+
+
+class _Xxh64:
+    name = 'xxh64'
+
+    def __init__(self):
+        self.state = _xxhash.xxh3_64()
+
+    def update(self, data):
+        self.state.update(data)
+
+    def hexdigest(self):
+        return self.state.hexdigest()
+
+
+ALGORITHMS = {'crc32': _Crc32}
+if _crc32c is not None:
+    ALGORITHMS['crc32c'] = _Crc32c
+if _xxhash is not None:
+    ALGORITHMS['xxh64'] = _Xxh64
+
+# 优先使用最快的可用算法, 校验和带算法前缀, 不同客户端之间可以混用
+DEFAULT_ALGORITHM = 'crc32c' if _crc32c is not None else 'xxh64' if _xxhash is not None else 'crc32'
+
+
+class ChecksumError(Exception):
+    # 数据与记录的校验和不一致
+    pass
+
+
+def new_hasher(checksum=None):
+    """_summary_    创建增量校验器
+
+    Args:
+        checksum (str, optional):   已有的校验和, 指定时使用其算法. Defaults to None.
+
+    Returns:
+        _type_: 具有 update / hexdigest 的校验器, 算法在本机不可用时为 None
+    """
+    name = checksum.split(':', 1)[0] if checksum else DEFAULT_ALGORITHM
+    algorithm = ALGORITHMS.get(name)
+    return algorithm() if algorithm else None
+
+
+def format_checksum(hasher):
+    return f"{hasher.name}:{hasher.hexdigest()}"
+
+
+def compute(data):
+    """_summary_    计算数据的校验和
+
+    Returns:
+        str:    "算法:十六进制摘要"
+    """
+    hasher = new_hasher()
+    hasher.update(data)
+    return format_checksum(hasher)
+
+
+def verify(data, checksum):
+    """_summary_    校验数据, 本机不支持该校验和的算法时视为通过
+
+    Raises:
+        ChecksumError:  校验失败
+    """
+    if not checksum:
+        return
+    hasher = new_hasher(checksum)
+    if hasher is None:
+        return
+    hasher.update(data)
+    if format_checksum(hasher) != checksum:
+        raise ChecksumError(f"Checksum mismatch: expected {checksum}, got {format_checksum(hasher)}")
@@ -1,7 +1,47 @@
-import socket
+import hashlib
+import heapq
+import logging
 import os
 import math
-import json
+
+import checksum
+import metrics
+from cache import LRUCache
+from erasure import ReedSolomon
+from protocol import DEFAULT_BLOCK_SIZE, ConnectionPool, Op, ProtocolError, block_name
+from remote_file import RemoteFile
+from sharding import ShardMap
+from transfer import TransferEngine
+
+logger = logging.getLogger(__name__)
+
+
+def preallocate(fd, size):
+    """_summary_    预分配输出文件空间, 避免乱序写入造成碎片和空洞
+
+    Args:
+        fd (int):   文件描述符
+        size (int): 文件大小
+    """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # 文件系统不支持时退化为 ftruncate
+    os.ftruncate(fd, size)
+
+
+def read_whole_file(filename):
+    # 批量上传的小文件只有一个块, 整个文件就是块数据; 用 with 及时关闭, 不依赖垃圾回收
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+# Gear 滚动哈希表: 每个字节值对应一个固定的 64 位随机数, 所有客户端必须一致
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
 
 
 class FileSplitter:
@@ -33,34 +73,210 @@ class FileSplitter:
         file_size = os.path.getsize(filename)
         return math.ceil(file_size / block_size)
 
+    def split_chunks(self, filename, average_size=1024*1024):
+        """_summary_    按内容定义的边界分割文件 (Gear 滚动哈希)
+
+        边界只取决于附近的内容, 文件中间插入或删除数据后, 其余位置的块保持不变,
+        因此修改过的文件再次上传时大部分块可以去重. 块大小在 average_size 的
+        1/4 到 4 倍之间.
+
+        Args:
+            filename (_type_):  文件名
+            average_size (int, optional):   期望的平均块大小. Defaults to 1024*1024.
+
+        Yields:
+            _type_:     文件块
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(f"The file {filename} does not exist.")
+
+        min_size, max_size = average_size // 4, average_size * 4
+        bits = max((average_size - min_size).bit_length() - 1, 1)
+        mask = ((1 << bits) - 1) << (64 - bits)  # 取高位: Gear 哈希的高位混合了更长窗口的内容
+
+        with open(filename, 'rb') as file:
+            buffer = b''
+            while True:
+                if len(buffer) < max_size:
+                    buffer += file.read(max_size)
+                if not buffer:
+                    break
+                cut = len(buffer) if len(buffer) <= min_size else self._find_boundary(buffer, min_size, max_size, mask)
+                yield buffer[:cut]
+                buffer = buffer[cut:]
+
+    def _find_boundary(self, buffer, min_size, max_size, mask):
+        h = 0
+        end = min(len(buffer), max_size)
+        for i in range(min_size, end):
+            h = ((h << 1) + GEAR[buffer[i]]) & 0xFFFFFFFFFFFFFFFF
+            if not h & mask:
+                return i + 1
+        return end
+
+    def split_stripes(self, filename, codec, fragment_size=1024*1024):
+        """_summary_    按条带分割文件并做纠删码编码
+
+        每个条带读取 k 个分片大小的数据 (最后一个条带补零), 依次生成
+        k 个数据分片和 m 个校验分片.
+
+        Args:
+            filename (_type_):  文件名
+            codec (ReedSolomon):    纠删码
+            fragment_size (int, optional):  分片大小. Defaults to 1024*1024.
+
+        Yields:
+            _type_:     分片
+        """
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(f"The file {filename} does not exist.")
+
+        with open(filename, 'rb') as file:
+            while True:
+                stripe = file.read(codec.k * fragment_size)
+                if not stripe:
+                    break
+                stripe = stripe.ljust(codec.k * fragment_size, b'\0')
+                view = memoryview(stripe)
+                data_shards = [view[i * fragment_size:(i + 1) * fragment_size] for i in range(codec.k)]
+                yield from data_shards
+                yield from codec.encode(data_shards)
+
 
 class Client:
-    def __init__(self, master_host='localhost', master_port=5000):
+    def __init__(self, master_host='localhost', master_port=5000, max_workers=32, per_server_inflight=4,
+                 memory_budget=64*1024*1024, metadata_cache_blocks=100000, metadata_ttl=30, shards=None,
+                 trace_file=None, compression=None):
         """_summary_: 客户端类
 
         Args:
             master_host (str, optional):    主服务器地址. Defaults to 'localhost'.
             master_port (int, optional):    主服务器端口. Defaults to 5000.
+            max_workers (int, optional):    并发传输线程数. Defaults to 32.
+            per_server_inflight (int, optional):    每台存储服务器同时在途的块数. Defaults to 4.
+            memory_budget (int, optional):  在途块数据的内存预算(字节), 它的 1/4 也是 Master 为本客户端
+                自适应选择的块大小上限. Defaults to 64MiB.
+            metadata_cache_blocks (int, optional):  元数据缓存最多保存的块位置条数. Defaults to 100000.
+            metadata_ttl (float, optional): 缓存的块位置的有效期(秒), 有效期内可能读到其他客户端覆盖前的版本.
+                Defaults to 30.
+            shards (ShardMap, optional):    Master 分片表, 文件请求按 fileID 发往所属分片.
+                Defaults to None (只有一个 Master).
+            trace_file (str, optional): 逐请求的跟踪日志文件 (Master 请求和每个块的传输). Defaults to None (不记录).
+            compression (str, optional):    上传时的块压缩算法 "算法[:级别]" (zlib/lzma, 安装了相应的包时还有
+                zstd/lz4), 或 auto (抽样判断块是否值得压缩). 块的算法记录在元数据中, 读取时透明解压.
+                Defaults to None (不压缩).
         """
         self.master_address = (master_host, master_port)  # Master服务器地址
+        self.shards = shards or ShardMap([self.master_address])
+        self.pool = ConnectionPool()  # 到 Master 和存储服务器的长连接
+        self.engine = TransferEngine(self, max_workers, per_server_inflight, memory_budget)
+        # 至少有 4 个块能同时在途
+        self.max_block_size = max(memory_budget // 4, DEFAULT_BLOCK_SIZE)
+        self.compression = compression
+        # fileID -> 块位置, 热点文件的重复读取不经过 Master
+        self.metadata_cache = LRUCache(metadata_cache_blocks, metadata_ttl,
+                                       sizeof=lambda file_info: 1 + len(file_info['blocks']))
+        self.namespace = {}  # 分片地址 -> (版本号, 文件名列表)
+
+        self.registry = metrics.Registry({"role": "client"})
+        self.tracer = metrics.Tracer(trace_file)
+        self.master_seconds = self.registry.histogram('dfs_client_master_seconds', "Master request latency by command",
+                                                      ('op',))
+        self.block_seconds = self.registry.histogram('dfs_client_block_seconds', "Block transfer latency", ('op',))
+        self.block_bytes = self.registry.counter('dfs_client_block_bytes_total', "Block bytes transferred", ('op',))
+
+    @classmethod
+    def from_config(cls, config_file='servers.conf', **kwargs):
+        """_summary_    按配置文件中的 [master] / [shards] 创建客户端
+        """
+        shards = ShardMap.from_config(config_file)
+        host, port = shards.addresses[0]
+        return cls(host, port, shards=shards, **kwargs)
+
+    def serve_metrics(self, port, host='127.0.0.1'):
+        """_summary_    在后台线程中提供本客户端的 /metrics 端点
+
+        Returns:
+            ThreadingHTTPServer:    HTTP 服务器, 调用 shutdown 停止
+        """
+        return metrics.serve_metrics(port, [self.registry], host)
+
+    def _span(self, op, host, port, **fields):
+        # 一次块传输的计时范围
+        return metrics.Span(self.block_seconds, self.block_bytes, self.tracer, op, server=f"{host}:{port}", **fields)
+
+    def _call_master(self, opcode, meta=None, address=None):
+        # 带 fileID 的请求发往负责该文件的分片, 其余请求发往第一个分片
+        if address is None:
+            address = self.shards.shard_for(meta["fileID"]) if meta and "fileID" in meta else self.master_address
+        with metrics.Span(self.master_seconds, None, self.tracer, Op(opcode).name.lower(),
+                          master=f"{address[0]}:{address[1]}"):
+            response, _ = self.pool.call(address, opcode, meta)
+        return response
+
+    def _lookup(self, filename, cached=None):
+        """_summary_    向 Master 查询文件的块位置并放入缓存
+
+        Args:
+            filename (str): 文件名
+            cached (dict, optional):    已缓存的元数据, Master 上的版本号未变时沿用它. Defaults to None.
+
+        Returns:
+            dict:   文件元数据, 未变化时就是 cached 本身
+        """
+        meta = {"fileID": filename}
+        if cached is not None and "generation" in cached:
+            meta["generation"] = cached["generation"]
+        try:
+            file_info = self._call_master(Op.RETRIEVE, meta)
+        except ProtocolError:
+            self.metadata_cache.pop(filename)  # 文件已被删除
+            raise
+        if file_info.get("unchanged"):
+            file_info = cached
+        self.metadata_cache.put(filename, file_info)
+        return file_info
 
     def get_master_file_namespace(self):
-        """_summary_    获取Master服务器文件命名空间
+        """_summary_    获取Master服务器文件命名空间, 合并所有分片; 分片的命名空间未变化时不重发文件列表
 
         Returns:
-            _type_:    文件命名空间 list
+            _type_:    按文件名排序的文件命名空间 list
         """
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(self.master_address)
+        for address in self.shards:
+            cached = self.namespace.get(address)
+            response = self._call_master(Op.GET_FILE_NAMESPACE, {"generation": cached[0] if cached else None},
+                                         address)
+            if not response.get("unchanged"):
+                self.namespace[address] = (response["generation"], sorted(response["files"]))
+        return list(heapq.merge(*(self.namespace[address][1] for address in self.shards)))
 
-        # 发送获取文件空间请求
-        client.send("GET_FILE_NAMESPACE::tmp::tmp".encode('utf-8'))
-        response = client.recv(40960).decode('utf-8')
-        file_space = json.loads(response)  # 解析文件空间
+    def list_files(self, prefix=None, start=None, end=None, after=None, page_size=1000):
+        """_summary_    流式遍历命名空间: 每个分片按页返回排好序的文件, 在客户端归并, 用到时才请求下一页
 
-        client.close()
+        Args:
+            prefix (str, optional): 只列出以它开头的文件. Defaults to None.
+            start (str, optional):  起始文件名(含). Defaults to None.
+            end (str, optional):    结束文件名(不含). Defaults to None.
+            after (str, optional):  游标, 从这个文件名之后开始 (可用上次遍历到的最后一个文件名续传). Defaults to None.
+            page_size (int, optional):  每页的文件数. Defaults to 1000.
 
-        return file_space
+        Yields:
+            dict:   按文件名排序的 {"fileID", "size", "blocks"}, blocks 为块数
+        """
+        query = {key: value for key, value in (("prefix", prefix), ("start", start), ("end", end)) if value}
+
+        def pages(address):
+            cursor = after
+            while True:
+                response = self._call_master(Op.GET_FILE_NAMESPACE, dict(query, limit=page_size, after=cursor),
+                                             address)
+                yield from response["files"]
+                cursor = response["next"]
+                if cursor is None:
+                    break
+
+        yield from heapq.merge(*(pages(address) for address in self.shards), key=lambda entry: entry["fileID"])
 
     def get_storage_servers_status(self):
         """_summary_    获取存储服务器状态
@@ -68,62 +284,191 @@ class Client:
         Returns:
             _type_:   存储服务器状态 dict
         """
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(self.master_address)
+        return self._call_master(Op.GET_STORAGE_SERVERS_STATUS)
 
-        # 发送获取文件空间请求
-        client.send("GET_STORAGE_SERVERS_STATUS::tmp::tmp".encode('utf-8'))
-        response = client.recv(40960).decode('utf-8')
-        status = json.loads(response)  # 解析文件空间
-        client.close()
+    def get_storage_server_stats(self, server_host, server_port):
+        """_summary_    获取存储服务器的负载和读缓存统计
 
-        return status
+        Returns:
+            _type_:   剩余空间、在途请求数以及缓存命中/未命中/淘汰/预读计数 dict
+        """
+        response, _ = self.pool.call((server_host, server_port), Op.STATS)
+        return response
 
-    def store_file(self, filename):
+    def store_file(self, filename, replication=None, erasure=None, fragment_size=1024*1024, dedup=None, pack=False,
+                   block_size=None, compression=None):
         """_summary_    存储文件
 
         Args:
             filename (_type_):  文件名
-            data (_type_):  文件内容
+            replication (int, optional):    副本数(含主副本), 缺省使用集群配置. Defaults to None.
+            erasure (str, optional):    纠删码方案如 "4+2", 指定时以 Reed-Solomon 条带代替副本. Defaults to None.
+            fragment_size (int, optional):  纠删码分片大小. Defaults to 1024*1024.
+            dedup (str, optional):  去重模式, "fixed" 按固定大小切块, "cdc" 按内容定义边界切块. Defaults to None.
+            pack (bool, optional):  小文件打包模式, 不超过 Master 配置上限的文件追加到共享的容器块中,
+                更大的文件照常存储. Defaults to False.
+            block_size (int, optional): 块大小, 缺省由 Master 按文件大小和集群规模选择; 实际使用的块大小
+                记录在文件元数据中. Defaults to None.
+            compression (str, optional):    块压缩算法, 缺省使用客户端的设置; 去重、打包和纠删码文件不压缩.
+                Defaults to None.
         """
+        if dedup:
+            return self._store_deduplicated(filename, replication, dedup)
+
         splitter = FileSplitter()
         try:
-            number_of_blocks = splitter.get_number_of_blocks(filename)
-            print(f"Number of blocks: {number_of_blocks}")
+            request = {"fileID": filename, "size": os.path.getsize(filename), "replication": replication}
         except FileNotFoundError as e:
-            print(e)
+            logger.warning("%s", e)
             return
+        if erasure:
+            codec = ReedSolomon.parse(erasure)
+            number_of_stripes = splitter.get_number_of_blocks(filename, codec.k * fragment_size)
+            request["num_blocks"] = number_of_stripes * codec.n
+            request["erasure"] = {"k": codec.k, "m": codec.m, "fragment_size": fragment_size}
+        else:
+            # 块数由 Master 按选定的块大小算出
+            request["max_block_size"] = self.max_block_size
+            if block_size:
+                request["block_size"] = block_size
+            if pack:
+                request["pack"] = True
+
+        self.metadata_cache.pop(filename)
+        # 获取块索引
+        block_info = self._call_master(Op.STORE, request)
+        if block_info.get("packed"):
+            return self._store_packed(filename, block_info, replication, compression)
+
+        logger.debug("%s", block_info)
+
+        # 边读边发: 块从生成器流出, 发送到主服务器和副本后即被释放
+        if erasure:
+            # 纠删码分片需要等长, 不压缩
+            checksums, codecs = self.engine.upload(filename, block_info['blocks'],
+                                                   splitter.split_stripes(filename, codec, fragment_size),
+                                                   fragment_size)
+        else:
+            block_size = block_info.get('block_size', DEFAULT_BLOCK_SIZE)
+            logger.debug("Block size: %s, number of blocks: %s", block_size, len(block_info['blocks']))
+            checksums, codecs = self.engine.upload(filename, block_info['blocks'],
+                                                   splitter.split_file(filename, block_size), block_size,
+                                                   compression or self.compression)
+        # 所有块写入成功后, 把校验和 (及压缩算法) 记录到 Master
+        commit = {"fileID": filename, "checksums": checksums}
+        if any(codecs):
+            commit["codecs"] = codecs
+        self._call_master(Op.COMMIT, commit)
+
+        logger.info("File stored successfully.")
+
+    def _store_packed(self, filename, block_info, replication=None, compression=None):
+        """_summary_    把小文件写入 Master 预留的容器区间 (经主服务器链式复制), 然后提交
+
+        写入或提交失败 (服务器不可用、校验和不符、容器已不存在) 时改为按普通文件存储;
+        没有提交的预留区间成为容器中的空洞, 由容器压缩回收.
 
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 创建TCP套接字
-        client.connect(self.master_address)  # 连接Master服务器
+        Args:
+            filename (_type_):  文件名
+            block_info (dict):  Master 的响应, packed 为预留的 {"container", "offset", "length"}
+            replication (int, optional):    副本数, 改为普通存储时使用. Defaults to None.
+            compression (str, optional):    块压缩算法, 改为普通存储时使用. Defaults to None.
+        """
+        packed = block_info["packed"]
+        with open(filename, 'rb') as f:
+            data = f.read(packed["length"])
+        data_checksum = checksum.compute(data)
+        block = block_info["blocks"][0]
+        meta = {"block": block_name(packed["container"], 0), "offset": packed["offset"], "checksum": data_checksum}
+
+        primary = block["primary"]
+        try:
+            response, _ = self.pool.call((primary["host"], primary["port"]), Op.APPEND_BLOCK,
+                                         dict(meta, pipeline=block["replica"]), data)
+            stored = response.get("stored", [primary])
+        except (OSError, ProtocolError) as e:
+            logger.warning("Failed to append %s on %s:%s. Error: %s", filename, primary['host'], primary['port'], e)
+            stored = []
+        try:
+            # 链条中断时, 未写入的服务器由客户端直接补写
+            for server in [primary] + block["replica"]:
+                if server not in stored:
+                    self.pool.call((server["host"], server["port"]), Op.APPEND_BLOCK, meta, data)
+            self._call_master(Op.COMMIT, {"fileID": filename, "pack": True, "packed": packed,
+                                          "checksum": data_checksum})
+        except (OSError, ProtocolError) as e:
+            logger.warning("Failed to pack %s into container %s, storing it unpacked. Error: %s", filename,
+                           packed['container'], e)
+            return self.store_file(filename, replication, compression=compression)
+        logger.info("File stored successfully in container %s.", packed['container'])
+
+    def _read_packed(self, block_info):
+        """_summary_    从容器中范围读取打包的文件并校验, 依次尝试各个副本
 
-        # 获取块索引
-        client.send(f"STORE::{filename}::{number_of_blocks}".encode(
-            'utf-8'))  # 发送存储请求
-        response = client.recv(40960).decode('utf-8')  # 接收响应
-        block_info = json.loads(response)  # 解析块索引
+        Returns:
+            bytes:  文件内容
+        """
+        packed = block_info["packed"]
+        block = block_info["blocks"][0]
+        for server in [block["primary"]] + block["replica"]:
+            try:
+                data = self.retrieve_block_range(server["host"], server["port"], packed["container"], 0,
+                                                 packed["offset"], packed["length"])
+                checksum.verify(data, packed.get("checksum"))
+                return data
+            except Exception as e:
+                logger.warning("Failed to read %s from %s:%s. Error: %s", block_info['fileID'], server['host'],
+                               server['port'], e)
+        raise IOError(f"File {block_info['fileID']} is unavailable")
 
-        print(block_info)
+    def _store_deduplicated(self, filename, replication=None, chunking='cdc', chunk_size=1024*1024):
+        """_summary_    以内容寻址方式存储文件, 只上传集群中还没有的块
 
-        client.close()  # 关闭连接
+        第一遍读取文件计算每个块的 SHA-256, Master 返回缺失的块及其存放位置;
+        第二遍只读出并上传缺失的块. 块的内容由哈希唯一确定, 不同文件共享同一份数据.
 
-        # 根据块索引存储块
-        blocks = list(splitter.split_file(filename))
-        for block in block_info['blocks']:
-            block_id = block['blockID']
-            primary = block['primary']
+        Args:
+            filename (_type_):  文件名
+            replication (int, optional):    新块的副本数. Defaults to None.
+            chunking (str, optional):   "fixed" 或 "cdc". Defaults to 'cdc'.
+            chunk_size (int, optional): 固定块大小或内容定义分块的平均块大小. Defaults to 1024*1024.
+        """
+        splitter = FileSplitter()
+        self.metadata_cache.pop(filename)
 
-            print(
-                f"Storing block {block_id} on {primary['host']}:{primary['port']}")
+        def split():
+            if chunking == 'cdc':
+                return splitter.split_chunks(filename, chunk_size)
+            return splitter.split_file(filename, chunk_size)
 
-            self.store_block(primary['host'], primary['port'], filename,
-                             block_id, blocks[block_id])
-            # 存储副本
-            for replica in block['replica']:
-                self.store_block(
-                    replica['host'], replica['port'], filename, block_id, blocks[block_id])
+        try:
+            chunks = [{"hash": hashlib.sha256(chunk).hexdigest(), "size": len(chunk)} for chunk in split()]
+        except FileNotFoundError as e:
+            logger.warning("%s", e)
+            return
 
-        print("File stored successfully.")
+        upload = self._call_master(Op.STORE, {"fileID": filename, "dedup": True, "chunks": chunks,
+                                              "size": os.path.getsize(filename), "replication": replication})
+        missing = upload['missing']
+        logger.info("Deduplicated %s: %s of %s unique chunks need uploading", filename, len(missing),
+                    len(set(chunk['hash'] for chunk in chunks)))
+
+        def missing_data():
+            # 按 missing 的顺序 (即哈希在文件中首次出现的顺序) 生成块数据, 每个块只上传一次
+            wanted = {block['hash'] for block in missing}
+            for chunk in split():
+                digest = hashlib.sha256(chunk).hexdigest()
+                if digest in wanted:
+                    wanted.discard(digest)
+                    yield chunk
+
+        max_chunk_size = chunk_size * 4 if chunking == 'cdc' else chunk_size
+        # 去重块在文件之间共享, 不压缩
+        block_checksums, _ = self.engine.upload(filename, missing, missing_data(), max_chunk_size)
+        checksums = {block['hash']: block_checksum for block, block_checksum in zip(missing, block_checksums)}
+        self._call_master(Op.COMMIT, {"fileID": filename, "dedup": True, "chunks": chunks, "checksums": checksums})
+
+        logger.info("File stored successfully.")
 
     def retrieve_file(self, filename):
         """_summary_    检索文件
@@ -134,46 +479,166 @@ class Client:
         Returns:
             _type_:    文件内容
         """
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(self.master_address)
+        # 获取块索引, 优先使用缓存
+        cached = self.metadata_cache.get(filename)
+        try:
+            self._download_file(filename, cached or self._lookup(filename))
+        except Exception:
+            if cached is None:
+                raise
+            # 缓存的块位置可能已过期 (文件被覆盖、删除或副本被迁移), 向 Master 确认后重试一次
+            block_info = self._lookup(filename, cached)
+            if block_info is cached:
+                raise
+            self._download_file(filename, block_info)
+
+        logger.info("File retrieved successfully.")
+
+    def _download_file(self, filename, block_info):
+        # 根据块索引并发检索块, 每个块到达后直接写入预分配文件中的偏移
+        part_file = filename + '.part'
+        with open(part_file, 'wb') as file:
+            preallocate(file.fileno(), block_info.get('size', 0))
+            try:
+                if block_info.get('packed'):
+                    file.write(self._read_packed(block_info))
+                elif block_info.get('erasure'):
+                    self.engine.download_stripes(filename, block_info, file.fileno())
+                elif block_info.get('dedup'):
+                    max_chunk_size = max((block['size'] for block in block_info['blocks']), default=0)
+                    self.engine.download(filename, block_info['blocks'], file.fileno(), max_chunk_size)
+                else:
+                    self.engine.download(filename, block_info['blocks'], file.fileno(),
+                                         block_info.get('block_size', DEFAULT_BLOCK_SIZE))
+            except Exception:
+                file.close()
+                os.remove(part_file)
+                raise
+        os.replace(part_file, filename)
+
+    def open(self, filename, mode='rb', prefetch=4):
+        """_summary_    以只读方式打开 DFS 文件, 按需读取而不下载整个文件
 
-        # 获取块索引
-        client.send(f"RETRIEVE::{filename}::".encode('utf-8'))
-        response = client.recv(40960).decode('utf-8')
-        block_info = json.loads(response)  # 解析块索引
+        Args:
+            filename (_type_):  文件名
+            mode (str, optional):   只支持 'rb'. Defaults to 'rb'.
+            prefetch (int, optional):   顺序读时预读的块数. Defaults to 4.
 
-        client.close()
+        Returns:
+            RemoteFile: 支持 seek/tell/read/readinto 的文件对象
+        """
+        if mode != 'rb':
+            raise ValueError(f"Unsupported mode {mode!r}, DFS files can only be opened with 'rb'")
+        file_info = self.metadata_cache.get(filename) or self._lookup(filename)
+        return RemoteFile(self, filename, file_info, prefetch=prefetch)
 
-        # 根据块索引检索块
-        data = bytearray()
-        for block in block_info['blocks']:
-            block_id = block['blockID']
-            primary = block['primary']
-            print(
-                f"Retrieving block {block_id} from {primary['host']}:{primary['port']}")
+    def store_files(self, filenames, replication=None, batch_size=1000):
+        """_summary_    批量存储多个文件 (适合大量小文件)
 
-            try:
-                block_data = self.retrieve_block(
-                    primary['host'], primary['port'], filename,  block_id)
-                data.extend(block_data)
-            except Exception as e:
-                print(
-                    f"Failed to retrieve block {block_id} from {primary['host']}:{primary['port']}. Error: {e}")
-                # 尝试从副本服务器检索
-                for replica in block['replica']:
-                    try:
-                        block_data = self.retrieve_block(
-                            replica['host'], replica['port'], filename, block_id)
-                        data.extend(block_data)
-                        break
-                    except Exception as e:
-                        print(
-                            f"Failed to retrieve block {block_id} from replica {replica['host']}:{replica['port']}. Error: {e}")
-
-        with open(filename, 'wb') as file:
-            file.write(data)
-
-        print("File retrieved successfully.")
+        每批文件在每个 Master 分片上只需一次分配请求和一次提交请求, 元数据只落盘一次;
+        只有一个块的小文件按复制链分组, 一个 STORE_BLOCK 请求携带多个块.
+
+        Args:
+            filenames (list):   文件名
+            replication (int, optional):    副本数(含主副本), 缺省使用集群配置. Defaults to None.
+            batch_size (int, optional): 每批的文件数. Defaults to 1000.
+
+        Returns:
+            list:   成功存储的文件名
+        """
+        splitter = FileSplitter()
+        stored = []
+        for start in range(0, len(filenames), batch_size):
+            requests = {}  # 分片地址 -> 分配请求
+            for filename in filenames[start:start + batch_size]:
+                try:
+                    size = os.path.getsize(filename)
+                except FileNotFoundError as e:
+                    logger.warning("%s", e)
+                    continue
+                self.metadata_cache.pop(filename)
+                requests.setdefault(self.shards.shard_for(filename), []).append(
+                    {"fileID": filename, "size": size, "replication": replication,
+                     "max_block_size": self.max_block_size})
+
+            # 某个分片或某个文件失败时只跳过相关的文件, 其余文件照常上传和提交
+            allocated = {}
+            for address, files in requests.items():
+                try:
+                    allocated[address] = self._call_master(Op.STORE_MANY, {"files": files}, address)["files"]
+                except (OSError, ProtocolError) as e:
+                    logger.warning("Failed to allocate %s files on %s:%s. Error: %s", len(files), address[0],
+                                   address[1], e)
+
+            # 小文件合并成多块请求, 大文件仍按块流式上传
+            small = [(file_info["fileID"], file_info["blocks"][0], file_info["size"])
+                     for files in allocated.values() for file_info in files if len(file_info["blocks"]) == 1]
+            checksums, codecs, failed = self.engine.upload_batched(
+                small, lambda filename, block: read_whole_file(filename), compression=self.compression)
+            for files in allocated.values():
+                for file_info in files:
+                    if len(file_info["blocks"]) != 1:
+                        block_size = file_info.get("block_size", DEFAULT_BLOCK_SIZE)
+                        try:
+                            checksums[file_info["fileID"]], codecs[file_info["fileID"]] = self.engine.upload(
+                                file_info["fileID"], file_info["blocks"],
+                                splitter.split_file(file_info["fileID"], block_size), block_size, self.compression)
+                        except Exception as e:  # upload 抛出工作线程中的第一个错误, 类型不定
+                            failed[file_info["fileID"]] = e
+            for filename, error in failed.items():
+                logger.warning("Failed to store %s. Error: %s", filename, error)
+
+            for address, files in allocated.items():
+                files = [file_info["fileID"] for file_info in files if file_info["fileID"] not in failed]
+                if not files:
+                    continue
+                try:
+                    self._call_master(Op.COMMIT, {"files": [{"fileID": file_id, "checksums": checksums[file_id],
+                                                             "codecs": codecs[file_id]} for file_id in files]},
+                                      address)
+                except (OSError, ProtocolError) as e:
+                    logger.warning("Failed to commit %s files on %s:%s. Error: %s", len(files), address[0],
+                                   address[1], e)
+                    continue
+                stored += files
+        logger.info("%s files stored successfully.", len(stored))
+        return stored
+
+    def delete_files(self, filenames, batch_size=1000):
+        """_summary_    批量删除多个文件: 每批每个分片一次 Master 请求, 每台存储服务器一次批量删除
+
+        Args:
+            filenames (list):   文件名
+            batch_size (int, optional): 每批的文件数. Defaults to 1000.
+
+        Returns:
+            list:   不存在的文件名
+        """
+        missing = []
+        for start in range(0, len(filenames), batch_size):
+            batch = {}
+            for filename in filenames[start:start + batch_size]:
+                self.metadata_cache.pop(filename)
+                batch.setdefault(self.shards.shard_for(filename), []).append(filename)
+
+            deletes = {}  # (host, port) -> 块名
+            for address, file_ids in batch.items():
+                response = self._call_master(Op.DELETE_MANY, {"fileIDs": file_ids}, address)
+                missing += response["missing"]
+                for file_info in response["files"]:
+                    for block in file_info["blocks"]:
+                        for server in [block["primary"]] + block["replica"]:
+                            deletes.setdefault((server["host"], server["port"]), []).append(
+                                block_name(file_info["fileID"], block["blockID"]))
+
+            for (host, port), names in deletes.items():
+                logger.debug("Deleting %s blocks from %s:%s", len(names), host, port)
+                try:
+                    self._delete_named_blocks(host, port, names)
+                except OSError as e:
+                    logger.warning("Failed to delete blocks from %s:%s. Error: %s", host, port, e)
+        logger.info("%s files deleted successfully.", len(filenames) - len(missing))
+        return missing
 
     def delete_file(self, filename):
         """_summary_    删除文件
@@ -181,84 +646,122 @@ class Client:
         Args:
             filename (_type_): 文件名
         """
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect(self.master_address)
-
-        client.send(f"DELETE::{filename}::".encode('utf-8'))
-        response = client.recv(40960).decode('utf-8')
-        block_info = json.loads(response)  # 解析块索引
-
-        client.close()
+        self.metadata_cache.pop(filename)
+        block_info = self._call_master(Op.DELETE, {"fileID": filename})
 
+        # 按存储服务器分组, 每台服务器上的删除请求流水线发送
+        deletes = {}
         for block in block_info['blocks']:
             block_id = block['blockID']
-            primary = block['primary']
-            print(
-                f"Deleting block {block_id} from {primary['host']}:{primary['port']}")
-
-            self.delete_block(
-                primary['host'], primary['port'], filename,  block_id)
-
-            for replica in block['replica']:
-                self.delete_block(
-                    replica['host'], replica['port'], filename, block_id)
-
-        print("File deleted successfully.")
-
-    def store_block(self, server_host, server_port, filename, block_id, block_data):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((server_host, server_port))
-        client.send(
-            f"STORE_BLOCK::{filename}_block_{block_id}".encode('utf-8'))
-        response = client.recv(1024).decode('utf-8')
-        if response == 'READY':
-
-            print("start storing block")
-
-            data_length = len(block_data)
-            client.send(str(data_length).encode('utf-8'))  # 发送数据长度
-
-            response = client.recv(1024).decode('utf-8')
-            if response == 'LENGTH_RECEIVED':
-
-                for i in range(0, len(block_data), 1024*256):
-                    client.send(block_data[i:i+1024*256])
-
-                print("block sent")
-
-                ack = client.recv(1024).decode('utf-8')
-                if ack == 'STORED':
-                    print(
-                        f"Block {block_id} stored successfully on {server_host}:{server_port}")
-        client.close()
-
-    def retrieve_block(self, server_host, server_port, filename, block_id, block_size=1024*1024):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((server_host, server_port))
-        client.send(
-            f"RETRIEVE_BLOCK::{filename}_block_{block_id}".encode('utf-8'))
-        response = client.recv(1024).decode('utf-8')
-
-        block_data = bytearray()
-        if response == 'READY':
-            client.send(b'READY')
-            file_size = int(client.recv(1024).decode('utf-8'))  # 接收文件大小
-            client.send(b'LENGTH_RECEIVED')
-            while len(block_data) < file_size:
-                packet = client.recv(1024*256)
-                block_data.extend(packet)
-
-        client.close()
+            for server in [block['primary']] + block['replica']:
+                deletes.setdefault((server['host'], server['port']), []).append(block_id)
+
+        for (host, port), block_ids in deletes.items():
+            logger.debug("Deleting %s blocks from %s:%s", len(block_ids), host, port)
+            try:
+                self.delete_blocks(host, port, filename, block_ids)
+            except OSError as e:
+                logger.warning("Failed to delete blocks from %s:%s. Error: %s", host, port, e)
+
+        logger.info("File deleted successfully.")
+
+    def store_block(self, server_host, server_port, filename, block_id, block_data, block_checksum=None,
+                    pipeline=None):
+        """_summary_    存储块
+
+        Args:
+            block_checksum (str, optional): 块校验和, 存储服务器据此校验收到的数据. Defaults to None.
+            pipeline (list, optional):  由该服务器依次转发的下游服务器 [{"host", "port"}, ...]. Defaults to None.
+
+        Returns:
+            dict:   存储服务器的响应, stored 为链上成功写入的服务器
+        """
+        meta = {"block": block_name(filename, block_id)}
+        if block_checksum:
+            meta["checksum"] = block_checksum
+        if pipeline:
+            meta["pipeline"] = pipeline
+        with self._span('store', server_host, server_port, block=meta["block"]) as span:
+            response, _ = self.pool.call((server_host, server_port), Op.STORE_BLOCK, meta, block_data)
+            span.bytes = len(block_data)
+        logger.debug("Block %s stored successfully on %s:%s", block_id, server_host, server_port)
+        return response or {}
+
+    def store_blocks(self, server_host, server_port, blocks, pipeline=None):
+        """_summary_    在一个请求中存储多个块 (小文件批量写入), 数据在一帧中首尾相接
+
+        Args:
+            blocks (list):  [(文件名, 块ID, 块数据, 校验和), ...]
+            pipeline (list, optional):  由该服务器依次转发的下游服务器 [{"host", "port"}, ...]. Defaults to None.
+
+        Returns:
+            dict:   存储服务器的响应, stored 为链上成功写入的服务器, errors 为校验失败的块名 -> 错误
+        """
+        meta = {"blocks": [{"block": block_name(filename, block_id), "checksum": block_checksum, "length": len(data)}
+                           for filename, block_id, data, block_checksum in blocks]}
+        if pipeline:
+            meta["pipeline"] = pipeline
+        frame = b''.join(data for _, _, data, _ in blocks)
+        with self._span('store', server_host, server_port, blocks=len(blocks)) as span:
+            response, _ = self.pool.call((server_host, server_port), Op.STORE_BLOCK, meta, frame)
+            span.bytes = len(frame)
+        logger.debug("%s blocks stored successfully on %s:%s", len(blocks), server_host, server_port)
+        return response
+
+    def retrieve_block(self, server_host, server_port, filename, block_id, block_size=1024*1024, buffer=None,
+                       block_checksum=None):
+        """_summary_    检索块并校验
+
+        Args:
+            buffer (memoryview, optional):  接收缓冲区, 指定时块数据直接 recv_into 到其中. Defaults to None.
+            block_checksum (str, optional): Master 记录的校验和, 缺省时使用存储服务器返回的. Defaults to None.
+
+        Raises:
+            ChecksumError:  块数据校验失败, 调用方应改从副本读取
+
+        Returns:
+            _type_: 块数据, 指定 buffer 时是 buffer 的一段
+        """
+        with self._span('retrieve', server_host, server_port, block=block_name(filename, block_id)) as span:
+            meta, block_data = self.pool.call((server_host, server_port), Op.RETRIEVE_BLOCK,
+                                              {"block": block_name(filename, block_id)}, into=buffer)
+            span.bytes = len(block_data)
+            checksum.verify(block_data, block_checksum or (meta or {}).get("checksum"))
         return block_data
 
+    def retrieve_block_range(self, server_host, server_port, filename, block_id, offset, length):
+        """_summary_    只读取块内 [offset, offset+length) 的一段, 存储服务器负责校验整个块
+
+        Returns:
+            _type_: 数据, 超出块末尾的部分被截断
+        """
+        with self._span('retrieve_range', server_host, server_port, block=block_name(filename, block_id)) as span:
+            _, data = self.pool.call((server_host, server_port), Op.RETRIEVE_BLOCK,
+                                     {"block": block_name(filename, block_id), "offset": offset, "length": length})
+            span.bytes = len(data)
+        return data
+
     def delete_block(self, server_host, server_port, filename, block_id):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((server_host, server_port))
-        client.send(
-            f"DELETE_BLOCK::{filename}_block_{block_id}".encode('utf-8'))
-        response = client.recv(1024).decode('utf-8')
+        self.delete_blocks(server_host, server_port, filename, [block_id])
 
-        return
+    def delete_blocks(self, server_host, server_port, filename, block_ids):
+        """_summary_    在一个连接上流水线删除多个块, 不存在的块被忽略
+
+        Args:
+            server_host (str):  存储服务器地址
+            server_port (int):  存储服务器端口
+            filename (str): 文件名
+            block_ids (list):   块ID列表
+        """
+        self._delete_named_blocks(server_host, server_port, [block_name(filename, block_id) for block_id in block_ids])
+
+    def _delete_named_blocks(self, server_host, server_port, names, batch_size=1024):
+        # 每个请求删除 batch_size 个块, 多个请求在一个连接上流水线发送
+        requests = [(Op.DELETE_BLOCK, {"blocks": names[start:start + batch_size]}, b'')
+                    for start in range(0, len(names), batch_size)]
+        for result in self.pool.pipeline((server_host, server_port), requests):
+            if isinstance(result, ProtocolError):
+                logger.warning("Failed to delete blocks from %s:%s. Error: %s", server_host, server_port, result)
 
 
 if __name__ == "__main__":
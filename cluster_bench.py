@@ -0,0 +1,339 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from client import Client
+from loadtest import wait_for_port
+from master_server import run_master_shard
+from metadata_bench import generate_files, write_snapshot
+from protocol import Op
+from storage_server import start_storage_servers
+
+MiB = 1024 * 1024
+
+
+def run_storage(config_file):
+    for server_thread in start_storage_servers(config_file):
+        server_thread.join()
+
+
+class LocalCluster:
+    def __init__(self, port, servers=3, replication=2, mode='threaded', files=None):
+        """_summary_: 在本机临时目录中运行的测试集群
+
+        Master 和每台存储服务器各是一个进程, 存储服务器可以单独杀掉以测试恢复.
+        存储服务器通过 start_storage_servers 启动, 各自的配置文件中只列出自己.
+
+        Args:
+            port (int): Master 端口, 存储服务器依次使用 port+1, port+2 ...
+            servers (int, optional):    存储服务器数. Defaults to 3.
+            replication (int, optional):    默认副本数. Defaults to 2.
+            mode (str, optional):   服务器运行模式 threaded / asyncio. Defaults to 'threaded'.
+            files (iterable, optional): 预先写入 Master 元数据快照的 file_info. Defaults to None.
+        """
+        self.workdir = tempfile.mkdtemp(prefix='cluster_bench-')
+        self.port = port
+        self.master_address = ('localhost', port)
+        self.servers = {f"server{i}": ('localhost', port + i) for i in range(1, servers + 1)}
+        self.replication = replication
+        self.mode = mode
+        self.metadata_file = os.path.join(self.workdir, 'metadata.json')
+        if files is not None:
+            write_snapshot(self.metadata_file, files, compact=True)
+        self.config_file = self._write_config('servers.conf', self.servers)
+        self.processes = {}
+
+    def _write_config(self, name, servers):
+        config_file = os.path.join(self.workdir, name)
+        with open(config_file, 'w') as f:
+            f.write(f"[master]\nserver = localhost:{self.port}\n\n[servers]\n")
+            f.write(''.join(f"{server} = {host}:{port}\n" for server, (host, port) in servers.items()))
+            f.write("\n[paths]\n")
+            f.write(''.join(f"{server} = {os.path.join(self.workdir, server)}\n" for server in self.servers))
+            f.write(f"\n[runtime]\nmode = {self.mode}\n\n[placement]\nreplication_factor = {self.replication}\n\n"
+                    "[logging]\nlevel = WARNING\n")
+        return config_file
+
+    def start(self, timeout=300):
+        """_summary_    启动 Master 和所有存储服务器, 等待它们开始监听
+
+        Returns:
+            float:  Master 的启动耗时(秒), 包括加载元数据快照
+        """
+        start = time.perf_counter()
+        self.processes["master"] = multiprocessing.Process(
+            target=run_master_shard, args=('localhost', self.port, self.config_file, self.metadata_file))
+        self.processes["master"].start()
+        wait_for_port(self.master_address, timeout)
+        startup_seconds = time.perf_counter() - start
+        for server in self.servers:
+            self.start_server(server)
+        for address in self.servers.values():
+            wait_for_port(address, timeout)
+        return startup_seconds
+
+    def start_server(self, server):
+        config_file = self._write_config(f"{server}.conf", {server: self.servers[server]})
+        process = multiprocessing.Process(target=run_storage, args=(config_file,))
+        process.start()
+        self.processes[server] = process
+
+    def kill(self, server):
+        # 模拟宕机: 不给进程清理的机会
+        process = self.processes.pop(server)
+        process.kill()
+        process.join()
+
+    def client(self, **kwargs):
+        return Client(*self.master_address, **kwargs)
+
+    def stop(self):
+        for process in self.processes.values():
+            process.kill()
+            process.join()
+        self.processes.clear()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def check_file(path, data):
+    with open(path, 'rb') as f:
+        if f.read() != data:
+            raise RuntimeError(f"{path} does not match the uploaded data")
+
+
+def bench_throughput(cluster, file_sizes, block_sizes, rounds):
+    """_summary_    大文件上传/下载吞吐量, 每种文件大小和块大小的组合取 rounds 次的中位数
+
+    下载紧跟在上传之后, 数据多半仍在存储服务器的页缓存和块缓存中.
+    块大小 0 表示由 Master 自适应选择, 结果中记录实际使用的块大小.
+
+    Returns:
+        list:   每种组合一条结果
+    """
+    client = cluster.client()
+    results = []
+    for size, block_size in itertools.product(file_sizes, block_sizes):
+        data = os.urandom(size)
+        name = f"throughput-{size}.bin"
+        uploads, downloads = [], []
+        for _ in range(rounds):
+            write_file(name, data)
+            start = time.perf_counter()
+            client.store_file(name, block_size=block_size or None)
+            uploads.append(time.perf_counter() - start)
+            file_info, _ = client.pool.call(cluster.master_address, Op.RETRIEVE, {"fileID": name})
+            os.remove(name)
+            start = time.perf_counter()
+            client.retrieve_file(name)
+            downloads.append(time.perf_counter() - start)
+            check_file(name, data)
+            os.remove(name)
+            client.delete_file(name)
+        results.append({"benchmark": "throughput", "file_size": size, "block_size": file_info["block_size"],
+                        "adaptive": not block_size, "blocks": len(file_info["blocks"]), "rounds": rounds,
+                        "upload_mb_per_sec": size / MiB / statistics.median(uploads),
+                        "download_mb_per_sec": size / MiB / statistics.median(downloads)})
+    return results
+
+
+def bench_small_files(cluster, count, size):
+    """_summary_    小文件每秒操作数: 逐个存储、批量存储、打包存储、逐个读取和删除
+
+    Returns:
+        dict:   测试结果
+    """
+    client = cluster.client()
+    data = os.urandom(size)
+
+    def timed(operation, names):
+        for name in names:
+            write_file(name, data)
+        start = time.perf_counter()
+        operation(names)
+        return len(names) / (time.perf_counter() - start)
+
+    single = [f"small-single-{i:06d}.bin" for i in range(count)]
+    batched = [f"small-batched-{i:06d}.bin" for i in range(count)]
+    packed = [f"small-packed-{i:06d}.bin" for i in range(count)]
+    result = {"benchmark": "small_files", "files": count, "file_size": size}
+    result["store_ops_per_sec"] = timed(lambda names: [client.store_file(name) for name in names], single)
+    result["store_batched_ops_per_sec"] = timed(client.store_files, batched)
+    result["store_packed_ops_per_sec"] = timed(
+        lambda names: [client.store_file(name, pack=True) for name in names], packed)
+
+    for name in single + packed:
+        os.remove(name)
+    start = time.perf_counter()
+    for name in single:
+        client.retrieve_file(name)
+    result["retrieve_ops_per_sec"] = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for name in packed:
+        client.retrieve_file(name)
+    result["retrieve_packed_ops_per_sec"] = count / (time.perf_counter() - start)
+    for name in single + packed:
+        check_file(name, data)
+
+    start = time.perf_counter()
+    for name in single:
+        client.delete_file(name)
+    result["delete_ops_per_sec"] = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    client.delete_files(batched + packed)
+    result["delete_batched_ops_per_sec"] = 2 * count / (time.perf_counter() - start)
+    for name in single + batched + packed:
+        os.remove(name)
+    return result
+
+
+def bench_metadata(port, files, lookups):
+    """_summary_    Master 上已有 files 个文件时的元数据查询延迟
+
+    Master 从预先生成的快照启动 (每个文件一个块, 不需要存储服务器上真有数据),
+    然后在一个长连接上逐个查询随机文件的块位置, 并列出第一页命名空间.
+
+    Returns:
+        dict:   测试结果
+    """
+    # 与 Master 写入的记录一样带版本号
+    snapshot = (dict(file_info, generation=1) for file_info in generate_files(files, 1, servers=16, replication=2))
+    with LocalCluster(port, servers=1, files=snapshot) as cluster:
+        startup_seconds = cluster.start()
+        client = cluster.client()
+        rng = random.Random(0)
+        latencies = []
+        for _ in range(lookups):
+            file_id = f"/bench/file-{rng.randrange(files):08d}"
+            start = time.perf_counter()
+            client.pool.call(cluster.master_address, Op.RETRIEVE, {"fileID": file_id})
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        page = list(itertools.islice(client.list_files(page_size=1000), 1000))
+        list_seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {"benchmark": "metadata_lookup", "files": files, "master_startup_seconds": startup_seconds,
+            "lookups": lookups, "lookups_per_sec": lookups / sum(latencies),
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            "list_page_files": len(page), "list_page_ms": list_seconds * 1000}
+
+
+def bench_recovery(port, servers, replication, total_size, file_size, timeout=600):
+    """_summary_    杀掉一台存储服务器后, Master 发现宕机并把它上面的块补足副本的时间
+
+    发现宕机取决于 Master 的心跳超时 (10 秒, 每 10 秒检查一次), 补副本的速度受
+    [replication] 段的带宽上限约束 (默认 32MiB/s). 两者都以 0.1 秒的间隔轮询 Master 得到.
+
+    Returns:
+        dict:   测试结果
+    """
+    with LocalCluster(port, servers, replication) as cluster:
+        cluster.start()
+        client = cluster.client()
+        names = [f"recovery-{i:04d}.bin" for i in range(max(1, total_size // file_size))]
+        contents = {}
+        for name in names:
+            contents[name] = os.urandom(file_size)
+            write_file(name, contents[name])
+        client.store_files(names)
+
+        victim = next(iter(cluster.servers))
+        address = "%s:%s" % cluster.servers[victim]
+
+        def blocks_on_victim():
+            count = 0
+            for name in names:
+                file_info, _ = client.pool.call(cluster.master_address, Op.RETRIEVE, {"fileID": name})
+                count += sum(1 for block in file_info["blocks"] for server in [block["primary"]] + block["replica"]
+                             if f"{server['host']}:{server['port']}" == address)
+            return count
+
+        lost = blocks_on_victim()
+        start = time.perf_counter()
+        cluster.kill(victim)
+        detect_seconds = None
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed > timeout:
+                raise TimeoutError(f"Blocks on {victim} were not re-replicated within {timeout}s")
+            if detect_seconds is None and not client.get_storage_servers_status().get(address, True):
+                detect_seconds = elapsed
+            if detect_seconds is not None and blocks_on_victim() == 0:
+                break
+            time.sleep(0.1)
+        recovery_seconds = time.perf_counter() - start
+
+        for name in names:
+            os.remove(name)
+            client.retrieve_file(name)
+            check_file(name, contents[name])
+            os.remove(name)
+
+    return {"benchmark": "recovery", "servers": servers, "replication": replication, "files": len(names),
+            "bytes": len(names) * file_size, "blocks_lost": lost, "detect_seconds": detect_seconds,
+            "recovery_seconds": recovery_seconds, "repair_seconds": recovery_seconds - detect_seconds}
+
+
+def sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在本机启动 Master 和存储服务器, 测试数据路径和元数据路径的性能")
+    parser.add_argument('--benchmarks', default='throughput,small_files,metadata,recovery',
+                        help="逗号分隔的测试项: throughput, small_files, metadata, recovery")
+    parser.add_argument('--port', type=int, default=5200, help="测试集群使用的起始端口")
+    parser.add_argument('--servers', type=int, default=3, help="存储服务器数")
+    parser.add_argument('--replication', type=int, default=2, help="副本数")
+    parser.add_argument('--mode', default='threaded', help="服务器运行模式 threaded / asyncio")
+    parser.add_argument('--file-sizes', type=sizes, default=[MiB, 16*MiB, 128*MiB], help="逗号分隔的文件大小(字节)")
+    parser.add_argument('--block-sizes', type=sizes, default=[0, MiB, 16*MiB],
+                        help="逗号分隔的块大小(字节), 0 表示由 Master 自适应选择")
+    parser.add_argument('--rounds', type=int, default=3, help="吞吐量测试每种文件大小重复的次数")
+    parser.add_argument('--small-files', type=int, default=500, help="小文件测试的文件数")
+    parser.add_argument('--small-file-size', type=int, default=4096, help="小文件大小(字节)")
+    parser.add_argument('--metadata-files', type=sizes, default=[10000, 100000, 1000000],
+                        help="逗号分隔的 Master 文件数")
+    parser.add_argument('--lookups', type=int, default=10000, help="每种规模的元数据查询次数")
+    parser.add_argument('--recovery-size', type=int, default=256*MiB, help="恢复测试写入的数据量(字节)")
+    parser.add_argument('--recovery-file-size', type=int, default=16*MiB, help="恢复测试的文件大小(字节)")
+    args = parser.parse_args()
+    benchmarks = args.benchmarks.split(',')
+
+    workdir = tempfile.mkdtemp(prefix='cluster_bench-client-')
+    os.chdir(workdir)  # 客户端以文件名作为 fileID, 在临时目录中读写
+    if 'throughput' in benchmarks or 'small_files' in benchmarks:
+        with LocalCluster(args.port, args.servers, args.replication, args.mode) as cluster:
+            cluster.start()
+            if 'throughput' in benchmarks:
+                for result in bench_throughput(cluster, args.file_sizes, args.block_sizes, args.rounds):
+                    print(json.dumps(result))
+            if 'small_files' in benchmarks:
+                print(json.dumps(bench_small_files(cluster, args.small_files, args.small_file_size)))
+    if 'metadata' in benchmarks:
+        for files in args.metadata_files:
+            print(json.dumps(bench_metadata(args.port, files, args.lookups)))
+    if 'recovery' in benchmarks:
+        # 多启动一台, 杀掉一台后仍有 servers 台服务器可以放置补充的副本
+        print(json.dumps(bench_recovery(args.port, args.servers + 1, args.replication, args.recovery_size,
+                                        args.recovery_file_size)))
+    shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,126 @@
+import lzma
+import zlib
+
+try:
+    import zstandard as _zstd  # 可选依赖, 压缩和解压都比 zlib 快得多
+except ImportError:
+    _zstd = None
+
+try:
+    import lz4.frame as _lz4  # 可选依赖, 压缩率较低但速度最快
+except ImportError:
+    _lz4 = None
+
+
+class _Zlib:
+    name = 'zlib'
+    default_level = 1  # 块压缩在传输路径上, 优先速度
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class _Lzma:
+    name = 'lzma'
+    default_level = 1
+
+    def compress(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class _Zstd:
+    name = 'zstd'
+    default_level = 3
+
+    def compress(self, data, level):
+        return _zstd.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data):
+        return _zstd.ZstdDecompressor().decompress(data)
+
+
+class _Lz4:
+    name = 'lz4'
+    default_level = 0
+
+    def compress(self, data, level):
+        return _lz4.compress(data, compression_level=level)
+
+    def decompress(self, data):
+        return _lz4.decompress(data)
+
+
+CODECS = {'zlib': _Zlib(), 'lzma': _Lzma()}
+if _zstd is not None:
+    CODECS['zstd'] = _Zstd()
+if _lz4 is not None:
+    CODECS['lz4'] = _Lz4()
+
+# auto 模式使用最快的可用算法; 块记录了各自的算法, 不同客户端之间可以混用
+DEFAULT_CODEC = 'zstd' if _zstd is not None else 'lz4' if _lz4 is not None else 'zlib'
+AUTO = 'auto'
+
+
+def parse(codec):
+    """_summary_    解析 "算法[:级别]", 例如 "zlib:6"; auto 解析为默认算法
+
+    Returns:
+        tuple:  (算法, 级别)
+
+    Raises:
+        ValueError: 算法在本机不可用
+    """
+    name, _, level = (DEFAULT_CODEC if codec == AUTO else codec).partition(':')
+    if name not in CODECS:
+        raise ValueError(f"Compression codec {name} is not available")
+    return CODECS[name], int(level) if level else CODECS[name].default_level
+
+
+def is_compressible(data, sample_size=4096, samples=3, min_ratio=0.9):
+    """_summary_    用 zlib 快速压缩块头、块中间和块尾的几段样本, 判断块是否值得压缩
+
+    已经压缩过的数据 (图片、压缩包、加密数据) 样本几乎压不动, 跳过它们可以省下整块压缩的 CPU.
+
+    Returns:
+        bool:   样本能压缩到 min_ratio 以下
+    """
+    if len(data) <= sample_size * samples:
+        sample = data
+    else:
+        step = (len(data) - sample_size) // (samples - 1)
+        sample = b''.join(data[index * step:index * step + sample_size] for index in range(samples))
+    return len(zlib.compress(sample, 1)) < len(sample) * min_ratio
+
+
+def compress(data, codec, min_ratio=0.9):
+    """_summary_    压缩一个块
+
+    Args:
+        data (bytes):   块数据
+        codec (str):    "算法[:级别]", 或 auto (先抽样判断, 值得压缩时使用默认算法)
+        min_ratio (float, optional):    压缩后不小于原大小的这一比例时保存原始数据. Defaults to 0.9.
+
+    Returns:
+        tuple:  (保存的数据, 算法名), 未压缩时算法名为 None
+    """
+    if codec == AUTO and not is_compressible(data, min_ratio=min_ratio):
+        return data, None
+    algorithm, level = parse(codec)
+    compressed = algorithm.compress(data, level)
+    if len(compressed) >= len(data) * min_ratio:
+        return data, None
+    return compressed, algorithm.name
+
+
+def decompress(data, codec):
+    """_summary_    还原块数据, codec 为块元数据中记录的算法, None 表示未压缩
+    """
+    if codec is None:
+        return data
+    return parse(codec)[0].decompress(data)
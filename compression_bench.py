@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import compression
+
+
+def sample_data(kind, size, seed=0):
+    """_summary_    生成一个块的测试数据
+
+    Args:
+        kind (str): log (应用日志), csv (数值表格) 或 random (不可压缩, 相当于已压缩的媒体文件)
+        size (int): 字节数
+
+    Returns:
+        bytes:  测试数据
+    """
+    rng = random.Random(seed)
+    if kind == 'random':
+        return os.urandom(size)
+    lines, total = [], 0
+    while total < size:
+        if kind == 'log':
+            line = (f"2024-05-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:"
+                    f"{rng.randint(0, 59):02d}.{rng.randint(0, 999):03d} "
+                    f"{rng.choice(['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR'])} "
+                    f"{rng.choice(['storage_server', 'master_server', 'transfer', 'replication'])}: "
+                    f"{rng.choice(['Stored block', 'Retrieved block', 'Deleted block', 'Replicated block'])} "
+                    f"{rng.randint(0, 4096)} of file_{rng.randint(0, 100000)}.dat from localhost:"
+                    f"{rng.randint(5001, 5016)} in {rng.random() * 100:.3f} ms\n")
+        else:
+            line = (f"{rng.randint(0, 10**9)},{rng.choice(['beijing', 'shanghai', 'shenzhen', 'hangzhou'])},"
+                    f"{rng.random() * 1000:.2f},{rng.randint(0, 100)},{rng.choice(['true', 'false'])}\n")
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode('utf-8')[:size]
+
+
+def bench(kind, codec, block_size, rounds):
+    """_summary_    测量一种算法在一类数据上的压缩/解压吞吐量和节省的字节数
+
+    Returns:
+        dict:   吞吐量按原始数据计 (MB/s); stored_codec 为 None 表示块按原样保存 (auto 判断为不可压缩)
+    """
+    data = sample_data(kind, block_size)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        stored, stored_codec = compression.compress(data, codec)
+    compress_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        restored = compression.decompress(stored, stored_codec)
+    decompress_seconds = time.perf_counter() - start
+    assert restored == data
+
+    return {
+        "data": kind,
+        "codec": codec,
+        "stored_codec": stored_codec,
+        "block_size": block_size,
+        "ratio": len(data) / len(stored),
+        "saved_percent": 100 * (1 - len(stored) / len(data)),
+        "compress_mb_per_sec": len(data) * rounds / compress_seconds / 1e6,
+        "decompress_mb_per_sec": len(data) * rounds / decompress_seconds / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    available = [f"{name}:{level}" for name in compression.CODECS for level in
+                 ((1, 6) if name in ('zlib', 'lzma') else (compression.CODECS[name].default_level,))]
+    parser = argparse.ArgumentParser(description="块压缩算法的 CPU 开销与节省的字节数")
+    parser.add_argument('--codecs', default=','.join(available + [compression.AUTO]),
+                        help="逗号分隔的 \"算法[:级别]\" 或 auto")
+    parser.add_argument('--data', default='log,csv,random', help="逗号分隔的数据类型 log / csv / random")
+    parser.add_argument('--block-size', type=int, default=4*1024*1024, help="块大小(字节)")
+    parser.add_argument('--rounds', type=int, default=3, help="每种组合重复的次数")
+    args = parser.parse_args()
+
+    for kind in args.data.split(','):
+        for codec in args.codecs.split(','):
+            print(json.dumps(bench(kind, codec, args.block_size, args.rounds)))
@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+
+from protocol import ConnectionPool, Op, ProtocolError, block_name
+
+logger = logging.getLogger(__name__)
+CHUNK_PREFIX = '#chunk-'  # 内容寻址块在元数据中的 fileID 前缀, 后接 SHA-256
+
+
+def chunk_id(digest):
+    return CHUNK_PREFIX + digest
+
+
+def is_chunk(file_id):
+    return file_id.startswith(CHUNK_PREFIX)
+
+
+class ChunkIndex:
+    def __init__(self, master, gc_interval=600, gc_grace=3600):
+        """_summary_: 内容寻址块索引 (去重模式)
+
+        去重文件按内容哈希切分, 每个不同的块在元数据中记录为一个 fileID 为
+        "#chunk-<sha256>" 的单块记录, 带引用计数 refs; 文件本身只记录块哈希列表.
+        这样块的放置、损坏上报和副本修复都复用普通文件的机制.
+
+        上传前客户端把哈希列表发给 Master, 只上传缺失的块; 提交时每个引用它的
+        文件使 refs 加一, 删除文件时减一. 引用计数归零超过宽限期、且不属于进行中
+        上传的块由后台垃圾回收线程从存储服务器和元数据中删除.
+
+        Args:
+            master (MasterServer):  Master 服务器
+            gc_interval (int, optional):    垃圾回收的间隔(秒). Defaults to 600.
+            gc_grace (int, optional):   块无人引用多久后才回收(秒), 也是未提交上传的有效期. Defaults to 3600.
+        """
+        self.master = master
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        self.pool = ConnectionPool()
+        self.uploads = {}  # fileID -> (哈希集合, 开始时间), 进行中的上传, 其块不会被回收
+        self.lock = threading.Lock()  # 串行化引用计数的修改与垃圾回收
+
+    def start(self):
+        collector = threading.Thread(target=self._gc_loop)
+        collector.daemon = True
+        collector.start()
+
+    def allocate(self, filename, chunks, size=None, replication=None):
+        """_summary_    为去重文件的新块分配存储服务器, 返回需要上传的块
+
+        Args:
+            filename (str): 文件名
+            chunks (list):  文件的块 [{"hash", "size"}, ...], 按文件顺序
+            size (int, optional):   文件大小. Defaults to None.
+            replication (int, optional):    新块的副本数, 缺省使用集群配置. Defaults to None.
+
+        Returns:
+            dict:   {"fileID", "dedup", "missing": [{"hash", "fileID", "blockID", "primary", "replica"}, ...]}
+        """
+        placement = self.master.placement
+        replication = replication or placement.replication_factor
+        healthy_servers = self.master.healthy_servers()
+        sizes = {chunk["hash"]: chunk["size"] for chunk in chunks}
+
+        def create(file_id, record):
+            if record is not None:
+                return None  # 已有的块直接引用
+            servers = placement.place(healthy_servers, replication, sizes[file_id[len(CHUNK_PREFIX):]])
+            return {
+                "fileID": file_id,
+                "chunk": True,
+                "size": sizes[file_id[len(CHUNK_PREFIX):]],
+                "replication": replication,
+                "refs": 0,
+                "orphaned": time.time(),  # 提交前无人引用, 超过宽限期未提交即被回收
+                "blocks": [{
+                    "blockID": 0,
+                    "primary": self.master._parse_server_address(servers[0]),
+                    "replica": [self.master._parse_server_address(server) for server in servers[1:]]
+                }]
+            }
+
+        with self.lock:
+            self.uploads[filename] = (set(sizes), time.time())
+            self.master.metadata.update_many([chunk_id(digest) for digest in sizes], create)
+
+        # 没有校验和的块尚未上传成功 (可能是另一个并发上传刚分配的), 也需要上传;
+        # 内容相同, 重复写入同一位置是安全的
+        missing = []
+        for digest in sizes:
+            block = self.master.metadata.get(chunk_id(digest))["blocks"][0]
+            if "checksum" not in block:
+                missing.append(dict(block, hash=digest, fileID=chunk_id(digest)))
+        return {"fileID": filename, "dedup": True, "size": size, "missing": missing}
+
+    def commit(self, filename, chunks, checksums):
+        """_summary_    上传完成: 记录新块的校验和, 写入文件元数据并增加引用计数
+
+        Args:
+            filename (str): 文件名
+            chunks (list):  文件的块 [{"hash", "size"}, ...]
+            checksums (dict):   本次上传的块哈希 -> 校验和
+
+        Raises:
+            ValueError: 有块既不存在也没有被上传
+        """
+        def reference(file_id, record):
+            block = record["blocks"][0]
+            digest = file_id[len(CHUNK_PREFIX):]
+            if digest in checksums:
+                block = dict(block, checksum=checksums[digest])
+            return dict(record, refs=record["refs"] + 1, orphaned=None, blocks=[block])
+
+        digests = list(dict.fromkeys(chunk["hash"] for chunk in chunks))
+        with self.lock:
+            # 先检查所有块, 提交失败时不增加任何引用计数, 上传仍保持进行中, 客户端可以重试
+            for digest in digests:
+                record = self.master.metadata.get(chunk_id(digest))
+                if record is None or (digest not in checksums and "checksum" not in record["blocks"][0]):
+                    raise ValueError(f"Chunk {digest} of {filename} was not uploaded")
+            previous = self.master.metadata.get(filename)
+            self.master.metadata.update_many([chunk_id(digest) for digest in digests], reference)
+            self.master.metadata.put({
+                "fileID": filename,
+                "dedup": True,
+                "size": sum(chunk["size"] for chunk in chunks),
+                "chunks": chunks,
+                "blocks": []
+            })
+            if previous is not None and previous.get("dedup"):
+                self._release(previous)  # 覆盖旧版本
+            upload = self.uploads.pop(filename, None)
+        if upload is None:
+            logger.warning("Commit of %s without a pending upload", filename)
+
+    def release(self, file_info):
+        """_summary_    去重文件被删除或覆盖, 减少其所有块的引用计数
+        """
+        with self.lock:
+            self._release(file_info)
+
+    def _release(self, file_info):
+        def dereference(file_id, record):
+            if record is None:
+                return None
+            refs = max(record["refs"] - 1, 0)
+            return dict(record, refs=refs, orphaned=time.time() if refs == 0 else None)
+
+        digests = dict.fromkeys(chunk["hash"] for chunk in file_info["chunks"])
+        self.master.metadata.update_many([chunk_id(digest) for digest in digests], dereference)
+
+    def resolve(self, file_info):
+        """_summary_    把去重文件的哈希列表展开为可直接下载的块列表
+
+        Returns:
+            dict:   文件元数据, blocks 中每一项带 fileID(块名)/offset/size 和块的位置
+        """
+        blocks = []
+        offset = 0
+        for chunk in file_info["chunks"]:
+            record = self.master.metadata.get(chunk_id(chunk["hash"]))
+            if record is None:
+                raise ValueError(f"Chunk {chunk['hash']} of {file_info['fileID']} is missing")
+            blocks.append(dict(record["blocks"][0], fileID=record["fileID"], offset=offset, size=chunk["size"]))
+            offset += chunk["size"]
+        return dict(file_info, blocks=blocks)
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                logger.warning("Chunk garbage collection failed: %s", e)
+
+    def collect_garbage(self):
+        """_summary_    回收无人引用超过宽限期的块
+
+        Returns:
+            int:    回收的块数
+        """
+        now = time.time()
+        collected = []
+        with self.lock:
+            # 超时未提交的上传不再保护它的块
+            for filename, (_, started) in list(self.uploads.items()):
+                if now - started > self.gc_grace:
+                    del self.uploads[filename]
+            pending = set().union(*(digests for digests, _ in self.uploads.values()))
+
+            for file_id in self.master.metadata.file_ids():
+                if not is_chunk(file_id) or file_id[len(CHUNK_PREFIX):] in pending:
+                    continue
+                record = self.master.metadata.get(file_id)
+                if record["refs"] == 0 and record["orphaned"] and now - record["orphaned"] > self.gc_grace:
+                    self.master.metadata.delete(file_id)
+                    collected.append(record)
+
+        # 元数据已删除, 存储服务器上的删除失败只会留下孤立的块文件; 每台服务器一次批量删除
+        deletes = {}
+        for record in collected:
+            block = record["blocks"][0]
+            for server in [block["primary"]] + block["replica"]:
+                deletes.setdefault((server["host"], server["port"]), []).append(block_name(record["fileID"], 0))
+        for (host, port), names in deletes.items():
+            try:
+                self.pool.call((host, port), Op.DELETE_BLOCK, {"blocks": names})
+            except (OSError, ProtocolError) as e:
+                logger.warning("Failed to delete %s chunks from %s:%s. Error: %s", len(names), host, port, e)
+        if collected:
+            logger.info("Garbage collected %s unreferenced chunks", len(collected))
+        return len(collected)
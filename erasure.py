@@ -0,0 +1,145 @@
+try:
+    import numpy as np  # 可选依赖, 提供向量化的 GF(256) 运算
+except ImportError:
+    np = None
+
+
+# GF(2^8) 运算表, 本原多项式 x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError("GF(256) inverse of zero")
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+# MUL_ROWS[c] 是"乘以常数 c"的 256 字节查找表, 纯 Python 路径用 bytes.translate 逐字节查表
+MUL_ROWS = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+MUL_TABLE = np.frombuffer(b''.join(MUL_ROWS), dtype=np.uint8).reshape(256, 256) if np is not None else None
+
+
+def gf_invert_matrix(matrix):
+    """_summary_    GF(256) 上的高斯-约当消元求逆
+
+    Args:
+        matrix (list):  k x k 矩阵
+
+    Returns:
+        list:   逆矩阵
+    """
+    k = len(matrix)
+    rows = [list(row) + [1 if i == j else 0 for j in range(k)] for i, row in enumerate(matrix)]
+    for col in range(k):
+        pivot = next((r for r in range(col, k) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Singular matrix")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, x) for x in rows[col]]
+        for r in range(k):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gf_mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[k:] for row in rows]
+
+
+class ReedSolomon:
+    def __init__(self, k, m):
+        """_summary_: 系统 Reed-Solomon 纠删码 (k 个数据分片 + m 个校验分片)
+
+        编码矩阵为单位阵叠加 Cauchy 矩阵, 其任意 k 行构成的方阵都可逆,
+        因此 n = k + m 个分片中任意 k 个即可恢复数据.
+
+        Args:
+            k (int):    数据分片数
+            m (int):    校验分片数
+        """
+        if k < 1 or m < 0 or k + m > 256:
+            raise ValueError(f"Invalid erasure code {k}+{m}")
+        self.k = k
+        self.m = m
+        self.n = k + m
+        # Cauchy 矩阵: C[i][j] = 1 / (x_i + y_j), x_i = k + i, y_j = j, 两组元素互不相同
+        self.parity_matrix = [[gf_inv((self.k + i) ^ j) for j in range(k)] for i in range(m)]
+        self.matrix = [[1 if i == j else 0 for j in range(k)] for i in range(k)] + self.parity_matrix
+
+    @classmethod
+    def parse(cls, scheme):
+        """_summary_    解析 "4+2" 形式的方案字符串
+        """
+        k, m = str(scheme).split('+')
+        return cls(int(k), int(m))
+
+    def _combine(self, coefficients, shards, length):
+        """_summary_    计算 sum(coefficients[j] * shards[j]), 加法为异或
+        """
+        if np is not None:
+            acc = np.zeros(length, dtype=np.uint8)
+            for c, shard in zip(coefficients, shards):
+                if c == 0:
+                    continue
+                data = np.frombuffer(shard, dtype=np.uint8)
+                if c == 1:
+                    acc ^= data
+                else:
+                    acc ^= MUL_TABLE[c][data]
+            return acc.tobytes()
+
+        acc = 0
+        for c, shard in zip(coefficients, shards):
+            if c == 0:
+                continue
+            product = bytes(shard) if c == 1 else bytes(shard).translate(MUL_ROWS[c])
+            acc ^= int.from_bytes(product, 'little')
+        return acc.to_bytes(length, 'little')
+
+    def encode(self, data_shards):
+        """_summary_    由 k 个等长数据分片计算 m 个校验分片
+
+        Args:
+            data_shards (list): k 个等长的 bytes-like
+
+        Returns:
+            list:   m 个校验分片
+        """
+        length = len(data_shards[0])
+        return [self._combine(row, data_shards, length) for row in self.parity_matrix]
+
+    def decode(self, shards):
+        """_summary_    由任意 k 个分片恢复全部数据分片
+
+        Args:
+            shards (dict):  分片序号(0..n-1) -> 分片数据, 至少 k 个
+
+        Returns:
+            list:   k 个数据分片
+        """
+        if len(shards) < self.k:
+            raise ValueError(f"Need {self.k} shards to decode, got {len(shards)}")
+        # 优先使用数据分片, 它们对应单位阵的行, 不需要计算
+        indexes = sorted(shards)[:self.k]
+        if indexes == list(range(self.k)):
+            return [shards[i] for i in indexes]
+
+        length = len(shards[indexes[0]])
+        inverse = gf_invert_matrix([self.matrix[i] for i in indexes])
+        available = [shards[i] for i in indexes]
+        return [shards[j] if j in shards else self._combine(inverse[j], available, length)
+                for j in range(self.k)]
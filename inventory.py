@@ -0,0 +1,337 @@
+import hashlib
+import logging
+import threading
+import time
+import zlib
+
+from dedup import is_chunk
+from packing import is_container
+from protocol import ConnectionPool, Op, block_name
+
+logger = logging.getLogger(__name__)
+
+
+def name_hash(name):
+    # 64 位的块名哈希, 块清单的摘要是所有块名哈希的异或, 与顺序无关, 可以逐个增减
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def digest(names):
+    """_summary_    块名集合的摘要
+
+    Returns:
+        tuple:  (块数, 摘要)
+    """
+    value = 0
+    for name in names:
+        value ^= name_hash(name)
+    return len(names), value
+
+
+def encode_names(names):
+    """_summary_    把块名集合编码为报告的数据部分
+
+    块名排序后相邻的名字共享很长的前缀 (同一文件的块只有块ID不同),
+    zlib 把它们压缩为对前一个名字的回引用, 效果接近逐个记录与前一个名字的差异,
+    百万个块的清单只有几 MB.
+
+    Returns:
+        bytes:  编码后的数据
+    """
+    if not names:
+        return b''
+    return zlib.compress('\0'.join(sorted(names)).encode('utf-8'))  # 文件名中不会出现 \0
+
+
+def decode_names(data):
+    if not data:
+        return []
+    return zlib.decompress(data).decode('utf-8').split('\0')
+
+
+def split_block_name(name):
+    """_summary_    块名 -> (fileID, 块ID), 不是块名时返回 None
+    """
+    file_id, _, block_id = name.rpartition('_block_')
+    if not file_id or not block_id.isdigit():
+        return None
+    return file_id, int(block_id)
+
+
+class BlockInventory:
+    def __init__(self, shards):
+        """_summary_: 存储服务器上的块清单 (按 Master 分片划分)
+
+        不在内存中保存块名, 只为每个分片维护块数、摘要和自上次报告以来新增/删除的块,
+        写入和删除块时逐个更新. 全量报告时重新扫描目录, 以扫描结果为准.
+
+        Args:
+            shards (ShardMap):  Master 分片表
+        """
+        self.shards = shards
+        self.digests = {address: (0, 0) for address in shards}  # 分片地址 -> (块数, 摘要)
+        self.added = {address: set() for address in shards}
+        self.removed = {address: set() for address in shards}
+        self.scanning = None  # 全量扫描期间发生的变更 [(块名, 是否存在), ...]
+        self.lock = threading.Lock()
+
+    def owners(self, name):
+        parsed = split_block_name(name)
+        file_id = parsed[0] if parsed else name
+        # 去重块和容器属于创建它的分片, 无法由块名确定, 报告给所有分片
+        if is_chunk(file_id) or is_container(file_id):
+            return list(self.shards)
+        return [self.shards.shard_for(file_id)]
+
+    def add(self, name):
+        self._change(name, True)
+
+    def discard(self, name):
+        self._change(name, False)
+
+    def _change(self, name, present):
+        value = name_hash(name)
+        with self.lock:
+            if self.scanning is not None:
+                self.scanning.append((name, present))
+            for address in self.owners(name):
+                count, current = self.digests[address]
+                self.digests[address] = (count + (1 if present else -1), current ^ value)
+                # 上次报告之后新增又删除(或反之)的块互相抵消
+                appeared, vanished = ((self.added, self.removed) if present else (self.removed, self.added))
+                if name in vanished[address]:
+                    vanished[address].discard(name)
+                else:
+                    appeared[address].add(name)
+
+    def scan(self, names):
+        """_summary_    以目录扫描结果重建清单, 清空所有分片的增量
+
+        扫描期间并发的写入和删除会被记录下来, 扫描结束后补到结果中.
+
+        Args:
+            names (callable):   返回目录中所有块名的函数
+
+        Returns:
+            tuple:  (扫描开始时间, 分片地址 -> (块名集合, 块数, 摘要)); 之后的变更进入下一次增量
+        """
+        with self.lock:
+            self.scanning = []
+        started = time.time()
+        try:
+            current = set(names())
+        except BaseException:
+            with self.lock:
+                self.scanning = None
+            raise
+        hashes = {name: name_hash(name) for name in current}
+        with self.lock:
+            for name, present in self.scanning:
+                if present:
+                    current.add(name)
+                    hashes[name] = name_hash(name)
+                else:
+                    current.discard(name)
+            self.scanning = None
+            partitions = {address: set() for address in self.shards}
+            digests = {address: 0 for address in self.shards}
+            for name in current:
+                for address in self.owners(name):
+                    partitions[address].add(name)
+                    digests[address] ^= hashes[name]
+            for address in self.shards:
+                self.digests[address] = (len(partitions[address]), digests[address])
+                self.added[address] = set()
+                self.removed[address] = set()
+        return started, {address: (partitions[address], len(partitions[address]), digests[address])
+                         for address in self.shards}
+
+    def take(self, address):
+        """_summary_    取出一个分片自上次报告以来的增量
+
+        Returns:
+            tuple:  (新增的块, 删除的块, 块数, 摘要)
+        """
+        with self.lock:
+            added, removed = self.added[address], self.removed[address]
+            self.added[address], self.removed[address] = set(), set()
+            count, value = self.digests[address]
+        return added, removed, count, value
+
+    def restore(self, address, added, removed):
+        """_summary_    报告发送失败, 把取出的增量放回去, 下次一并报告
+        """
+        with self.lock:
+            for name in added:
+                if name in self.removed[address]:
+                    self.removed[address].discard(name)
+                else:
+                    self.added[address].add(name)
+            for name in removed:
+                if name in self.added[address]:
+                    self.added[address].discard(name)
+                else:
+                    self.removed[address].add(name)
+
+
+class InventoryReconciler:
+    def __init__(self, master, grace=3600):
+        """_summary_: Master 端的块清单核对
+
+        存储服务器定期报告块清单的增量, 附带块数和摘要; Master 用增量更新上一次的摘要,
+        与报告中的摘要不符 (Master 重启或报告丢失) 时要求对方发送全量报告.
+
+        报告中的块与元数据核对后:
+        - 元数据中不存在的块 (删除/上传中途失败、覆盖后旧版本留下的块) 是孤立块,
+          超过宽限期仍孤立时从存储服务器上删除. 宽限期覆盖了副本修复先复制块、
+          后更新元数据之类的时间差; 删除时带上首次发现的时间, 之后被重新写入的块不会被删除.
+        - 元数据认为存在、已经提交但服务器上没有的块是丢失的副本, 在下一次报告中
+          仍然缺失时与损坏的副本一样交给副本修复.
+
+        Args:
+            master (MasterServer):  Master 服务器
+            grace (int, optional):  块孤立多久后才删除(秒). Defaults to 3600.
+        """
+        self.master = master
+        self.grace = grace
+        self.pool = ConnectionPool(timeout=60)
+        self.known = {}  # "host:port" -> (块数, 摘要), 来自上一次报告
+        self.suspects = {}  # "host:port" -> {块名: ("orphan" | "missing", 首次发现时存储服务器上的时间)}
+        self.lock = threading.Lock()
+        self.orphans_deleted = master.registry.counter('dfs_orphan_blocks_deleted_total',
+                                                       "Orphan blocks deleted from storage servers")
+        self.missing_found = master.registry.counter('dfs_missing_blocks_total',
+                                                     "Committed replicas missing from storage servers' block reports")
+        master.registry.gauge('dfs_inventory_suspects', "Blocks waiting to be confirmed as orphaned or missing",
+                              function=lambda: sum(len(suspects) for suspects in self.suspects.values()))
+
+    def _owns(self, file_id):
+        # 有多个分片时, 不在本分片元数据中的去重块和容器可能属于其他分片
+        if is_chunk(file_id) or is_container(file_id):
+            return len(self.master.shards) == 1
+        return self.master.shards.owns(self.master.server_address, file_id)
+
+    def _expected(self, server, name):
+        """_summary_    元数据是否认为块存放在该服务器上
+
+        Returns:
+            tuple:  (块信息, 文件元数据), 不在该服务器上时为 (None, 文件元数据)
+        """
+        parsed = split_block_name(name)
+        if parsed is None:
+            return None, None
+        file_id, block_id = parsed
+        file_info = self.master.metadata.get(file_id)
+        if file_info is None or block_id >= len(file_info["blocks"]):
+            return None, file_info
+        block = file_info["blocks"][block_id]
+        if server not in [f"{location['host']}:{location['port']}"
+                          for location in [block["primary"]] + block["replica"]]:
+            return None, file_info
+        return block, file_info
+
+    def _committed(self, block, file_info):
+        # 上传中的块还没有写到服务器上; 容器块没有整块校验和, 有文件提交后才算写入
+        return "checksum" in block or (file_info.get("container") and file_info.get("size", 0) > 0)
+
+    def _is_orphan(self, server, name):
+        parsed = split_block_name(name)
+        if parsed is None or not self._owns(parsed[0]):
+            return False
+        return self._expected(server, name)[0] is None
+
+    def _is_missing(self, server, name):
+        block, file_info = self._expected(server, name)
+        return block is not None and self._committed(block, file_info)
+
+    def report(self, meta, data):
+        """_summary_    处理一台存储服务器的块报告
+
+        Args:
+            meta (dict):    {"host", "port", "full", "count", "digest", "time", "added_length"}
+            data (bytes):   全量报告为 encode_names(所有块); 增量报告为新增块和删除块的编码首尾相接
+
+        Returns:
+            dict:   需要全量报告时为 {"full": True}
+        """
+        server = f"{meta['host']}:{meta['port']}"
+        reported = (meta["count"], int(meta["digest"], 16))
+        if meta.get("full"):
+            names = decode_names(data)
+            if digest(names) != reported:
+                raise ValueError(f"Block report from {server} does not match its digest")
+            self.known[server] = reported
+            present, absent = set(names), ()
+            expected = {block_name(file_id, block_id) for file_id, block_id in self.master.metadata.blocks_on(server)}
+            orphans = [name for name in present - expected
+                       if split_block_name(name) is not None and self._owns(split_block_name(name)[0])]
+            missing = [name for name in expected - present if self._is_missing(server, name)]
+        else:
+            split = meta["added_length"]
+            present, absent = set(decode_names(data[:split])), set(decode_names(data[split:]))
+            known = self.known.pop(server, None)
+            if known is None:
+                return {"full": True}
+            count, value = known
+            for name in present:
+                count, value = count + 1, value ^ name_hash(name)
+            for name in absent:
+                count, value = count - 1, value ^ name_hash(name)
+            if (count, value) != reported:
+                logger.info("Block report from %s is out of sync, requesting a full report", server)
+                return {"full": True}
+            self.known[server] = reported
+            orphans = [name for name in present if self._is_orphan(server, name)]
+            missing = [name for name in absent if self._is_missing(server, name)]
+
+        with self.lock:
+            suspects = self.suspects.get(server, {})
+            if meta.get("full"):
+                # 全量报告中已不成立的怀疑都作废
+                findings = set(orphans) | set(missing)
+                suspects = {name: suspect for name, suspect in suspects.items() if name in findings}
+            else:
+                suspects = {name: (kind, first) for name, (kind, first) in suspects.items()
+                            if not (kind == "missing" and name in present) and not (kind == "orphan" and name in absent)}
+            due_orphans, due_missing, before = [], [], 0
+            for name, (kind, first) in list(suspects.items()):
+                if kind == "orphan" and meta["time"] - first >= self.grace:
+                    due_orphans.append(name)
+                    before = max(before, first)
+                    del suspects[name]
+                elif kind == "missing":
+                    due_missing.append(name)
+                    del suspects[name]
+            for name in orphans:
+                suspects.setdefault(name, ("orphan", meta["time"]))
+            for name in missing:
+                if name not in due_missing:
+                    suspects.setdefault(name, ("missing", meta["time"]))
+            self.suspects[server] = suspects
+
+        self._delete_orphans(server, [name for name in due_orphans if self._is_orphan(server, name)], before)
+        self._repair_missing(server, [name for name in due_missing if self._is_missing(server, name)])
+        return {}
+
+    def _delete_orphans(self, server, names, before):
+        """_summary_    批量删除一台服务器上的孤立块, 只删除 before 之后没有被重新写入的块
+        """
+        if not names:
+            return
+        host, port = server.rsplit(':', 1)
+        try:
+            response, _ = self.pool.call((host, int(port)), Op.DELETE_BLOCK, {"blocks": names, "before": before})
+        except Exception as e:
+            logger.warning("Failed to delete %s orphan blocks from %s: %s", len(names), server, e)
+            return
+        self.orphans_deleted.inc(response["deleted"])
+        logger.info("Deleted %s orphan blocks from %s", response["deleted"], server)
+
+    def _repair_missing(self, server, names):
+        for name in names:
+            file_id, block_id = split_block_name(name)
+            logger.warning("Server %s lost block %s of %s", server, block_id, file_id)
+            self.missing_found.inc()
+            # 与损坏的副本一样不再算作有效副本, 由副本修复补足
+            self.master.corrupt_replicas.setdefault((file_id, block_id), set()).add(server)
+            self.master.replicator.schedule(file_id, block_id)
@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import time
+
+from protocol import HEADER, MAGIC, Op
+
+
+def run_master(config_file, metadata_file, host, port):
+    from master_server import MasterServer
+    master = MasterServer(host, port, config_file=config_file, metadata_file=metadata_file)
+    master.metadata.put({"fileID": "loadtest.bin", "blocks": []})
+    master.start()
+
+
+def wait_for_port(address, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Server {address} did not start")
+
+
+async def client_loop(address, deadline, latencies, errors):
+    """_summary_    一个长连接上循环发送 RETRIEVE 请求, 记录每个请求的延迟
+    """
+    try:
+        reader, writer = await asyncio.open_connection(*address)
+    except OSError:
+        errors.append(1)
+        return
+    meta = json.dumps({"fileID": "loadtest.bin"}).encode('utf-8')
+    request_id = 0
+    try:
+        while time.perf_counter() < deadline:
+            request_id += 1
+            start = time.perf_counter()
+            writer.write(HEADER.pack(MAGIC, Op.RETRIEVE, 0, request_id, len(meta), 0) + meta)
+            header = await reader.readexactly(HEADER.size)
+            _, opcode, _, _, meta_len, data_len = HEADER.unpack(header)
+            await reader.readexactly(meta_len + data_len)
+            latencies.append(time.perf_counter() - start)
+            if opcode != Op.OK:
+                errors.append(1)
+    except (OSError, asyncio.IncompleteReadError, struct.error):
+        errors.append(1)
+    finally:
+        writer.close()
+
+
+async def run_clients(address, connections, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client_loop(address, deadline, latencies, errors) for _ in range(connections)))
+    return latencies, errors
+
+
+def load_test(mode, connections, duration, port):
+    """_summary_    以指定模式启动 Master, 用 connections 个并发长连接压测
+
+    Returns:
+        dict:   吞吐量和延迟统计
+    """
+    workdir = tempfile.mkdtemp(prefix='dfs-loadtest-')
+    config_file = os.path.join(workdir, 'servers.conf')
+    with open(config_file, 'w') as f:
+        f.write(f"[master]\nserver = localhost:{port}\n\n"
+                "[servers]\nserver1 = localhost:1\n\n"
+                f"[runtime]\nmode = {mode}\nbacklog = 4096\nmax_connections = 65536\n")
+
+    server = multiprocessing.Process(
+        target=run_master, args=(config_file, os.path.join(workdir, 'metadata.json'), 'localhost', port))
+    server.daemon = True
+    server.start()
+    try:
+        wait_for_port(('localhost', port))
+        latencies, errors = asyncio.run(run_clients(('localhost', port), connections, duration))
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else None
+
+    return {
+        "mode": mode,
+        "connections": connections,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_sec": len(latencies) / duration,
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Master 服务器线程模式与 asyncio 模式压测")
+    parser.add_argument('--connections', type=int, default=1000, help="并发长连接数")
+    parser.add_argument('--duration', type=float, default=10, help="每种模式的压测时长(秒)")
+    parser.add_argument('--port', type=int, default=5100, help="压测 Master 使用的端口")
+    parser.add_argument('--modes', default='threaded,asyncio', help="逗号分隔的服务器模式")
+    args = parser.parse_args()
+
+    for i, mode in enumerate(args.modes.split(',')):
+        result = load_test(mode, args.connections, args.duration, args.port + i)
+        print(json.dumps(result))
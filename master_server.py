@@ -1,10 +1,24 @@
-import socket
+import logging
+import multiprocessing
 import threading
 import time
 import configparser
-import random
 import json
-import os
+
+import metrics
+import protocol
+from dedup import CHUNK_PREFIX, ChunkIndex, is_chunk
+from inventory import InventoryReconciler
+from metadata_store import MetadataStore
+from namespace import prefix_end
+from packing import PACK_PREFIX, PackIndex, is_container
+from protocol import DEFAULT_BLOCK_SIZE, Op, Response, nonblocking
+from placement import PlacementEngine
+from replication import ReplicationScheduler
+from server_runtime import RuntimeOptions, configure_logging, serve
+from sharding import ShardMap
+
+logger = logging.getLogger(__name__)
 
 
 class MasterServer:
@@ -16,141 +30,523 @@ class MasterServer:
             port (int, optional):   主服务器端口. Defaults to 5000.
         """
         self.server_address = (host, port)  # Master服务器地址
+        self.shards = ShardMap.from_config(config_file)  # 命名空间分片, 本服务器只负责其中一片
         self.servers = self.load_servers(config_file)
+        self.placement = self.load_placement(config_file)  # 副本数和负载/容量感知的放置
+        self.runtime = RuntimeOptions.from_config(config_file)  # 线程/asyncio 模式及连接限制
+        self.telemetry = metrics.MetricsOptions.from_config(config_file)  # /metrics 端口和跟踪日志
+        self.registry = metrics.Registry({"role": "master", "server": f"{host}:{port}"})
 
         self.metadata_file = metadata_file
-        self.metadata = self.metadata = self.load_metadata()
+        self.metadata = self.load_metadata(config_file, metadata_file)  # fileID 索引 + 预写日志
 
         self.heartbeat_timeout = 10  # 心跳检查间隔
         self.server_status = {server: True for server in self.servers}  # 健康状态
         self.last_heartbeat = {server: time.time() for server in self.servers}
+        self.corrupt_replicas = {}  # (fileID, blockID) -> 副本损坏或丢失的服务器集合
+        self.replicator = self.load_replicator(config_file)  # 宕机/损坏后的副本修复
+        self.chunks = self.load_chunk_index(config_file)  # 去重块的引用计数和垃圾回收
+        self.packs = self.load_pack_index(config_file)  # 小文件打包的容器和压缩
+
+        tracer = metrics.Tracer(self.telemetry.trace_file, {"server": f"{host}:{port}"})
+        self.handlers = metrics.instrument({
+            Op.STORE: self._handle_store,
+            Op.RETRIEVE: self._handle_retrieve,
+            Op.DELETE: self._handle_delete,
+            Op.GET_FILE_NAMESPACE: self._handle_get_file_namespace,
+            Op.GET_STORAGE_SERVERS_STATUS: self._handle_get_storage_servers_status,
+            Op.HEARTBEAT: self._handle_heartbeat,
+            Op.COMMIT: self._handle_commit,
+            Op.REPORT_CORRUPT: self._handle_report_corrupt,
+            Op.STORE_MANY: self._handle_store_many,
+            Op.DELETE_MANY: self._handle_delete_many,
+            Op.BLOCK_REPORT: self._handle_block_report,
+        }, self.registry, tracer)
+        self.registry.gauge('dfs_files', "Files and internal records in this shard's metadata",
+                            function=lambda: len(self.metadata))
+        self.registry.gauge('dfs_storage_servers_up', "Storage servers considered healthy",
+                            function=lambda: sum(self.server_status.values()))
+        self.inventory = self.load_inventory(config_file)  # 存储服务器块报告的核对, 回收孤立块
 
     def _parse_server_address(self, server):
         host, port = server.split(':')
         return {"host": host, "port": int(port)}
 
+    def load_metadata(self, config_file, metadata_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config['metadata'] if config.has_section('metadata') else {}
+        return MetadataStore(metadata_file, compact_threshold=int(section.get('compact_threshold', 100000)),
+                             snapshot_interval=float(section.get('snapshot_interval', 3600)), registry=self.registry)
+
     def load_servers(self, config_file):
         config = configparser.ConfigParser()
         config.read(config_file)
         return [address for address in config['servers'].values()]
 
-    def load_metadata(self):
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r') as f:
-                return json.load(f)
-        else:
-            return {"fileMetadata": []}
+    def load_placement(self, config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        # [domains] 与 [paths] 一样按服务器名配置故障域, 例如 server1 = rack1
+        domains = {}
+        if config.has_section('domains'):
+            for server_name, domain in config['domains'].items():
+                if server_name in config['servers']:
+                    domains[config['servers'][server_name]] = domain
+        section = config['placement'] if config.has_section('placement') else {}
+        return PlacementEngine(domains, int(section.get('replication_factor', 2)),
+                               min_block_size=int(section.get('min_block_size', 1024*1024)),
+                               max_block_size=int(section.get('max_block_size', 128*1024*1024)),
+                               blocks_per_server=int(section.get('blocks_per_server', 4)))
+
+    def load_replicator(self, config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config['replication'] if config.has_section('replication') else {}
+        return ReplicationScheduler(self, workers=int(section.get('workers', 4)),
+                                    bytes_per_sec=int(section.get('bytes_per_sec', 32*1024*1024)))
+
+    def load_chunk_index(self, config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config['dedup'] if config.has_section('dedup') else {}
+        return ChunkIndex(self, gc_interval=int(section.get('gc_interval', 600)),
+                          gc_grace=int(section.get('gc_grace', 3600)))
+
+    def load_pack_index(self, config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config['packing'] if config.has_section('packing') else {}
+        return PackIndex(self, container_size=int(section.get('container_size', 8*1024*1024)),
+                         max_file_size=int(section.get('max_file_size', 64*1024)),
+                         compact_interval=int(section.get('compact_interval', 600)),
+                         compact_ratio=float(section.get('compact_ratio', 0.5)),
+                         grace=int(section.get('grace', 3600)))
+
+    def load_inventory(self, config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        section = config['inventory'] if config.has_section('inventory') else {}
+        return InventoryReconciler(self, grace=int(section.get('grace', 3600)))
+
+    def is_healthy(self, location):
+        return self.server_status.get(f"{location['host']}:{location['port']}", False)
 
-    def save_metadata(self):
-        with open(self.metadata_file, 'w') as f:
-            json.dump(self.metadata, f, indent=4)
+    def healthy_servers(self):
+        return [server for server in self.servers if self.server_status[server]]
 
     def heartbeat_check(self):
         """_summary_    心跳检查
         """
         while True:
             current_time = time.time()
-            for server, last_time in self.last_heartbeat.items():
-                if current_time - last_time > self.heartbeat_timeout:
+            for server, last_time in list(self.last_heartbeat.items()):
+                if current_time - last_time > self.heartbeat_timeout and self.server_status[server]:
                     self.server_status[server] = False
-                    print(f"Server {server} is down.")
+                    logger.warning("Server %s is down.", server)
+                    self.replicator.server_down(server)  # 为其上的块补足副本
             time.sleep(self.heartbeat_timeout)
 
+    def allocate_file(self, filename, num_blocks=None, size=None, replication=None, erasure=None, block_size=None,
+                      max_block_size=None):
+        """_summary_    为文件的每个块分配主服务器和副本服务器, 并记录元数据
+
+        普通文件的块大小记录在元数据的 block_size 中: 客户端指定时使用指定值(不超过集群上限),
+        只给出块数时(旧客户端)为 1MiB, 否则按文件大小和集群规模自适应.
+
+        Args:
+            filename (str): 文件名
+            num_blocks (int, optional): 块数, 缺省由文件大小和块大小算出; 纠删码模式下为分片总数 (条带数 x (k+m)).
+                Defaults to None.
+            size (int, optional):   文件大小(字节). Defaults to None.
+            replication (int, optional):    副本数(含主副本), 缺省使用集群配置. Defaults to None.
+            erasure (dict, optional):   纠删码参数 {"k", "m", "fragment_size"}, 指定时不做副本. Defaults to None.
+            block_size (int, optional): 客户端指定的块大小. Defaults to None.
+            max_block_size (int, optional): 自适应块大小的上限(客户端的内存限制). Defaults to None.
+
+        Returns:
+            dict:   文件元数据
+        """
+        request = {"fileID": filename, "num_blocks": num_blocks, "size": size, "replication": replication,
+                   "erasure": erasure, "block_size": block_size, "max_block_size": max_block_size}
+        previous = self.metadata.get(filename)
+        file_info = self._layout(request, self.healthy_servers())
+        self.metadata.put(file_info)  # 追加到预写日志
+        self._replaced(previous)
+        return file_info
+
+    def allocate_files(self, requests):
+        """_summary_    批量分配多个文件, 所有元数据只等待一次落盘
+
+        Args:
+            requests (list):    [{"fileID", "size", "replication", ...}, ...], 参数同 allocate_file
+
+        Returns:
+            list:   与 requests 顺序一致的文件元数据
+        """
+        healthy_servers = self.healthy_servers()
+        layouts = {request["fileID"]: self._layout(request, healthy_servers) for request in requests}
+        previous = []
+
+        def replace(file_id, current):
+            previous.append(current)
+            return layouts[file_id]
+
+        allocated = self.metadata.update_many(list(layouts), replace)
+        for file_info in previous:
+            self._replaced(file_info)
+        return [allocated[request["fileID"]] for request in requests]
+
+    def _layout(self, request, healthy_servers):
+        """_summary_    计算文件的块布局 (不写入元数据)
+        """
+        size, erasure = request.get("size"), request.get("erasure")
+        num_blocks = request.get("num_blocks")
+        num_blocks = int(num_blocks) if num_blocks is not None else None
+        file_info = {
+            "fileID": request["fileID"],
+            "blocks": []
+        }
+        if size is not None:
+            file_info["size"] = size
+
+        if erasure:
+            # 每个条带的 k+m 个分片放在互不相同的服务器上, 分片本身不再复制
+            file_info["erasure"] = erasure
+            file_info["replication"] = 1
+            width = erasure["k"] + erasure["m"]
+            for stripe in range(num_blocks // width):
+                servers = self.placement.place(healthy_servers, width, erasure["fragment_size"])
+                if len(servers) < width:
+                    raise RuntimeError(f"Erasure code {erasure['k']}+{erasure['m']} needs {width} healthy "
+                                       f"storage servers, only {len(healthy_servers)} available")
+                for index, server in enumerate(servers):
+                    file_info["blocks"].append({
+                        "blockID": stripe * width + index,
+                        "primary": self._parse_server_address(server),
+                        "replica": []
+                    })
+            return file_info
+
+        replication = request.get("replication") or self.placement.replication_factor
+        file_info["replication"] = replication
+        if request.get("block_size") is not None:
+            if int(request["block_size"]) <= 0:
+                raise ValueError(f"Invalid block size {request['block_size']}")
+            block_size = min(int(request["block_size"]), self.placement.max_block_size)
+        elif num_blocks is not None:
+            block_size = DEFAULT_BLOCK_SIZE  # 旧客户端按 1MiB 切分后只上报块数
+        else:
+            block_size = self.placement.block_size(size or 0, len(healthy_servers), request.get("max_block_size"))
+        if num_blocks is None:
+            num_blocks = -(-size // block_size) if size else 0
+        file_info["block_size"] = block_size
+        for block_id in range(num_blocks):
+            # 按剩余空间/负载加权, 副本分散到不同故障域; 健康服务器不足时减少副本
+            servers = self.placement.place(healthy_servers, replication, min(block_size, size or block_size))
+            block_info = {
+                "blockID": block_id,
+                "primary": self._parse_server_address(servers[0]),
+                "replica": [self._parse_server_address(server) for server in servers[1:]]
+            }
+            file_info["blocks"].append(block_info)
+        return file_info
+
+    def _replaced(self, file_info):
+        # 被覆盖或删除的去重文件不再引用它的块, 打包的文件不再占用容器空间
+        if file_info is not None and file_info.get("dedup"):
+            self.chunks.release(file_info)
+        elif file_info is not None and file_info.get("packed"):
+            self.packs.release(file_info)
+
+    def file_ids(self):
+        # 命名空间中不包含内容寻址块和容器的内部记录
+        return [file_id for file_id in self.metadata.file_ids() if not is_chunk(file_id) and not is_container(file_id)]
+
+    def list_files(self, prefix=None, start=None, end=None, after=None, limit=1000):
+        """_summary_    按文件名顺序列出一页文件, 附带大小和块数
+
+        Args:
+            prefix (str, optional): 只列出以它开头的文件. Defaults to None.
+            start (str, optional):  起始文件名(含). Defaults to None.
+            end (str, optional):    结束文件名(不含). Defaults to None.
+            after (str, optional):  游标, 上一页的最后一个文件名. Defaults to None.
+            limit (int, optional):  每页的文件数. Defaults to 1000.
+
+        Returns:
+            tuple:  ([{"fileID", "size", "blocks"}, ...], 下一页的游标, 没有下一页时为 None)
+        """
+        # 空字符串表示没有下界, None 表示没有上界
+        low = max(start or '', prefix or '')
+        high = min([bound for bound in (end, prefix_end(prefix or '')) if bound is not None], default=None)
+        # 内容寻址块和容器的记录各自集中在以其前缀开头的一段, 分段查询以跳过它们
+        ranges, cursor = [], low
+        for internal in sorted((CHUNK_PREFIX, PACK_PREFIX)):
+            ranges.append((cursor, internal if high is None else min(high, internal)))
+            cursor = max(cursor, prefix_end(internal))
+        ranges.append((cursor, high))
+        names = []  # 多取一个, 以判断是否还有下一页
+        for range_start, range_stop in ranges:
+            if len(names) > limit or (range_stop is not None and range_start >= range_stop):
+                continue
+            names += self.metadata.scan(range_start or None, range_stop, after, limit + 1 - len(names))
+
+        entries = []
+        for file_id in names[:limit]:
+            file_info = self.metadata.get(file_id)
+            if file_info is None:
+                continue  # 扫描后被删除
+            entries.append({"fileID": file_id, "size": file_info.get("size"),
+                            "blocks": len(file_info["chunks"] if file_info.get("dedup") else file_info["blocks"])})
+        return entries, names[limit - 1] if len(names) > limit else None
+
+    def record_heartbeat(self, host, port, stats=None):
+        server_address = f"{host}:{port}"
+        self.server_status[server_address] = True
+        self.last_heartbeat[server_address] = time.time()
+        if stats:
+            self.placement.update_stats(server_address, stats)  # 剩余空间和在途 I/O
+
     def handle_client(self, client_socket):
-        """_summary_    处理客户端请求
+        """_summary_    处理客户端连接, 二进制帧走长连接, 旧的文本命令走兼容层
+
+        Args:
+            client_socket (_type_): 客户端套接字
+        """
+        try:
+            if protocol.is_framed(client_socket):
+                protocol.serve_connection(client_socket, self.handlers)
+            else:
+                self.handle_legacy(client_socket)
+        except (OSError, protocol.ProtocolError) as e:
+            logger.warning("Connection error: %s", e)
+        finally:
+            client_socket.close()
+
+    def _store_error(self, file_id):
+        # 客户端不能在本分片创建该文件时返回错误信息:
+        # 去重块和打包容器的内部记录与文件共用键空间, 客户端写入这些前缀会覆盖引用计数或容器记录;
+        # 不属于本分片的文件在这里创建后, 其他分片永远不会路由到
+        if is_chunk(file_id) or is_container(file_id):
+            return f"File name {file_id} uses a reserved prefix"
+        if self.shards.owns(self.server_address, file_id):
+            return None
+        host, port = self.shards.shard_for(file_id)
+        return f"File {file_id} belongs to master shard {host}:{port}"
+
+    def _handle_store(self, meta, payload):
+        error = self._store_error(meta["fileID"])
+        if error:
+            return Response.error(error)
+        if meta.get("dedup"):
+            return Response(self.chunks.allocate(meta["fileID"], meta["chunks"], meta.get("size"),
+                                                 meta.get("replication")))
+        if meta.get("pack") and meta.get("size") is not None and meta["size"] <= self.packs.max_file_size:
+            # 小文件打包; 超过上限的文件照常分配块, 客户端按响应中有无 packed 区分
+            return Response(self.packs.allocate(meta["fileID"], meta["size"], meta.get("replication")))
+        return Response(self.allocate_file(meta["fileID"], meta.get("num_blocks"), meta.get("size"),
+                                           meta.get("replication"), meta.get("erasure"), meta.get("block_size"),
+                                           meta.get("max_block_size")))
+
+    @nonblocking
+    def _handle_retrieve(self, meta, payload):
+        file_info = self.metadata.get(meta["fileID"])
+        if file_info is None:
+            return Response.error("File not found")
+        if file_info.get("dedup"):
+            return Response(self.chunks.resolve(file_info))  # 块位置在块记录中, 不能按文件版本号判断
+        if file_info.get("packed"):
+            return Response(self.packs.resolve(file_info))  # 同上, 位置在容器记录中
+        if meta.get("generation") == file_info.get("generation"):
+            # 客户端缓存的块位置仍是最新的, 不必重发
+            return Response({"fileID": file_info["fileID"], "generation": file_info["generation"], "unchanged": True})
+        return Response(file_info)
+
+    def _handle_store_many(self, meta, payload):
+        # 批量分配: 所有文件都必须属于本分片, 去重文件需逐个走 STORE
+        for request in meta["files"]:
+            error = self._store_error(request["fileID"])
+            if error:
+                return Response.error(error)
+            if request.get("dedup"):
+                return Response.error(f"Deduplicated file {request['fileID']} cannot be stored in a batch")
+        return Response({"files": self.allocate_files(meta["files"])})
+
+    def _handle_delete(self, meta, payload):
+        file_info = self.metadata.delete(meta["fileID"])  # 删除metadata中的文件信息
+        if file_info is None:
+            return Response.error("File not found")
+        self._replaced(file_info)  # 去重文件的块由垃圾回收删除, blocks 为空, 客户端无需删除
+        return Response(file_info)
+
+    def _handle_delete_many(self, meta, payload):
+        deleted = self.metadata.delete_many(meta["fileIDs"])
+        for file_info in deleted.values():
+            self._replaced(file_info)
+        return Response({"files": list(deleted.values()),
+                         "missing": [file_id for file_id in meta["fileIDs"] if file_id not in deleted]})
+
+    @nonblocking
+    def _handle_get_file_namespace(self, meta, payload):
+        if meta and "limit" in meta:
+            # 分页: 按文件名顺序返回 after 之后的 limit 个文件 (可按前缀或范围过滤) 和下一页的游标
+            files, cursor = self.list_files(meta.get("prefix"), meta.get("start"), meta.get("end"),
+                                            meta.get("after"), meta["limit"])
+            return Response({"files": files, "next": cursor})
+        if not meta or "generation" not in meta:
+            return Response(self.file_ids())
+        # 带版本号的请求: 命名空间未变化时只返回版本号
+        generation = self.metadata.generation()
+        if meta["generation"] == generation:
+            return Response({"generation": generation, "unchanged": True})
+        return Response({"generation": generation, "files": self.file_ids()})
+
+    @nonblocking
+    def _handle_get_storage_servers_status(self, meta, payload):
+        return Response(self.server_status)
+
+    @nonblocking
+    def _handle_heartbeat(self, meta, payload):
+        self.record_heartbeat(meta["host"], int(meta["port"]), meta.get("stats"))
+        return Response()
+
+    def _handle_commit(self, meta, payload):
+        """_summary_    上传完成后记录每个块的校验和
+        """
+        if "files" in meta:
+            # 批量提交: {"files": [{"fileID", "checksums", "codecs"}, ...]}, 只等待一次落盘
+            entries = {entry["fileID"]: entry for entry in meta["files"]}
+            self.metadata.update_many(entries, lambda file_id, file_info: None if file_info is None else dict(
+                file_info, blocks=file_info["blocks"].with_checksums(
+                    entries[file_id]["checksums"][:len(file_info["blocks"])], entries[file_id].get("codecs"))))
+            return Response()
+        if meta.get("pack"):
+            self.packs.commit(meta["fileID"], meta["packed"], meta["checksum"])
+            return Response()
+        checksums = meta["checksums"]
+        if meta.get("dedup"):
+            self.chunks.commit(meta["fileID"], meta["chunks"], checksums)
+            return Response()
+        # 元数据写入后不可原地修改, 复制一份再写回; codecs 为每个块的压缩算法
+        file_info = self.metadata.update(meta["fileID"], lambda file_info: dict(
+            file_info, blocks=file_info["blocks"].with_checksums(checksums[:len(file_info["blocks"])],
+                                                                 meta.get("codecs"))))
+        if file_info is None:
+            return Response.error("File not found")
+        return Response()
+
+    def _handle_block_report(self, meta, payload):
+        return Response(self.inventory.report(meta, bytes(payload.read())))
+
+    def _handle_report_corrupt(self, meta, payload):
+        filename, block_id = meta["block"].rsplit('_block_', 1)
+        if self.metadata.get(filename) is None:
+            return Response()  # 不属于本分片 (或已删除) 的块
+        server = f"{meta['host']}:{meta['port']}"
+        self.corrupt_replicas.setdefault((filename, int(block_id)), set()).add(server)
+        logger.warning("Server %s reported corrupt block %s of %s", server, block_id, filename)
+        self.replicator.schedule(filename, int(block_id))
+        return Response()
+
+    def handle_legacy(self, client_socket):
+        """_summary_    兼容旧的 "COMMAND::filename::args" 文本命令
 
         Args:
             client_socket (_type_): 客户端套接字
         """
         request = client_socket.recv(40960).decode('utf-8')
+        if '::' not in request:
+            return
         command, filename, *args = request.split('::')
 
         if command == 'STORE':
-            num_blocks = int(args[0])
-
-            file_info = {
-                "fileID": filename,
-                "blocks": []
-            }
-
-            for block_id in range(num_blocks):
-                healthy_servers = [server for server in self.servers if self.server_status[server]]
-                primary = random.choice(healthy_servers)
-                replica = random.choice([server for server in healthy_servers if server != primary])
-                block_info = {
-                    "blockID": block_id,
-                    "primary": self._parse_server_address(primary),
-                    "replica": [self._parse_server_address(replica)]
-                }
-                file_info["blocks"].append(block_info)
-
-            client_socket.send(json.dumps(file_info).encode('utf-8'))
-            
-            self.metadata["fileMetadata"].append(file_info)
-            self.save_metadata()  # 保存到文件
+            error = self._store_error(filename)
+            if error:
+                client_socket.send(json.dumps({"error": error}).encode('utf-8'))
+                return
+            file_info = self.allocate_file(filename, int(args[0]))
+            client_socket.send(protocol.encode_meta(file_info))
 
         elif command == 'RETRIEVE':
-            file_info = next(
-                (file_meta for file_meta in self.metadata["fileMetadata"] if file_meta["fileID"] == filename), None)
+            file_info = self.metadata.get(filename)
             if file_info:
-                client_socket.send(json.dumps(file_info).encode('utf-8'))
+                client_socket.send(protocol.encode_meta(file_info))
             else:
                 client_socket.send(json.dumps(
                     {"error": "File not found"}).encode('utf-8'))
 
         elif command == 'DELETE':
-            file_info = next(
-                (file_meta for file_meta in self.metadata["fileMetadata"] if file_meta["fileID"] == filename), None)
+            file_info = self.metadata.delete(filename)  # 删除metadata中的文件信息
+            self._replaced(file_info)
             if file_info:
-                client_socket.send(json.dumps(file_info).encode('utf-8'))
-                # 删除metadata中的文件信息
-                self.metadata["fileMetadata"].remove(file_info)
-                self.save_metadata()  # 保存到文件
+                client_socket.send(protocol.encode_meta(file_info))
             else:
                 client_socket.send(json.dumps(
                     {"error": "File not found"}).encode('utf-8'))
 
         elif command == 'GET_FILE_NAMESPACE':
             # 返回所有的文件名
-            files = [file["fileID"] for file in self.metadata["fileMetadata"]]
+            files = self.file_ids()
             client_socket.send(json.dumps(files).encode('utf-8'))
-            
+
         elif command == 'GET_STORAGE_SERVERS_STATUS':
             client_socket.send(json.dumps(self.server_status).encode('utf-8'))
 
         elif command == 'HEARTBEAT':
-            host = filename
-            port = int(args[0])
-            server_address = f"{host}:{port}"
-            self.server_status[server_address] = True
-            self.last_heartbeat[server_address] = time.time()
-
-        client_socket.close()
+            self.record_heartbeat(filename, int(args[0]))
 
     def start(self):
         heartbeat_thread = threading.Thread(target=self.heartbeat_check)
         heartbeat_thread.daemon = True
         heartbeat_thread.start()
+        self.replicator.start()
+        self.chunks.start()
+        self.packs.start()
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind(self.server_address)
-        server.listen(5)
-        print(f"Master server listening on {self.server_address}")
+        if self.telemetry.master_port:
+            index = self.shards.addresses.index(self.server_address) if self.server_address in self.shards else 0
+            metrics.serve_metrics(self.telemetry.master_port + index, [self.registry], self.telemetry.host)
+            logger.info("Master metrics on %s:%s/metrics", self.telemetry.host, self.telemetry.master_port + index)
 
-        while True:
-            client_socket, addr = server.accept()
-            client_handler = threading.Thread(
-                target=self.handle_client, args=(client_socket,))
-            client_handler.start()
+        logger.info("Master server listening on %s (%s mode)", self.server_address, self.runtime.mode)
+        serve(self.server_address, self.handlers, self.handle_client, self.handle_legacy, self.runtime,
+              self.registry)
+
+
+def run_master_shard(host, port, config_file, metadata_file):
+    configure_logging(config_file)  # 分片运行在独立的进程中
+    MasterServer(host, port, config_file=config_file, metadata_file=metadata_file).start()
+
+
+def start_master_shards(config_file):
+    """_summary_    每个 Master 分片运行在独立的进程中, 各自持有一部分命名空间和自己的元数据文件
+
+    Returns:
+        list:   分片进程
+    """
+    processes = []
+    shards = ShardMap.from_config(config_file)
+    for name, (host, port) in zip(shards.names, shards.addresses):
+        process = multiprocessing.Process(target=run_master_shard,
+                                          args=(host, port, config_file, f"metadata-{name}.json"))
+        process.start()
+        processes.append(process)
+        logger.info("Master shard %s started on %s:%s", name, host, port)
+    return processes
 
 
 if __name__ == "__main__":
 
     config = configparser.ConfigParser()
     config.read('servers.conf')
+    configure_logging(config)
 
-    master_config = config['master']['server']
+    if config.has_section('shards'):
+        for process in start_master_shards('servers.conf'):
+            process.join()
+    else:
+        master_config = config['master']['server']
 
-    master = MasterServer(master_config.split(
-        ':')[0], int(master_config.split(':')[1]))
-    master.start()
+        master = MasterServer(master_config.split(
+            ':')[0], int(master_config.split(':')[1]))
+        master.start()
@@ -0,0 +1,133 @@
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from blockmap import BlockMap, encode_tables
+from metadata_store import MetadataStore
+
+
+def generate_files(total_blocks, blocks_per_file, servers, replication):
+    """_summary_    生成模拟的文件元数据 (每个块带 crc32 校验和, 副本随机分布)
+
+    Yields:
+        dict:   与 Master 写入的 file_info 结构相同
+    """
+    rng = random.Random(0)
+    addresses = [{"host": f"10.0.{i // 256}.{i % 256}", "port": 50000 + i} for i in range(servers)]
+    for file_index in range(0, total_blocks, blocks_per_file):
+        count = min(blocks_per_file, total_blocks - file_index)
+        blocks = []
+        for block_id in range(count):
+            locations = rng.sample(addresses, replication)
+            blocks.append({"blockID": block_id, "primary": dict(locations[0]),
+                           "replica": [dict(server) for server in locations[1:]],
+                           "checksum": f"crc32:{rng.getrandbits(32):08x}"})
+        yield {"fileID": f"/bench/file-{file_index // blocks_per_file:08d}", "size": count * 1024 * 1024,
+               "replication": replication, "blocks": blocks}
+
+
+def write_snapshot(path, files, compact):
+    # 逐个文件写出, 避免先在内存中拼出整个快照
+    with open(path, 'w') as f:
+        f.write('{"lsn":0,"fileMetadata":[')
+        for index, file_info in enumerate(files):
+            if compact:
+                file_info = dict(file_info, blocks=BlockMap.from_blocks(file_info["blocks"]).encode())
+            f.write((',' if index else '') + json.dumps(file_info, separators=(',', ':')))
+        f.write(']')
+        if compact:
+            f.write(',"tables":' + json.dumps(encode_tables()))
+        f.write('}')
+
+
+class LegacyStore:
+    def __init__(self, snapshot_file):
+        """_summary_: 改用 BlockMap 之前的内存表示 (块字典列表 + (fileID, blockID) 反向索引), 仅用于对比
+        """
+        self.files = {}
+        self.server_blocks = {}
+        with open(snapshot_file, 'r') as f:
+            snapshot = json.load(f)
+        for file_info in snapshot["fileMetadata"]:
+            self.files[file_info["fileID"]] = file_info
+            for block in file_info["blocks"]:
+                key = (file_info["fileID"], block["blockID"])
+                for server in [block["primary"]] + block["replica"]:
+                    self.server_blocks.setdefault(f"{server['host']}:{server['port']}", set()).add(key)
+
+    def close(self):
+        pass
+
+
+def load(store_class, snapshot_file):
+    """_summary_    测量加载快照的耗时和加载后常驻的内存
+
+    Returns:
+        tuple:  (耗时秒数, 常驻字节数)
+    """
+    gc.collect()
+    start = time.perf_counter()
+    store = store_class(snapshot_file)
+    seconds = time.perf_counter() - start
+    store.close()
+    del store
+    gc.collect()
+
+    # 第二次加载在 tracemalloc 下进行 (tracemalloc 会拖慢分配, 不计入耗时)
+    tracemalloc.start()
+    store = store_class(snapshot_file)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    store.close()
+    del store
+    gc.collect()
+    return seconds, memory
+
+
+def bench(total_blocks, blocks_per_file, servers, replication, legacy):
+    """_summary_    对比两种表示在同样元数据下的启动耗时和内存占用
+
+    Returns:
+        dict:   测试结果
+    """
+    result = {"blocks": total_blocks, "files": -(-total_blocks // blocks_per_file), "blocks_per_file": blocks_per_file,
+              "replication": replication}
+    workdir = tempfile.mkdtemp(prefix='metadata_bench-')
+    variants = [("compact", MetadataStore)] + ([("legacy", LegacyStore)] if legacy else [])
+    for name, store_class in variants:
+        snapshot_file = os.path.join(workdir, f"{name}.json")
+        write_snapshot(snapshot_file, generate_files(total_blocks, blocks_per_file, servers, replication),
+                       compact=name == "compact")
+        seconds, memory = load(store_class, snapshot_file)
+        result[name] = {"snapshot_bytes": os.path.getsize(snapshot_file), "startup_seconds": seconds,
+                        "memory_bytes": memory, "bytes_per_block": memory / total_blocks}
+        for path in os.listdir(workdir):
+            os.remove(os.path.join(workdir, path))
+    os.rmdir(workdir)
+    if legacy:
+        result["memory_reduction"] = result["legacy"]["memory_bytes"] / result["compact"]["memory_bytes"]
+        result["startup_speedup"] = result["legacy"]["startup_seconds"] / result["compact"]["startup_seconds"]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Master 块映射的内存占用和启动(加载快照)耗时测试")
+    parser.add_argument('--blocks', default='1000000,10000000', help="逗号分隔的总块数")
+    parser.add_argument('--blocks-per-file', default='64,1',
+                        help="逗号分隔的每个文件的块数 (1 为全是小文件的情况, 每个文件的固定开销占主要部分)")
+    parser.add_argument('--servers', type=int, default=100, help="存储服务器数")
+    parser.add_argument('--replication', type=int, default=3, help="副本数")
+    parser.add_argument('--legacy-max-blocks', type=int, default=2000000,
+                        help="超过该块数时不测旧表示 (1000 万块的旧表示需要 10GB 以上内存)")
+    args = parser.parse_args()
+
+    for blocks_per_file in map(int, args.blocks_per_file.split(',')):
+        for total_blocks in map(int, args.blocks.split(',')):
+            print(json.dumps(bench(total_blocks, blocks_per_file, args.servers, args.replication,
+                                   legacy=total_blocks <= args.legacy_max_blocks)))
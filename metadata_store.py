@@ -0,0 +1,341 @@
+import json
+import os
+import threading
+import time
+
+import metrics
+from blockmap import SERVERS, BlockMap, decode_tables, encode_tables
+from namespace import NamespaceIndex
+
+
+class MetadataStore:
+    def __init__(self, snapshot_file='metadata.json', fsync_interval=0.01, compact_threshold=100000,
+                 snapshot_interval=3600, registry=None):
+        """_summary_: 元数据存储引擎 (内存索引 + 预写日志 + 快照)
+
+        所有修改先追加到预写日志(WAL), 由后台线程批量 fsync (组提交),
+        日志过长或距上次快照过久时压缩为快照. 启动时加载快照并重放日志.
+        内存中每个文件的块映射保存为紧凑的 BlockMap, 快照中也使用其紧凑编码.
+
+        Args:
+            snapshot_file (str, optional):  快照文件. Defaults to 'metadata.json'.
+            fsync_interval (float, optional):   组提交等待窗口(秒). Defaults to 0.01.
+            compact_threshold (int, optional):  触发快照压缩的日志条数. Defaults to 100000.
+            snapshot_interval (float, optional):    日志中有记录时, 距上次快照多久(秒)后也压缩,
+                写入不多的 Master 重启时不必重放越来越长的日志. Defaults to 3600.
+            registry (metrics.Registry, optional):  记录落盘和快照耗时的指标. Defaults to None.
+        """
+        self.snapshot_file = snapshot_file
+        self.log_file = snapshot_file + '.wal'
+        self.old_log_file = self.log_file + '.1'  # 压缩过程中被冻结的日志段
+        self.fsync_interval = fsync_interval
+        self.compact_threshold = compact_threshold
+        self.snapshot_interval = snapshot_interval
+        # 上次快照的时间, 没有快照时从启动算起
+        self.snapshot_time = os.path.getmtime(snapshot_file) if os.path.exists(snapshot_file) else time.time()
+
+        self.files = {}  # fileID -> file_info 索引
+        self.server_files = {}  # 服务器编号 -> {fileID, ...} 反向索引, 块ID在需要时从 BlockMap 中查找
+        self.names = NamespaceIndex()  # 按文件名排序的索引, 用于范围/前缀查询
+        self.lock = threading.RLock()
+        self.sync_cond = threading.Condition(threading.Lock())
+        self.compact_lock = threading.Lock()
+        self.io_lock = threading.Lock()  # 保护日志文件的 fsync 与轮转
+
+        self.lsn = 0  # 最新写入的日志序号
+        self.synced_lsn = 0  # 已经 fsync 的日志序号
+        self.snapshot_lsn = 0  # 快照覆盖到的日志序号
+
+        registry = registry or metrics.Registry()
+        self.fsync_seconds = registry.histogram('dfs_metadata_fsync_seconds',
+                                                "Duration of one group-commit flush and fsync of the metadata log")
+        self.fsync_records = registry.histogram('dfs_metadata_fsync_records', "Log records made durable by one fsync",
+                                                buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000))
+        self.snapshot_seconds = registry.histogram('dfs_metadata_snapshot_seconds',
+                                                   "Duration of writing a metadata snapshot",
+                                                   buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+        registry.gauge('dfs_metadata_log_records', "Log records written since the last snapshot",
+                       function=lambda: self.lsn - self.snapshot_lsn)
+        load_seconds = registry.gauge('dfs_metadata_load_seconds',
+                                      "Time spent loading the snapshot and replaying the log")
+
+        start = time.perf_counter()
+        self._replay()
+        load_seconds.set(time.perf_counter() - start)
+
+        self._log = open(self.log_file, 'ab')
+        flusher = threading.Thread(target=self._flush_loop)
+        flusher.daemon = True
+        flusher.start()
+
+    def _replay(self):
+        """_summary_    加载快照并重放预写日志
+        """
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                snapshot = json.load(f)
+            self.snapshot_lsn = snapshot.get("lsn", 0)
+            server_ids, algorithm_ids, codec_ids = decode_tables(snapshot.get("tables", {}))
+            for file_info in snapshot.get("fileMetadata", []):
+                if isinstance(file_info["blocks"], dict):
+                    blocks = BlockMap.decode(file_info["blocks"], server_ids, algorithm_ids,
+                                             snapshot["tables"]["byteorder"], codec_ids)
+                    file_info["blocks"] = blocks  # 快照刚解析出来, 没有其他引用, 可以原地替换
+                self._apply({"op": "put", "file": file_info})
+
+        self.lsn = self.snapshot_lsn
+        for log_file in (self.old_log_file, self.log_file):
+            if not os.path.exists(log_file):
+                continue
+            with open(log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # 崩溃时写了一半的尾部记录
+                    if record["lsn"] <= self.snapshot_lsn:
+                        continue
+                    self._apply(record)
+                    self.lsn = record["lsn"]
+        self.synced_lsn = self.lsn
+
+    def _apply(self, record):
+        if record["op"] == "put":
+            file_info = dict(record["file"], blocks=BlockMap.from_blocks(record["file"]["blocks"]))
+            self._unindex(self.files.get(file_info["fileID"]))
+            self.files[file_info["fileID"]] = file_info
+            self.names.add(file_info["fileID"])
+            self._index(file_info)
+        elif record["op"] == "delete":
+            self._unindex(self.files.pop(record["fileID"], None))
+            self.names.discard(record["fileID"])
+
+    def _index(self, file_info):
+        for server_id in file_info["blocks"].server_ids():
+            self.server_files.setdefault(server_id, set()).add(file_info["fileID"])
+
+    def _unindex(self, file_info):
+        if file_info is None:
+            return
+        for server_id in file_info["blocks"].server_ids():
+            self.server_files.get(server_id, set()).discard(file_info["fileID"])
+
+    def _write(self, record):
+        """_summary_    追加日志记录(仅写入缓冲区), 调用方需持有 self.lock
+
+        Returns:
+            int:    记录的日志序号
+        """
+        self.lsn += 1
+        record["lsn"] = self.lsn
+        if record["op"] == "put":
+            # 每次修改都以日志序号作为新的版本号, 删除后重建的文件也不会与旧版本号重复
+            record["file"] = dict(record["file"], generation=self.lsn)
+        self._apply(record)
+        self._log.write(json.dumps(record, separators=(',', ':'), default=lambda value: value.to_json()).encode('utf-8') + b'\n')
+        return self.lsn
+
+    def _wait_durable(self, lsn):
+        """_summary_    等待日志序号 lsn 之前的记录落盘
+        """
+        with self.sync_cond:
+            self.sync_cond.notify_all()
+            while self.synced_lsn < lsn:
+                self.sync_cond.wait()
+
+        due = (lsn - self.snapshot_lsn >= self.compact_threshold
+               or time.time() - self.snapshot_time >= self.snapshot_interval)
+        if due and not self.compact_lock.locked():
+            compactor = threading.Thread(target=self.compact)
+            compactor.daemon = True
+            compactor.start()
+
+    def _flush_loop(self):
+        """_summary_    组提交: 一次 fsync 覆盖窗口内的所有写入
+        """
+        while True:
+            with self.sync_cond:
+                while self.synced_lsn >= self.lsn:
+                    self.sync_cond.wait()
+            time.sleep(self.fsync_interval)  # 等待更多写入加入本批次
+
+            start = time.perf_counter()
+            with self.io_lock:
+                with self.lock:
+                    lsn = self.lsn
+                    self._log.flush()
+                os.fsync(self._log.fileno())
+            self.fsync_seconds.observe(time.perf_counter() - start)
+
+            with self.sync_cond:
+                self.fsync_records.observe(lsn - self.synced_lsn)
+                self.synced_lsn = max(self.synced_lsn, lsn)
+                self.sync_cond.notify_all()
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+    def put(self, file_info):
+        """_summary_    写入(覆盖)文件元数据, file_info 写入后不应再被原地修改
+
+        Args:
+            file_info (dict):   文件元数据
+        """
+        with self.lock:
+            lsn = self._write({"op": "put", "file": file_info})
+        self._wait_durable(lsn)
+
+    def update(self, file_id, func):
+        """_summary_    原子地读-改-写一个文件的元数据
+
+        Args:
+            file_id (str):  文件名
+            func (callable):    接收当前元数据, 返回新的元数据; 返回 None 表示不修改
+
+        Returns:
+            dict:   新的元数据, 文件不存在或未修改时为 None
+        """
+        with self.lock:
+            file_info = self.files.get(file_id)
+            if file_info is None:
+                return None
+            file_info = func(file_info)
+            if file_info is None:
+                return None
+            lsn = self._write({"op": "put", "file": file_info})
+            file_info = self.files[file_id]
+        self._wait_durable(lsn)
+        return file_info
+
+    def update_many(self, file_ids, func):
+        """_summary_    批量读-改-写多个文件的元数据, 所有修改只等待一次落盘
+
+        先对所有文件调用 func 再写日志: 任何一次调用抛出异常时什么都不写入, 批量修改要么全部生效要么都不生效.
+
+        Args:
+            file_ids (iterable):    文件名
+            func (callable):    接收 (fileID, 当前元数据或 None), 返回新的元数据; 返回 None 表示不修改
+
+        Returns:
+            dict:   fileID -> 修改后的元数据
+        """
+        updated = {}
+        lsn = None
+        with self.lock:
+            changes = [(file_id, func(file_id, self.files.get(file_id))) for file_id in file_ids]
+            for file_id, file_info in changes:
+                if file_info is None:
+                    continue
+                lsn = self._write({"op": "put", "file": file_info})
+                updated[file_id] = self.files[file_id]
+        if lsn is not None:
+            self._wait_durable(lsn)
+        return updated
+
+    def blocks_on(self, server):
+        """_summary_    反向索引: 存放在某台存储服务器上的所有块
+
+        Args:
+            server (str):   "host:port"
+
+        Returns:
+            list:   [(fileID, blockID), ...]
+        """
+        with self.lock:
+            server_id = SERVERS.lookup(server)
+            files = [self.files[file_id] for file_id in self.server_files.get(server_id, ())]
+        return [(file_info["fileID"], block_id) for file_info in files
+                for block_id in file_info["blocks"].blocks_on(server_id)]
+
+    def delete(self, file_id):
+        """_summary_    删除文件元数据
+
+        Returns:
+            dict:   被删除的文件元数据, 不存在时为 None
+        """
+        with self.lock:
+            file_info = self.files.get(file_id)
+            if file_info is None:
+                return None
+            lsn = self._write({"op": "delete", "fileID": file_id})
+        self._wait_durable(lsn)
+        return file_info
+
+    def delete_many(self, file_ids):
+        """_summary_    批量删除文件元数据, 所有删除只等待一次落盘
+
+        Returns:
+            dict:   fileID -> 被删除的文件元数据, 不存在的文件不在其中
+        """
+        deleted = {}
+        lsn = None
+        with self.lock:
+            for file_id in file_ids:
+                file_info = self.files.get(file_id)
+                if file_info is None:
+                    continue
+                lsn = self._write({"op": "delete", "fileID": file_id})
+                deleted[file_id] = file_info
+        if lsn is not None:
+            self._wait_durable(lsn)
+        return deleted
+
+    def file_ids(self):
+        return list(self.files)
+
+    def scan(self, start=None, stop=None, after=None, limit=None):
+        """_summary_    按文件名顺序列出 [start, stop) 中 after 之后的至多 limit 个文件名
+        """
+        return self.names.range(start, stop, after, limit)
+
+    def generation(self):
+        # 任何修改都会推进日志序号, 可用作整个命名空间的版本号
+        return self.lsn
+
+    def __len__(self):
+        return len(self.files)
+
+    def compact(self):
+        """_summary_    把当前状态写成快照并截断日志
+        """
+        if not self.compact_lock.acquire(blocking=False):
+            return  # 已有压缩在进行
+        start = time.perf_counter()
+        try:
+            with self.io_lock, self.lock:
+                # 冻结当前日志段, 新的写入进入新日志
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+                if os.path.exists(self.old_log_file):
+                    # 上一次压缩未完成, 合并两个日志段
+                    with open(self.old_log_file, 'ab') as old, open(self.log_file, 'rb') as cur:
+                        old.write(cur.read())
+                        old.flush()
+                        os.fsync(old.fileno())
+                    os.remove(self.log_file)
+                else:
+                    os.replace(self.log_file, self.old_log_file)
+                self._log = open(self.log_file, 'ab')
+                files = list(self.files.values())
+                lsn = self.lsn
+
+            tmp_file = self.snapshot_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                files = [dict(file_info, blocks=file_info["blocks"].encode()) for file_info in files]
+                json.dump({"lsn": lsn, "tables": encode_tables(), "fileMetadata": files}, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+            os.remove(self.old_log_file)
+            self.snapshot_lsn = lsn
+            self.snapshot_time = time.time()
+            self.snapshot_seconds.observe(time.perf_counter() - start)
+        finally:
+            self.compact_lock.release()
+
+    def close(self):
+        with self.io_lock, self.lock:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
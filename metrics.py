@@ -0,0 +1,374 @@
+import configparser
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from protocol import Op
+
+# 延迟直方图的默认桶上界(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        """_summary_: 一个指标及其按标签区分的取值
+
+        Args:
+            name (str): 指标名
+            help (str): 说明
+            labelnames (tuple, optional):   标签名, 记录时以关键字参数给出. Defaults to ().
+            function (callable, optional):  导出时调用它取值 (无标签), 用于已有的统计量, 记录路径上没有任何开销.
+                Defaults to None.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.values = {}  # 标签值元组 -> 取值
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        """_summary_    (后缀, 标签 dict, 值) 列表, 用于生成文本格式
+        """
+        if self.function is not None:
+            return [('', {}, self.function())]
+        with self.lock:
+            return [('', dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]  # 各桶计数, 总和, 次数
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            entries = [(dict(zip(self.labelnames, key)), list(counts), total, count)
+                       for key, (counts, total, count) in self.values.items()]
+        for labels, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', dict(labels, le=_format_value(float(bound))), cumulative))
+            samples.append(('_bucket', dict(labels, le='+Inf'), count))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Span:
+    def __init__(self, latency, transferred, tracer, op, **fields):
+        """_summary_: 一次操作的计时范围 (with 语句), 在 with 块内设置 bytes;
+        结束时记录耗时和字节数, 并按需写一条跟踪日志 (异常时 status 为 error)
+
+        Args:
+            latency (Histogram):    按 op 记录耗时
+            transferred (Counter):  按 op 累计字节数, 可为 None
+            tracer (Tracer):    跟踪日志
+            op (str):   操作名
+            fields: 写入跟踪日志的其他字段
+        """
+        self.latency = latency
+        self.transferred = transferred
+        self.tracer = tracer
+        self.op = op
+        self.fields = fields
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        self.latency.observe(seconds, op=self.op)
+        if self.transferred is not None and self.bytes:
+            self.transferred.inc(self.bytes, op=self.op)
+        if self.tracer.enabled:
+            self.tracer.record(op=self.op, status='ok' if exc_type is None else 'error', seconds=round(seconds, 6),
+                               bytes=self.bytes, **self.fields)
+
+
+class Registry:
+    def __init__(self, labels=None):
+        """_summary_: 一个服务器(或客户端)实例的全部指标
+
+        Args:
+            labels (dict, optional):    附加到每个样本上的固定标签, 如 {"role": "storage", "server": "host:port"},
+                同一进程中的多个实例由此区分. Defaults to None.
+        """
+        self.labels = labels or {}
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=(), function=None):
+        return self._register(Counter(name, help, labelnames, function))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self._register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        return render([self])
+
+
+def render(registries):
+    """_summary_    生成 Prometheus 文本格式; 多个实例的同名指标合并在一个 HELP/TYPE 下
+
+    Args:
+        registries (list):  Registry 列表
+
+    Returns:
+        str:    文本格式的指标
+    """
+    families = {}
+    for registry in registries:
+        with registry.lock:
+            metrics = list(registry.metrics.values())
+        for metric in metrics:
+            families.setdefault(metric.name, (metric, []))[1].append((registry.labels, metric))
+    lines = []
+    for name, (first, members) in sorted(families.items()):
+        lines.append(f"# HELP {name} {first.help}")
+        lines.append(f"# TYPE {name} {first.kind}")
+        for const_labels, metric in members:
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{name}{suffix}{_format_labels(dict(const_labels, **labels))} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(port, registries, host='127.0.0.1'):
+    """_summary_    在后台线程中提供 GET /metrics (Prometheus 文本格式)
+
+    Args:
+        port (int): 端口
+        registries (list):  导出的 Registry 列表
+        host (str, optional):   监听地址, 默认只监听本机. Defaults to '127.0.0.1'.
+
+    Returns:
+        ThreadingHTTPServer:    HTTP 服务器, 调用 shutdown 停止
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render(registries).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 抓取请求不写访问日志
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class MetricsOptions:
+    def __init__(self, master_port=0, storage_port=0, host='127.0.0.1', trace_file=None):
+        """_summary_: 指标和跟踪日志的配置, 对应 servers.conf 的 [metrics] 段
+
+        Args:
+            master_port (int, optional):    Master 的 /metrics 端口, 第 i 个分片使用 master_port + i, 0 表示不开启.
+                Defaults to 0.
+            storage_port (int, optional):   存储进程的 /metrics 端口, 进程内的所有存储服务器共用, 0 表示不开启.
+                Defaults to 0.
+            host (str, optional):   /metrics 的监听地址. Defaults to '127.0.0.1'.
+            trace_file (str, optional): 逐请求的跟踪日志文件, 不配置时不记录. Defaults to None.
+        """
+        self.master_port = master_port
+        self.storage_port = storage_port
+        self.host = host
+        self.trace_file = trace_file
+
+    @classmethod
+    def from_config(cls, config):
+        """_summary_    从 ConfigParser 或配置文件路径读取 [metrics] 段, 缺省项使用默认值
+        """
+        if isinstance(config, str):
+            config_file, config = config, configparser.ConfigParser()
+            config.read(config_file)
+        if not config.has_section('metrics'):
+            return cls()
+        section = config['metrics']
+        return cls(master_port=section.getint('master_port', 0),
+                   storage_port=section.getint('storage_port', 0),
+                   host=section.get('host', '127.0.0.1'),
+                   trace_file=section.get('trace_file') or None)
+
+
+class Tracer:
+    def __init__(self, path=None, labels=None):
+        """_summary_: 逐请求的跟踪日志, 每个请求一行 JSON; 未指定文件时 record 直接返回
+
+        Args:
+            path (str, optional):   日志文件, 以追加方式写入. Defaults to None.
+            labels (dict, optional):    写入每条记录的固定字段, 如 {"server": "host:port"}. Defaults to None.
+        """
+        self.file = open(path, 'a', buffering=1) if path else None
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+
+    def bind(self, **labels):
+        """_summary_    写入同一个文件的跟踪日志, 每条记录再附加 labels (同一进程中的多个服务器共用一个文件)
+        """
+        tracer = Tracer(labels=dict(self.labels, **labels))
+        tracer.file, tracer.lock = self.file, self.lock
+        return tracer
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def record(self, **fields):
+        if self.file is None:
+            return
+        line = json.dumps(dict(self.labels, ts=round(time.time(), 6), **fields), separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+
+def _subject(meta):
+    # 跟踪日志中标识请求对象的字段
+    for key in ("fileID", "block"):
+        if key in meta:
+            return {key: meta[key]}
+    if "blocks" in meta:
+        return {"blocks": len(meta["blocks"])}
+    if "files" in meta:
+        return {"files": len(meta["files"])}
+    return {}
+
+
+def instrument(handlers, registry, tracer=None):
+    """_summary_    为服务器的每个处理函数记录延迟、字节数和结果, 并按需写跟踪日志
+
+    Args:
+        handlers (dict):    操作码 -> 处理函数(meta, payload) -> Response
+        registry (Registry):    指标
+        tracer (Tracer, optional):  跟踪日志. Defaults to None.
+
+    Returns:
+        dict:   包装后的处理函数, 保留 nonblocking 标记
+    """
+    latency = registry.histogram('dfs_request_seconds', "Request handling latency by command", ('op',))
+    requests = registry.counter('dfs_requests_total', "Requests handled by command and status", ('op', 'status'))
+    bytes_in = registry.counter('dfs_received_bytes_total', "Request payload bytes received by command", ('op',))
+    bytes_out = registry.counter('dfs_sent_bytes_total', "Response payload bytes sent by command", ('op',))
+    inflight = registry.gauge('dfs_requests_inflight', "Requests currently being handled")
+
+    def wrap(opcode, handler):
+        op = Op(opcode).name.lower()
+
+        def instrumented(meta, payload):
+            inflight.inc()
+            start = time.perf_counter()
+            status, response = 'error', None
+            try:
+                response = handler(meta, payload)
+                status = 'error' if response.opcode == Op.ERROR else 'ok'
+                return response
+            finally:
+                seconds = time.perf_counter() - start
+                inflight.dec()
+                sent = 0 if response is None else (response.count if response.file is not None
+                                                   else len(response.data))
+                latency.observe(seconds, op=op)
+                requests.inc(op=op, status=status)
+                bytes_in.inc(payload.length, op=op)
+                bytes_out.inc(sent, op=op)
+                if tracer is not None and tracer.enabled:
+                    tracer.record(op=op, status=status, seconds=round(seconds, 6), bytes_in=payload.length,
+                                  bytes_out=sent, **_subject(meta))
+
+        instrumented.nonblocking = getattr(handler, 'nonblocking', False)
+        return instrumented
+
+    return {opcode: wrap(opcode, handler) for opcode, handler in handlers.items()}
@@ -0,0 +1,102 @@
+import bisect
+import threading
+
+
+class NamespaceIndex:
+    def __init__(self, load=1000):
+        """_summary_: 按文件名排序的命名空间索引, 支持范围和前缀查询
+
+        文件名分段保存在若干有序小列表中 (每段不超过 2*load 个), 插入/删除只移动一段,
+        百万级命名空间下也不需要每次整体排序或移动整个列表.
+
+        Args:
+            load (int, optional):   每段的目标长度. Defaults to 1000.
+        """
+        self.load = load
+        self.segments = []  # 有序的分段, 段与段之间也有序
+        self.maxes = []  # 每段的最大文件名, 用于二分定位
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            if not self.segments:
+                self.segments.append([name])
+                self.maxes.append(name)
+                self.count = 1
+                return
+            position = min(bisect.bisect_left(self.maxes, name), len(self.maxes) - 1)
+            segment = self.segments[position]
+            index = bisect.bisect_left(segment, name)
+            if index < len(segment) and segment[index] == name:
+                return  # 已存在 (覆盖写入)
+            segment.insert(index, name)
+            self.maxes[position] = segment[-1]
+            self.count += 1
+            if len(segment) > 2 * self.load:
+                # 段过长时对半拆分
+                self.segments[position:position + 1] = [segment[:self.load], segment[self.load:]]
+                self.maxes[position:position + 1] = [segment[self.load - 1], segment[-1]]
+
+    def discard(self, name):
+        with self.lock:
+            position = bisect.bisect_left(self.maxes, name)
+            if position == len(self.maxes):
+                return
+            segment = self.segments[position]
+            index = bisect.bisect_left(segment, name)
+            if index == len(segment) or segment[index] != name:
+                return
+            del segment[index]
+            self.count -= 1
+            if segment:
+                self.maxes[position] = segment[-1]
+            else:
+                del self.segments[position]
+                del self.maxes[position]
+
+    def __len__(self):
+        return self.count
+
+    def range(self, start=None, stop=None, after=None, limit=None):
+        """_summary_    按顺序返回 [start, stop) 中 after 之后的文件名
+
+        Args:
+            start (str, optional):  起点(含), None 表示从头开始. Defaults to None.
+            stop (str, optional):   终点(不含), None 表示到末尾. Defaults to None.
+            after (str, optional):  分页游标, 只返回大于它的文件名. Defaults to None.
+            limit (int, optional):  最多返回的个数. Defaults to None.
+
+        Returns:
+            list:   文件名
+        """
+        names = []
+        with self.lock:
+            if after is not None and (start is None or after >= start):
+                position = bisect.bisect_right(self.maxes, after)
+                index = bisect.bisect_right(self.segments[position], after) if position < len(self.segments) else 0
+            elif start is not None:
+                position = bisect.bisect_left(self.maxes, start)
+                index = bisect.bisect_left(self.segments[position], start) if position < len(self.segments) else 0
+            else:
+                position, index = 0, 0
+            while position < len(self.segments) and (limit is None or len(names) < limit):
+                segment = self.segments[position]
+                end = len(segment) if limit is None else min(len(segment), index + limit - len(names))
+                if stop is not None:
+                    end = min(end, bisect.bisect_left(segment, stop, index))
+                names.extend(segment[index:end])
+                if end < len(segment):
+                    break
+                position, index = position + 1, 0
+        return names
+
+
+def prefix_end(prefix):
+    """_summary_    以 prefix 开头的文件名都小于返回值 (空前缀返回 None, 即不设上界)
+    """
+    while prefix and prefix[-1] == chr(0x10FFFF):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
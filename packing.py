@@ -0,0 +1,293 @@
+import logging
+import threading
+import time
+import uuid
+
+import checksum
+from protocol import ConnectionPool, Op, ProtocolError, block_name
+
+logger = logging.getLogger(__name__)
+PACK_PREFIX = '#pack-'  # 容器块在元数据中的 fileID 前缀
+
+
+def is_container(file_id):
+    return file_id.startswith(PACK_PREFIX)
+
+
+class PackIndex:
+    def __init__(self, master, container_size=8*1024*1024, max_file_size=64*1024, compact_interval=600,
+                 compact_ratio=0.5, grace=3600):
+        """_summary_: 小文件打包 (把小文件追加到共享的容器块中)
+
+        每个容器在元数据中是一个 fileID 为 "#pack-<id>" 的单块记录, 带已写入的
+        长度 size 和仍被引用的字节数 live; 打包的文件不占用自己的块, 只记录
+        packed = {"container", "offset", "length", "checksum"}.
+        容器的放置、损坏上报和副本修复都复用普通文件的机制.
+
+        Master 在内存中为每个文件预留容器内互不重叠的区间, 客户端用 APPEND_BLOCK
+        写入后提交. 容器写满后封存, Master 重启后原有的容器全部视为封存, 所以
+        预留的区间不需要落盘. 文件被删除或覆盖后只减少容器的 live, 由后台压缩把
+        live 比例过低的封存容器中的文件搬到新容器, 再删除旧容器.
+
+        Args:
+            master (MasterServer):  Master 服务器
+            container_size (int, optional): 容器大小上限. Defaults to 8MiB.
+            max_file_size (int, optional):  打包的文件大小上限, 更大的文件按普通方式存储. Defaults to 64KiB.
+            compact_interval (int, optional):   压缩的间隔(秒). Defaults to 600.
+            compact_ratio (float, optional):    live 占 size 的比例低于它的封存容器被压缩. Defaults to 0.5.
+            grace (int, optional):  容器最后一次预留之后多久才能被压缩(秒), 也是未提交写入的有效期. Defaults to 3600.
+        """
+        self.master = master
+        self.container_size = container_size
+        self.max_file_size = max_file_size
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        self.grace = grace
+        self.pool = ConnectionPool()
+        self.open = {}  # 副本数 -> 正在追加的容器
+        self.reserved = {}  # 容器 -> 已预留到的偏移
+        self.reserved_at = {}  # 容器 -> 最后一次预留的时间
+        self.members = {}  # 容器 -> 打包在其中的 fileID, 压缩时使用
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def start(self):
+        # 重建容器成员索引; 重启前打开的容器不再追加, 视为封存
+        for file_id in self.master.metadata.file_ids():
+            file_info = self.master.metadata.get(file_id)
+            if file_info is None:
+                continue
+            if is_container(file_id):
+                self.members.setdefault(file_id, set())
+            elif file_info.get("packed"):
+                self.members.setdefault(file_info["packed"]["container"], set()).add(file_id)
+        compactor = threading.Thread(target=self._compact_loop)
+        compactor.daemon = True
+        compactor.start()
+
+    def _new_container(self, replication):
+        """_summary_    创建一个空容器并写入元数据, 调用方需持有 self.lock
+        """
+        container = PACK_PREFIX + uuid.uuid4().hex  # 不复用名字, 缓存了旧位置的客户端不会读到别的数据
+        servers = self.master.placement.place(self.master.healthy_servers(), replication, self.container_size)
+        self.master.metadata.put({
+            "fileID": container,
+            "container": True,
+            "size": 0,
+            "live": 0,
+            "replication": replication,
+            "blocks": [{
+                "blockID": 0,
+                "primary": self.master._parse_server_address(servers[0]),
+                "replica": [self.master._parse_server_address(server) for server in servers[1:]]
+            }]
+        })
+        self.open[replication] = container
+        self.reserved[container] = 0
+        self.members[container] = set()
+        return container
+
+    def _reserve(self, length, replication):
+        """_summary_    在正在追加的容器中预留 length 字节, 放不下时封存它并打开新容器
+
+        Returns:
+            tuple:  (容器, 偏移)
+        """
+        with self.lock:
+            container = self.open.get(replication)
+            if container is None or self.reserved[container] + length > self.container_size:
+                container = self._new_container(replication)
+            offset = self.reserved[container]
+            self.reserved[container] = offset + length
+            self.reserved_at[container] = time.time()
+        return container, offset
+
+    def allocate(self, filename, size, replication=None):
+        """_summary_    为小文件预留容器中的区间
+
+        Returns:
+            dict:   {"fileID", "size", "packed": {"container", "offset", "length"}, "blocks": [容器块]}
+        """
+        replication = replication or self.master.placement.replication_factor
+        container, offset = self._reserve(size, replication)
+        block = self.master.metadata.get(container)["blocks"][0]
+        return {"fileID": filename, "size": size,
+                "packed": {"container": container, "offset": offset, "length": size},
+                "blocks": [dict(block, fileID=container)]}
+
+    def commit(self, filename, packed, file_checksum):
+        """_summary_    文件已写入容器: 写入文件元数据, 增加容器的 live
+
+        Args:
+            filename (str): 文件名
+            packed (dict):  allocate 返回的 {"container", "offset", "length"}
+            file_checksum (str):    文件数据的校验和
+
+        Raises:
+            ValueError: 容器已不存在 (预留超过有效期后被压缩)
+        """
+        container, end = packed["container"], packed["offset"] + packed["length"]
+        previous = []
+
+        def record(file_id, current):
+            if file_id == container:
+                if current is None:
+                    raise ValueError(f"Container {container} of {filename} no longer exists")
+                return dict(current, live=current["live"] + packed["length"], size=max(current["size"], end))
+            previous.append(current)
+            return {"fileID": filename, "size": packed["length"], "packed": dict(packed, checksum=file_checksum),
+                    "blocks": []}
+
+        # 容器和文件的修改只等待一次落盘
+        self.master.metadata.update_many([container, filename], record)
+        for file_info in previous:
+            self.master._replaced(file_info)  # 覆盖旧版本
+        with self.lock:
+            self.members.setdefault(container, set()).add(filename)
+
+    def release(self, file_info):
+        """_summary_    打包的文件被删除或覆盖, 减少容器的 live
+        """
+        packed = file_info["packed"]
+        self.master.metadata.update(packed["container"], lambda record: dict(
+            record, live=max(record["live"] - packed["length"], 0)))
+        with self.lock:
+            self.members.get(packed["container"], set()).discard(file_info["fileID"])
+
+    def resolve(self, file_info):
+        """_summary_    附上容器块的位置
+
+        Returns:
+            dict:   文件元数据, blocks 中是容器块 (fileID 为容器名)
+        """
+        record = self.master.metadata.get(file_info["packed"]["container"])
+        if record is None:
+            raise ValueError(f"Container of {file_info['fileID']} is missing")
+        return dict(file_info, blocks=[dict(record["blocks"][0], fileID=record["fileID"])])
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.warning("Container compaction failed: %s", e)
+
+    def compact(self):
+        """_summary_    压缩 live 比例过低的封存容器: 搬走其中的文件后删除容器
+
+        Returns:
+            int:    删除的容器数
+        """
+        now = time.time()
+        with self.lock:
+            candidates = [container for container in self.members
+                          if container not in self.open.values()
+                          and now - self.reserved_at.get(container, self.started) > self.grace]
+        removed = 0
+        for container in candidates:
+            record = self.master.metadata.get(container)
+            if record is None or record["live"] > self.compact_ratio * record["size"]:
+                continue
+            with self.lock:
+                members = list(self.members.get(container, ()))
+            for file_id in members:
+                self._move(file_id, container, record)
+            with self.lock:
+                if self.members.get(container):
+                    continue  # 有文件没能搬走, 下次再试
+                self.members.pop(container, None)
+                self.reserved.pop(container, None)
+                self.reserved_at.pop(container, None)
+            self.master.metadata.delete(container)
+            self._delete_container(record)
+            removed += 1
+        if removed:
+            logger.info("Compacted %s containers", removed)
+        return removed
+
+    def _move(self, file_id, container, record):
+        """_summary_    把一个文件从旧容器复制到正在追加的容器, 再切换文件元数据
+        """
+        file_info = self.master.metadata.get(file_id)
+        if file_info is None or not file_info.get("packed") or file_info["packed"]["container"] != container:
+            with self.lock:
+                self.members.get(container, set()).discard(file_id)
+            return
+        packed = file_info["packed"]
+        try:
+            data = self._read(record["blocks"][0], container, packed)
+        except (OSError, ProtocolError, checksum.ChecksumError) as e:
+            logger.warning("Failed to read %s from container %s. Error: %s", file_id, container, e)
+            return
+        target, offset = self._reserve(len(data), record["replication"])
+        block = self.master.metadata.get(target)["blocks"][0]
+        if not self._append(block, target, offset, data, packed["checksum"]):
+            return
+        moved = dict(packed, container=target, offset=offset)
+
+        def switch(current_id, current):
+            if current_id == target:
+                return dict(current, live=current["live"] + len(data), size=max(current["size"], offset + len(data)))
+            if current is None or current.get("packed") != packed:
+                raise ValueError(f"{file_id} changed during compaction")
+            return dict(current, packed=moved)
+
+        try:
+            self.master.metadata.update_many([file_id, target], switch)
+        except ValueError as e:
+            logger.info("%s", e)  # 文件在复制期间被覆盖或删除, 新容器中的副本成为待压缩的空间
+            return
+        self.master.metadata.update(container, lambda current: dict(current, live=max(current["live"] - len(data), 0)))
+        with self.lock:
+            self.members.get(container, set()).discard(file_id)
+            self.members.setdefault(target, set()).add(file_id)
+
+    def _read(self, block, container, packed):
+        for server in [block["primary"]] + block["replica"]:
+            try:
+                _, data = self.pool.call((server["host"], server["port"]), Op.RETRIEVE_BLOCK,
+                                         {"block": block_name(container, 0), "offset": packed["offset"],
+                                          "length": packed["length"]})
+                checksum.verify(data, packed["checksum"])
+                return bytes(data)
+            except (OSError, ProtocolError, checksum.ChecksumError) as e:
+                error = e
+        raise error
+
+    def _append(self, block, container, offset, data, data_checksum):
+        """_summary_    把数据写入容器的 offset 处, 经主服务器链式复制, 链条中断时直接补写
+
+        Returns:
+            bool:   所有副本是否都写入成功
+        """
+        primary, meta = block["primary"], {"block": block_name(container, 0), "offset": offset,
+                                           "checksum": data_checksum}
+        try:
+            response, _ = self.pool.call((primary["host"], primary["port"]), Op.APPEND_BLOCK,
+                                         dict(meta, pipeline=block["replica"]), data)
+            stored = response.get("stored", [primary])
+        except (OSError, ProtocolError) as e:
+            logger.warning("Failed to append to %s on %s:%s. Error: %s", container, primary['host'],
+                           primary['port'], e)
+            return False
+        for server in block["replica"]:
+            if server in stored:
+                continue
+            try:
+                self.pool.call((server["host"], server["port"]), Op.APPEND_BLOCK, meta, data)
+            except (OSError, ProtocolError) as e:
+                logger.warning("Failed to append to %s on %s:%s. Error: %s", container, server['host'],
+                               server['port'], e)
+                return False
+        return True
+
+    def _delete_container(self, record):
+        block = record["blocks"][0]
+        for server in [block["primary"]] + block["replica"]:
+            try:
+                self.pool.call((server["host"], server["port"]), Op.DELETE_BLOCK,
+                               {"block": block_name(record["fileID"], 0)})
+            except (OSError, ProtocolError) as e:
+                logger.warning("Failed to delete container %s from %s:%s. Error: %s", record['fileID'],
+                               server['host'], server['port'], e)
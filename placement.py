@@ -0,0 +1,108 @@
+import random
+import threading
+
+
+class PlacementEngine:
+    def __init__(self, domains=None, replication_factor=2, min_block_size=1024*1024, max_block_size=128*1024*1024,
+                 blocks_per_server=4):
+        """_summary_: 块放置引擎
+
+        按存储服务器心跳上报的剩余空间和在途 I/O 加权随机选择服务器,
+        同一个块的多个副本尽量分散到不同的故障域(机架/主机).
+
+        Args:
+            domains (dict, optional):   "host:port" -> 故障域名, 未列出的服务器各自成域. Defaults to None.
+            replication_factor (int, optional): 集群默认副本数(含主副本). Defaults to 2.
+            min_block_size (int, optional): 自适应块大小的下限. Defaults to 1MiB.
+            max_block_size (int, optional): 块大小的上限, 也限制客户端指定的块大小. Defaults to 128MiB.
+            blocks_per_server (int, optional):  自适应时期望每台服务器分到的块数. Defaults to 4.
+        """
+        self.domains = domains or {}
+        self.replication_factor = replication_factor
+        self.min_block_size = min_block_size
+        self.max_block_size = max_block_size
+        self.blocks_per_server = blocks_per_server
+        self.stats = {}  # "host:port" -> {"free": 剩余字节, "inflight": 在途请求数}
+        self.reserved = {}  # 自上次心跳以来已分配但尚未体现在 free 中的字节数
+        self.lock = threading.Lock()
+
+    def block_size(self, size, servers, limit=None):
+        """_summary_    按文件大小和集群规模选择块大小
+
+        大文件用大块减少元数据条目和每块请求的开销, 但块数仍要足以让每台服务器分到
+        blocks_per_server 个块, 保持并发传输; 结果取 2 的幂, 落在 [min_block_size, max_block_size].
+
+        Args:
+            size (int): 文件大小(字节)
+            servers (int):  健康的存储服务器数
+            limit (int, optional):  客户端能承受的块大小上限(受其内存预算限制). Defaults to None.
+
+        Returns:
+            int:    块大小(字节)
+        """
+        target = -(-size // (max(servers, 1) * self.blocks_per_server))
+        block_size = self.min_block_size
+        while block_size < target and block_size < self.max_block_size:
+            block_size *= 2
+        block_size = min(block_size, self.max_block_size)
+        if limit:
+            block_size = min(block_size, max(int(limit), self.min_block_size))
+        return block_size
+
+    def domain(self, server):
+        return self.domains.get(server, server)
+
+    def update_stats(self, server, stats):
+        with self.lock:
+            self.stats[server] = stats
+            self.reserved[server] = 0
+
+    def _weight(self, server):
+        stats = self.stats.get(server)
+        if not stats:
+            return 1.0  # 还没有收到带统计信息的心跳
+        free = max(stats.get("free", 0) - self.reserved.get(server, 0), 0)
+        return free / (1 + stats.get("inflight", 0)) + 1.0
+
+    def choose(self, candidates, count, exclude=(), avoid_domains=(), size=0):
+        """_summary_    从候选服务器中选出 count 台
+
+        Args:
+            candidates (list):  健康的候选服务器 "host:port"
+            count (int):    需要的台数, 候选不足时返回尽可能多的服务器
+            exclude (iterable, optional):   不能选择的服务器. Defaults to ().
+            avoid_domains (iterable, optional): 已被占用、尽量避开的故障域. Defaults to ().
+            size (int, optional):   每台服务器将写入的字节数, 用于预占空间. Defaults to 0.
+
+        Returns:
+            list:   选中的服务器
+        """
+        with self.lock:
+            remaining = [server for server in candidates if server not in set(exclude)]
+            used_domains = set(avoid_domains)
+            chosen = []
+            while remaining and len(chosen) < count:
+                # 优先选择尚未使用的故障域, 全部用过后再退化为任意服务器
+                pool = [server for server in remaining if self.domain(server) not in used_domains] or remaining
+                server = random.choices(pool, weights=[self._weight(server) for server in pool])[0]
+                chosen.append(server)
+                remaining.remove(server)
+                used_domains.add(self.domain(server))
+                self.reserved[server] = self.reserved.get(server, 0) + size
+            return chosen
+
+    def place(self, candidates, replication_factor=None, size=0):
+        """_summary_    为一个块选择主服务器和副本服务器
+
+        Args:
+            candidates (list):  健康的候选服务器
+            replication_factor (int, optional): 副本数, 缺省使用集群默认值. Defaults to None.
+            size (int, optional):   块大小. Defaults to 0.
+
+        Returns:
+            list:   第一个为主服务器, 其余为副本; 健康服务器不足时副本数相应减少
+        """
+        servers = self.choose(candidates, replication_factor or self.replication_factor, size=size)
+        if not servers:
+            raise RuntimeError("No healthy storage servers")
+        return servers
@@ -0,0 +1,526 @@
+import json
+import socket
+import struct
+import threading
+from enum import IntEnum
+
+
+MAGIC = b'\xd5\xf5'  # 非 ASCII 魔数, 与旧的 "COMMAND::..." 文本命令区分
+# 帧头: 魔数, 操作码, 标志位, 请求ID, 元数据长度, 数据长度
+HEADER = struct.Struct('!2sBBIIQ')
+
+CHUNK_SIZE = 1024 * 256
+# 未记录块大小的文件(旧版本写入的文件、旧客户端按块数上传的文件)使用的块大小
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+
+class Op(IntEnum):
+    # 响应
+    OK = 0
+    ERROR = 1
+    # Master 命令
+    STORE = 10
+    RETRIEVE = 11
+    DELETE = 12
+    GET_FILE_NAMESPACE = 13
+    GET_STORAGE_SERVERS_STATUS = 14
+    HEARTBEAT = 15
+    COMMIT = 16
+    REPORT_CORRUPT = 17
+    STORE_MANY = 18
+    DELETE_MANY = 19
+    BLOCK_REPORT = 30  # 10-19 已用完
+    # 存储服务器命令
+    STORE_BLOCK = 20
+    RETRIEVE_BLOCK = 21
+    DELETE_BLOCK = 22
+    REPLICATE_BLOCK = 23
+    STATS = 24
+    APPEND_BLOCK = 25
+
+
+def block_name(file_id, block_id):
+    # 块在存储服务器上的文件名
+    return f"{file_id}_block_{block_id}"
+
+
+class ProtocolError(Exception):
+    # 协议错误或对端返回的 ERROR 响应
+    pass
+
+
+def recv_exact(sock, length):
+    """_summary_    从套接字读取恰好 length 字节
+
+    Returns:
+        bytearray:  读取到的数据
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return buffer
+
+
+def encode_meta(meta):
+    """_summary_    把元数据编码为 JSON; 内存中的紧凑结构 (如 BlockMap) 通过 to_json 展开为普通 JSON
+
+    Returns:
+        bytes:  UTF-8 编码的 JSON, meta 为 None 时为空
+    """
+    if meta is None:
+        return b''
+    return json.dumps(meta, default=lambda value: value.to_json()).encode('utf-8')
+
+
+def configure_socket(sock):
+    # 帧头和小响应立即发出, 不等待对端的延迟确认 (Nagle)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_buffers(sock, buffers):
+    """_summary_    用 sendmsg 把多段数据作为一次写入发出, 小帧只占一个 TCP 段
+
+    Args:
+        sock (socket.socket):   套接字
+        buffers (list): 依次发送的 bytes/bytearray/memoryview
+    """
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if views:
+            views[0] = views[0][sent:]
+
+
+def send_frame(sock, opcode, request_id, meta=None, data=b''):
+    """_summary_    发送一帧: 帧头 + JSON 元数据 + 原始数据
+
+    Args:
+        sock (socket.socket):   套接字
+        opcode (int):   操作码
+        request_id (int):   请求ID
+        meta (dict, optional):  元数据. Defaults to None.
+        data (bytes, optional): 数据. Defaults to b''.
+    """
+    meta_bytes = encode_meta(meta)
+    header = HEADER.pack(MAGIC, opcode, 0, request_id, len(meta_bytes), len(data))
+    send_buffers(sock, [header, meta_bytes, data])
+
+
+class Payload:
+    def __init__(self, sock, length, buffer=None):
+        """_summary_: 帧中尚未读取的数据部分
+
+        Args:
+            sock (socket.socket):   套接字
+            length (int):   数据长度
+            buffer (bytearray, optional):   连接复用的中转缓冲区. Defaults to None.
+        """
+        self.sock = sock
+        self.length = length
+        self.remaining = length
+        self.buffer = buffer
+
+    def read(self):
+        data = recv_exact(self.sock, self.remaining)
+        self.remaining = 0
+        return data
+
+    def read_into(self, view):
+        """_summary_    把数据直接接收到调用方提供的缓冲区中
+
+        Args:
+            view (memoryview):  目标缓冲区, 长度不小于数据长度
+
+        Returns:
+            memoryview: 填充了数据的那一段
+        """
+        if len(view) < self.remaining:
+            raise ProtocolError("Receive buffer too small")
+        view = view[:self.remaining]
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError("Connection closed by peer")
+            received += n
+        self.remaining = 0
+        return view
+
+    def copy_to(self, file, hasher=None, forward=None, count=None):
+        """_summary_    经由固定大小的缓冲区把数据写入文件, 不在内存中拼接整个块
+
+        Args:
+            file (_type_):  以二进制写模式打开的文件
+            hasher (_type_, optional):  边写边计算校验和的校验器. Defaults to None.
+            forward (callable, optional):   每收到一段数据就调用一次, 用于链式转发. Defaults to None.
+            count (int, optional):  只复制接下来的 count 个字节 (一帧中连续的多个块), 缺省复制全部剩余数据.
+                Defaults to None.
+
+        Returns:
+            int:    写入的字节数
+        """
+        if self.buffer is None:
+            self.buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(self.buffer)
+        count = self.remaining if count is None else count
+        if count > self.remaining:
+            raise ProtocolError("Block extends past the end of the frame")
+        left = count
+        while left:
+            n = self.sock.recv_into(view[:min(left, len(view))])
+            if n == 0:
+                raise ConnectionError("Connection closed by peer")
+            if forward is not None:
+                forward(view[:n])  # 先转发再写本地盘, 下游的网络传输与本地写入重叠
+            file.write(view[:n])
+            if hasher is not None:
+                hasher.update(view[:n])
+            self.remaining -= n
+            left -= n
+        return count
+
+    def drain(self):
+        # 丢弃处理函数没有读取的数据, 使连接可以继续处理下一帧
+        if self.buffer is None:
+            self.buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(self.buffer)
+        while self.remaining:
+            n = self.sock.recv_into(view[:min(self.remaining, len(view))])
+            if n == 0:
+                raise ConnectionError("Connection closed by peer")
+            self.remaining -= n
+
+
+def read_frame(sock, buffer=None):
+    """_summary_    读取一帧的帧头和元数据, 数据部分以 Payload 返回
+
+    Returns:
+        tuple:  (opcode, request_id, meta, payload), 对端关闭连接时返回 None
+    """
+    try:
+        header = recv_exact(sock, HEADER.size)
+    except ConnectionError:
+        return None
+    magic, opcode, _flags, request_id, meta_len, data_len = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic")
+    meta = json.loads(recv_exact(sock, meta_len)) if meta_len else None
+    return opcode, request_id, meta, Payload(sock, data_len, buffer)
+
+
+class Response:
+    def __init__(self, meta=None, data=b'', opcode=Op.OK, file=None, offset=0, count=0):
+        """_summary_: 服务器处理函数的返回值
+
+        数据可以是内存中的 data, 也可以是文件的一段 (file, offset, count),
+        后者通过 sendfile 从页缓存直接发送到套接字, 发送后文件被关闭.
+
+        Args:
+            meta (dict, optional):  元数据. Defaults to None.
+            data (bytes, optional): 数据. Defaults to b''.
+            opcode (int, optional): 响应码. Defaults to Op.OK.
+            file (_type_, optional):    以二进制读模式打开的文件. Defaults to None.
+            offset (int, optional): 文件中的起始偏移. Defaults to 0.
+            count (int, optional):  从文件发送的字节数. Defaults to 0.
+        """
+        self.meta = meta
+        self.data = data
+        self.opcode = opcode
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    @classmethod
+    def error(cls, message):
+        return cls({"error": message}, opcode=Op.ERROR)
+
+
+def send_response(sock, request_id, response):
+    if response.file is None:
+        send_frame(sock, response.opcode, request_id, response.meta, response.data)
+        return
+    # 帧头和 sendfile 的数据之间塞住套接字, 帧头与数据的开头合并成满的 TCP 段
+    cork = getattr(socket, 'TCP_CORK', None)
+    try:
+        meta_bytes = encode_meta(response.meta)
+        if cork is not None and response.count:
+            sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+        sock.sendall(HEADER.pack(MAGIC, response.opcode, 0, request_id, len(meta_bytes), response.count)
+                     + meta_bytes)
+        if response.count:
+            sock.sendfile(response.file, response.offset, response.count)
+    finally:
+        response.file.close()
+        if cork is not None and response.count:
+            sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
+
+def nonblocking(handler):
+    """_summary_    标记不做阻塞 I/O 的处理函数, asyncio 模式下直接在事件循环中执行
+    """
+    handler.nonblocking = True
+    return handler
+
+
+def is_framed(sock):
+    """_summary_    窥探连接的前两个字节, 判断对端使用的是二进制协议还是旧的文本命令
+    """
+    head = sock.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    return head == MAGIC
+
+
+def serve_connection(sock, handlers):
+    """_summary_    在一个长连接上循环处理请求, 直到对端关闭
+
+    Args:
+        sock (socket.socket):   客户端套接字
+        handlers (dict):    操作码 -> 处理函数(meta, payload) -> Response
+    """
+    buffer = bytearray(CHUNK_SIZE)  # 每个连接一个中转缓冲区, 在请求之间复用
+    while True:
+        frame = read_frame(sock, buffer)
+        if frame is None:
+            return
+        opcode, request_id, meta, payload = frame
+
+        handler = handlers.get(opcode)
+        try:
+            if handler is None:
+                response = Response.error(f"Unknown opcode {opcode}")
+            else:
+                response = handler(meta or {}, payload)
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            response = Response.error(str(e))
+        payload.drain()
+
+        send_response(sock, request_id, response)
+
+
+class Connection:
+    def __init__(self, address, timeout=None):
+        """_summary_: 到服务器的长连接, 支持流水线请求
+
+        Args:
+            address (tuple):    服务器地址 (host, port)
+            timeout (float, optional):  套接字超时. Defaults to None.
+        """
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.next_request_id = 0
+        self.early_responses = {}  # 先于其请求到达的响应 request_id -> 响应
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        configure_socket(self.sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.early_responses.clear()
+
+    def _send(self, opcode, meta, data):
+        self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+        send_frame(self.sock, opcode, self.next_request_id, meta, data)
+        return self.next_request_id
+
+    def _receive(self, request_id, into=None):
+        while request_id not in self.early_responses:
+            try:
+                frame = read_frame(self.sock)
+                if frame is None:
+                    raise ConnectionError("Connection closed by peer")
+                opcode, response_id, meta, payload = frame
+                if response_id == request_id and into is not None and opcode != Op.ERROR:
+                    data = payload.read_into(into)
+                else:
+                    data = payload.read()
+            except ProtocolError:
+                # 本地的帧错误 (魔数不对、缓冲区放不下): 连接上剩余的字节已无法按帧解析, 不能再复用
+                self.close()
+                raise
+            self.early_responses[response_id] = (opcode, meta, data)
+
+        opcode, meta, data = self.early_responses.pop(request_id)
+        if opcode == Op.ERROR:
+            raise ProtocolError((meta or {}).get("error", "Unknown error"))
+        return meta, data
+
+    def pipeline(self, requests, into=None):
+        """_summary_    流水线: 先发送全部请求, 再依次收取响应
+
+        Args:
+            requests (list):    [(opcode, meta, data), ...]
+            into (memoryview, optional):    最后一个请求的响应数据直接接收到该缓冲区. Defaults to None.
+
+        Returns:
+            list:   与请求一一对应的 (meta, data), 服务器返回 ERROR 的请求对应 ProtocolError 实例
+
+        Raises:
+            ProtocolError:  本地的帧错误, 连接已被关闭
+        """
+        with self.lock:
+            for attempt in range(2):
+                reused = self.sock is not None
+                results = []
+                try:
+                    if not reused:
+                        self._connect()
+                    request_ids = [self._send(opcode, meta, data) for opcode, meta, data in requests]
+                    for request_id in request_ids:
+                        try:
+                            results.append(self._receive(
+                                request_id, into if request_id == request_ids[-1] else None))
+                        except ProtocolError as e:
+                            if self.sock is None:
+                                raise  # _receive 因帧错误关闭了连接
+                            results.append(e)
+                    return results
+                except OSError:
+                    self.close()
+                    # 空闲的长连接可能已被对端关闭, 此时重连重试一次
+                    if not reused or attempt or results:
+                        raise
+
+    def call(self, opcode, meta=None, data=b'', into=None):
+        """_summary_    发送单个请求并等待响应
+
+        Args:
+            into (memoryview, optional):    响应数据直接接收到该缓冲区. Defaults to None.
+
+        Returns:
+            tuple:  (meta, data), 指定 into 时 data 是 into 的一段
+        """
+        result, = self.pipeline([(opcode, meta, data)], into)
+        if isinstance(result, ProtocolError):
+            raise result
+        return result
+
+    def stream(self, opcode, meta, length, on_done=None):
+        """_summary_    发起一个数据分段发送的请求, 用于边收边转发
+
+        Args:
+            on_done (callable, optional):   请求结束(完成或放弃)时的回调. Defaults to None.
+
+        Returns:
+            StreamingRequest:   调用 write 发送数据, 发送完 length 字节后调用 finish 取响应
+        """
+        self.lock.acquire()
+        try:
+            if self.sock is None:
+                self._connect()
+            self.next_request_id = (self.next_request_id + 1) & 0xFFFFFFFF
+            meta_bytes = encode_meta(meta)
+            self.sock.sendall(HEADER.pack(MAGIC, opcode, 0, self.next_request_id, len(meta_bytes), length)
+                              + meta_bytes)
+        except BaseException:
+            self.close()
+            self.lock.release()
+            raise
+        return StreamingRequest(self, self.next_request_id, on_done)
+
+
+class StreamingRequest:
+    def __init__(self, connection, request_id, on_done=None):
+        """_summary_: 正在分段发送数据的请求, 持有连接锁直到 finish 或 abort
+
+        Args:
+            connection (Connection):    连接
+            request_id (int):   请求ID
+            on_done (callable, optional):   请求结束时的回调. Defaults to None.
+        """
+        self.connection = connection
+        self.request_id = request_id
+        self.on_done = on_done
+        self.done = False
+
+    def write(self, chunk):
+        try:
+            self.connection.sock.sendall(chunk)
+        except BaseException:
+            self.abort()
+            raise
+
+    def finish(self):
+        try:
+            return self.connection._receive(self.request_id)
+        except OSError:
+            self.connection.close()
+            raise
+        finally:
+            self._release()
+
+    def abort(self):
+        # 中途放弃: 关闭连接, 对端会因数据不完整丢弃这个请求
+        self.connection.close()
+        self._release()
+
+    def _release(self):
+        if not self.done:
+            self.done = True
+            self.connection.lock.release()
+            if self.on_done is not None:
+                self.on_done()
+
+
+class ConnectionPool:
+    def __init__(self, timeout=None):
+        """_summary_: 按服务器地址缓存空闲长连接
+        """
+        self.timeout = timeout
+        self.idle = {}  # address -> [Connection, ...]
+        self.lock = threading.Lock()
+
+    def acquire(self, address):
+        address = tuple(address)
+        with self.lock:
+            connections = self.idle.get(address)
+            if connections:
+                return connections.pop()
+        return Connection(address, self.timeout)
+
+    def release(self, connection):
+        with self.lock:
+            self.idle.setdefault(connection.address, []).append(connection)
+
+    def call(self, address, opcode, meta=None, data=b'', into=None):
+        connection = self.acquire(address)
+        try:
+            return connection.call(opcode, meta, data, into)
+        finally:
+            self.release(connection)
+
+    def stream(self, address, opcode, meta, length):
+        """_summary_    在池中的连接上发起分段发送的请求, 请求结束后连接归还到池中
+        """
+        connection = self.acquire(address)
+        try:
+            return connection.stream(opcode, meta, length, lambda: self.release(connection))
+        except BaseException:
+            self.release(connection)
+            raise
+
+    def pipeline(self, address, requests):
+        connection = self.acquire(address)
+        try:
+            return connection.pipeline(requests)
+        finally:
+            self.release(connection)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
@@ -0,0 +1,228 @@
+import bisect
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import checksum
+from compression import decompress
+from erasure import ReedSolomon
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteFile(io.RawIOBase):
+    def __init__(self, client, filename, file_info, block_size=1024*1024, prefetch=4):
+        """_summary_: DFS 文件的只读随机访问句柄 (由 Client.open 创建)
+
+        零散的小读取只向存储服务器请求块内的一段 (RETRIEVE_BLOCK 的 offset/length),
+        读取文件头之类的操作只需一次小请求. 连续两次读取首尾相接时视为顺序读,
+        改为整块读取并在后台预读之后的 prefetch 个块.
+
+        Args:
+            client (Client):    客户端
+            filename (str): 文件名
+            file_info (dict):   Master 返回的文件元数据
+            block_size (int, optional): 元数据中没有记录块大小的普通文件(旧文件)的块大小. Defaults to 1024*1024.
+            prefetch (int, optional):   顺序读时预读的块数, 0 表示不预读; 预读的数据不超过客户端的内存预算.
+                Defaults to 4.
+        """
+        super().__init__()
+        self.client = client
+        self.filename = filename
+        self.file_info = file_info
+        block_size = file_info.get("block_size", block_size)
+        self.extents = self._build_extents(file_info, block_size)
+        self.offsets = [extent["offset"] for extent in self.extents]
+        self.size = file_info.get("size", sum(extent["size"] for extent in self.extents))
+        self.position = 0
+
+        # 大块文件减少预读的块数, 避免预读的整块数据超出内存预算
+        self.prefetch = min(prefetch, max(client.engine.budget.capacity // block_size, 1)) if prefetch else 0
+        self.sequential = 0  # 连续首尾相接的读取次数
+        self.last_end = None
+        self.blocks = {}  # 区段序号 -> 整块数据的 Future
+        self.executor = ThreadPoolExecutor(max_workers=max(self.prefetch, 1))
+
+    def _build_extents(self, file_info, block_size):
+        """_summary_    把三种布局 (多副本 / 去重 / 纠删码) 统一为按文件偏移排列的数据区段
+        """
+        extents = []
+        if file_info.get("erasure"):
+            erasure = file_info["erasure"]
+            k, n, fragment_size = erasure["k"], erasure["k"] + erasure["m"], erasure["fragment_size"]
+            size = file_info.get("size", 0)
+            for stripe in range(len(file_info["blocks"]) // n):
+                for index in range(k):
+                    offset = (stripe * k + index) * fragment_size
+                    if offset >= size:
+                        break
+                    block = file_info["blocks"][stripe * n + index]
+                    extents.append({"offset": offset, "size": min(fragment_size, size - offset),
+                                    "name": self.filename, "block": block, "stripe": stripe, "index": index})
+        elif file_info.get("packed"):
+            # 打包的文件是容器块中的一段, base 为其在容器中的偏移
+            packed = file_info["packed"]
+            extents.append({"offset": 0, "size": packed["length"], "name": packed["container"],
+                            "block": file_info["blocks"][0], "base": packed["offset"],
+                            "checksum": packed.get("checksum")})
+        elif file_info.get("dedup"):
+            for block in file_info["blocks"]:
+                extents.append({"offset": block["offset"], "size": block["size"], "name": block["fileID"],
+                                "block": block})
+        else:
+            size = file_info.get("size")
+            for block in file_info["blocks"]:
+                offset = block["blockID"] * block_size
+                length = block_size if size is None else min(block_size, size - offset)
+                extents.append({"offset": offset, "size": length, "name": self.filename, "block": block})
+        return extents
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            position = offset
+        elif whence == os.SEEK_CUR:
+            position = self.position + offset
+        elif whence == os.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self.position = position
+        return position
+
+    def read(self, size=-1):
+        # 与普通文件一致: 除非到达文件末尾, 否则返回 size 个字节 (可能跨越多个块)
+        if size is None or size < 0:
+            size = max(self.size - self.position, 0)
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        total = 0
+        while total < size:
+            count = self.readinto(view[total:])
+            if not count:
+                break
+            total += count
+        return bytes(buffer[:total])
+
+    def readinto(self, buffer):
+        """_summary_    从当前位置读取, 一次最多读到当前块的末尾
+
+        Returns:
+            int:    读取的字节数, 文件末尾返回 0
+        """
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.position >= self.size or not len(buffer):
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        extent = self.extents[index]
+        within = self.position - extent["offset"]
+        count = min(len(buffer), extent["size"] - within)
+
+        self.sequential = self.sequential + 1 if self.position == self.last_end else 0
+        # 压缩块内的偏移与文件偏移不对应, 只能整块读取后解压
+        if self.sequential >= 2 or index in self.blocks or extent["block"].get("codec"):
+            data = self._block(index).result()[within:within + count]
+            self._prefetch(index)
+        else:
+            data = self._read_range(extent, within, count)
+        buffer[:len(data)] = data
+
+        self.position += len(data)
+        self.last_end = self.position
+        return len(data)
+
+    def _block(self, index):
+        if index not in self.blocks:
+            self.blocks[index] = self.executor.submit(self._read_block, self.extents[index])
+        return self.blocks[index]
+
+    def _prefetch(self, index):
+        # 丢弃已经读过的块, 保持之后 prefetch 个块在途或已就绪
+        for stale in [i for i in self.blocks if i < index]:
+            del self.blocks[stale]
+        for following in range(index + 1, min(index + 1 + self.prefetch, len(self.extents))):
+            self._block(following)
+
+    def _locations(self, extent):
+        block = extent["block"]
+        return [block["primary"]] + block["replica"]
+
+    def _read_range(self, extent, offset, length):
+        """_summary_    只读取块内的一段, 依次尝试各个副本
+        """
+        block = extent["block"]
+        for server in self._locations(extent):
+            try:
+                return self.client.retrieve_block_range(server["host"], server["port"], extent["name"],
+                                                        block["blockID"], extent.get("base", 0) + offset, length)
+            except Exception as e:
+                logger.warning("Failed to read block %s from %s:%s. Error: %s", block['blockID'], server['host'],
+                               server['port'], e)
+        if "stripe" in extent:
+            return self._reconstruct(extent)[offset:offset + length]
+        raise IOError(f"Block {block['blockID']} of {self.filename} is unavailable")
+
+    def _read_block(self, extent):
+        """_summary_    读取并校验整个块
+        """
+        block = extent["block"]
+        if "base" in extent:
+            # 不读取整个容器, 只读出文件所在的一段并用文件的校验和校验
+            data = self._read_range(extent, 0, extent["size"])
+            checksum.verify(data, extent["checksum"])
+            return bytes(data)
+        for server in self._locations(extent):
+            try:
+                data = self.client.retrieve_block(server["host"], server["port"], extent["name"],
+                                                  block["blockID"], block_checksum=block.get("checksum"))
+                if block.get("codec"):
+                    data = decompress(data, block["codec"])
+                return bytes(data[:extent["size"]])
+            except Exception as e:
+                logger.warning("Failed to read block %s from %s:%s. Error: %s", block['blockID'], server['host'],
+                               server['port'], e)
+        if "stripe" in extent:
+            return self._reconstruct(extent)
+        raise IOError(f"Block {block['blockID']} of {self.filename} is unavailable")
+
+    def _reconstruct(self, extent):
+        """_summary_    纠删码文件的数据分片不可读时, 用同一条带的其他分片重建
+        """
+        erasure = self.file_info["erasure"]
+        codec = ReedSolomon(erasure["k"], erasure["m"])
+        shards = {}
+        for index in range(codec.n):
+            if len(shards) == codec.k:
+                break
+            if index == extent["index"]:
+                continue
+            block = self.file_info["blocks"][extent["stripe"] * codec.n + index]
+            server = block["primary"]
+            try:
+                shards[index] = bytes(self.client.retrieve_block(
+                    server["host"], server["port"], self.filename, block["blockID"],
+                    block_checksum=block.get("checksum")))
+            except Exception as e:
+                logger.warning("Failed to read fragment %s from %s:%s. Error: %s", block['blockID'], server['host'],
+                               server['port'], e)
+        if len(shards) < codec.k:
+            raise IOError(f"Stripe {extent['stripe']} of {self.filename} cannot be reconstructed")
+        return bytes(codec.decode(shards)[extent["index"]][:extent["size"]])
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.blocks.clear()
+        super().close()
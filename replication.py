@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from protocol import DEFAULT_BLOCK_SIZE, ConnectionPool, Op, block_name
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    def __init__(self, bytes_per_sec):
+        """_summary_: 令牌桶限速器, 允许透支, 透支后由下一次申请者休眠偿还
+
+        Args:
+            bytes_per_sec (int):    速率上限(字节/秒)
+        """
+        self.rate = bytes_per_sec
+        self.tokens = bytes_per_sec  # 允许一秒的突发
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ReplicationScheduler:
+    def __init__(self, master, workers=4, bytes_per_sec=32*1024*1024, retry_delay=30):
+        """_summary_: 副本修复调度器
+
+        存储服务器宕机或上报损坏块时, 把受影响的块按剩余有效副本数排入优先队列
+        (副本越少越优先), 由工作线程让存活副本所在的服务器把块直接复制到健康的
+        目标服务器, 然后更新元数据. 复制总带宽受令牌桶限制, 不挤占前台流量.
+
+        Args:
+            master (MasterServer):  Master 服务器
+            workers (int, optional):    并发修复的工作线程数. Defaults to 4.
+            bytes_per_sec (int, optional):  修复流量的总带宽上限. Defaults to 32MiB.
+            retry_delay (int, optional):    修复失败后重试的间隔(秒). Defaults to 30.
+        """
+        self.master = master
+        self.workers = workers
+        self.limiter = RateLimiter(bytes_per_sec)
+        self.retry_delay = retry_delay
+        self.pool = ConnectionPool(timeout=60)
+
+        self.queue = []  # 堆: (有效副本数, 入队序号, fileID, blockID)
+        self.queued = set()  # 已在队列中的 (fileID, blockID)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def start(self):
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _locations(self, block):
+        return [block['primary']] + block['replica']
+
+    def _live_locations(self, file_id, block):
+        bad = self.master.corrupt_replicas.get((file_id, block['blockID']), ())
+        return [location for location in self._locations(block)
+                if self.master.is_healthy(location) and f"{location['host']}:{location['port']}" not in bad]
+
+    def _block_length(self, file_info, block_id):
+        """_summary_    按元数据估算块的字节数, 用于复制前预留带宽
+
+        去重块和容器是单块记录, size 就是块长度; 普通文件的最后一块可能不满.
+        压缩的块实际更小, 复制后按实际长度多退少补.
+        """
+        size = file_info.get('size')
+        if size is None:
+            return file_info.get('block_size', DEFAULT_BLOCK_SIZE)
+        if len(file_info['blocks']) == 1:
+            return size
+        block_size = file_info.get('block_size', DEFAULT_BLOCK_SIZE)
+        return max(min(block_size, size - block_id * block_size), 0)
+
+    def schedule(self, file_id, block_id):
+        file_info = self.master.metadata.get(file_id)
+        if file_info is None or block_id >= len(file_info['blocks']):
+            return
+        live = len(self._live_locations(file_id, file_info['blocks'][block_id]))
+        with self.cond:
+            if (file_id, block_id) in self.queued:
+                return
+            self.queued.add((file_id, block_id))
+            heapq.heappush(self.queue, (live, next(self.counter), file_id, block_id))
+            self.cond.notify()
+
+    def server_down(self, server):
+        """_summary_    存储服务器被判定宕机, 为其上的所有块安排修复
+
+        Args:
+            server (str):   "host:port"
+        """
+        blocks = self.master.metadata.blocks_on(server)
+        logger.info("Scheduling re-replication of %s blocks from %s", len(blocks), server)
+        for file_id, block_id in blocks:
+            self.schedule(file_id, block_id)
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                _, _, file_id, block_id = heapq.heappop(self.queue)
+                self.queued.discard((file_id, block_id))
+            try:
+                self.repair(file_id, block_id)
+            except Exception as e:
+                logger.warning("Failed to re-replicate block %s of %s: %s", block_id, file_id, e)
+                retry = threading.Timer(self.retry_delay, self.schedule, args=(file_id, block_id))
+                retry.daemon = True
+                retry.start()
+
+    def repair(self, file_id, block_id):
+        """_summary_    把块复制到健康服务器, 使有效副本数恢复到原来的数量
+
+        Args:
+            file_id (str):  文件名
+            block_id (int): 块ID
+        """
+        file_info = self.master.metadata.get(file_id)
+        if file_info is None:
+            return  # 文件已被删除
+        if file_info.get('erasure'):
+            # 纠删码分片没有副本可复制, 读取时由同一条带的其他分片重建
+            logger.warning("Fragment %s of %s lost; reads will reconstruct it from its stripe", block_id, file_id)
+            return
+        block = file_info['blocks'][block_id]
+        locations = self._locations(block)
+        live = self._live_locations(file_id, block)
+        missing = file_info.get('replication', len(locations)) - len(live)
+        if missing <= 0:
+            return
+        if not live:
+            logger.error("Block %s of %s has no live replica left", block_id, file_id)
+            return
+
+        placement = self.master.placement
+        used = [f"{location['host']}:{location['port']}" for location in locations]
+        live_domains = [placement.domain(f"{location['host']}:{location['port']}") for location in live]
+        targets = []
+        for server in placement.choose(self.master.healthy_servers(), missing, exclude=used,
+                                       avoid_domains=live_domains):
+            target = self.master._parse_server_address(server)
+            source = live[len(targets) % len(live)]
+            # 先预留带宽再复制, 每一次复制都受限速约束
+            reserved = self._block_length(file_info, block_id)
+            self.limiter.consume(reserved)
+            response, _ = self.pool.call((source['host'], source['port']), Op.REPLICATE_BLOCK,
+                                         {"block": block_name(file_id, block_id), "target": target})
+            if response["length"] != reserved:
+                self.limiter.consume(response["length"] - reserved)  # 预估不准时按实际长度结算, 负数即退还令牌
+            targets.append(target)
+        if not targets:
+            logger.warning("Block %s of %s is under-replicated: no healthy target server available", block_id, file_id)
+            return
+
+        def replace_lost(current):
+            # 复制期间元数据可能已被修改, 只在块的位置未变时替换失效副本
+            current_block = current['blocks'][block_id]
+            if self._locations(current_block) != locations:
+                return None
+            new_locations = self._live_locations(file_id, current_block) + targets
+            blocks = current['blocks'].replace(
+                block_id, dict(current_block, primary=new_locations[0], replica=new_locations[1:]))
+            return dict(current, blocks=blocks)
+
+        if self.master.metadata.update(file_id, replace_lost) is not None:
+            bad = self.master.corrupt_replicas.pop((file_id, block_id), None)
+            restored = ', '.join(f"{target['host']}:{target['port']}" for target in targets)
+            logger.info("Re-replicated block %s of %s to %s%s", block_id, file_id, restored,
+                        f" (dropped corrupt replicas on {', '.join(bad)})" if bad else "")
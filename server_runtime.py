@@ -0,0 +1,289 @@
+import asyncio
+import configparser
+import json
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import protocol
+from protocol import HEADER, MAGIC, Response
+
+logger = logging.getLogger(__name__)
+
+
+class RuntimeOptions:
+    def __init__(self, mode='threaded', backlog=1024, max_connections=4096, io_workers=32,
+                 max_frame_size=256*1024*1024):
+        """_summary_: 服务器运行时配置, 对应 servers.conf 的 [runtime] 段
+
+        Args:
+            mode (str, optional):   'threaded' 每连接一个线程, 'asyncio' 事件循环. Defaults to 'threaded'.
+            backlog (int, optional):    listen 队列长度. Defaults to 1024.
+            max_connections (int, optional):    同时服务的最大连接数, 超出的连接被直接关闭. Defaults to 4096.
+            io_workers (int, optional): asyncio 模式下执行阻塞磁盘 I/O 的线程数. Defaults to 32.
+            max_frame_size (int, optional): asyncio 模式下单帧数据的上限. Defaults to 256MiB.
+        """
+        if mode not in ('threaded', 'asyncio'):
+            raise ValueError(f"Unknown server mode {mode}")
+        self.mode = mode
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.io_workers = io_workers
+        self.max_frame_size = max_frame_size
+
+    @classmethod
+    def from_config(cls, config):
+        """_summary_    从 ConfigParser 或配置文件路径读取 [runtime] 段, 缺省项使用默认值
+        """
+        if isinstance(config, str):
+            config_file, config = config, configparser.ConfigParser()
+            config.read(config_file)
+        if not config.has_section('runtime'):
+            return cls()
+        section = config['runtime']
+        return cls(mode=section.get('mode', 'threaded'),
+                   backlog=section.getint('backlog', 1024),
+                   max_connections=section.getint('max_connections', 4096),
+                   io_workers=section.getint('io_workers', 32),
+                   max_frame_size=section.getint('max_frame_size', 256*1024*1024))
+
+
+def configure_logging(config):
+    """_summary_    按 [logging] 段配置日志: level 为级别 (默认 INFO), file 为日志文件 (默认输出到标准错误)
+
+    Args:
+        config (ConfigParser | str):    配置或配置文件路径
+    """
+    if isinstance(config, str):
+        config_file, config = config, configparser.ConfigParser()
+        config.read(config_file)
+    section = config['logging'] if config.has_section('logging') else {}
+    logging.basicConfig(level=section.get('level', 'INFO').upper(), filename=section.get('file') or None,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+def create_listener(address, backlog):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(address)
+    server.listen(backlog)
+    return server
+
+
+def serve(address, handlers, handle_client, handle_legacy, options, registry=None):
+    """_summary_    按运行时配置选择线程模式或 asyncio 模式, 阻塞运行服务器
+
+    Args:
+        address (tuple):    监听地址
+        handlers (dict):    操作码 -> 处理函数(meta, payload) -> Response
+        handle_client (callable):   线程模式下处理一个连接
+        handle_legacy (callable):   处理旧文本命令的连接 (阻塞套接字)
+        options (RuntimeOptions):   运行时配置
+        registry (metrics.Registry, optional):  记录当前连接数的指标. Defaults to None.
+    """
+    registry = registry or metrics.Registry()
+    if options.mode == 'asyncio':
+        AsyncServer(address, handlers, handle_legacy, options, registry).run()
+    else:
+        serve_threaded(address, handle_client, options, registry)
+
+
+def serve_threaded(address, handle_client, options, registry=None):
+    server = create_listener(address, options.backlog)
+    slots = threading.BoundedSemaphore(options.max_connections)
+    connections = (registry or metrics.Registry()).gauge('dfs_connections', "Open client connections")
+
+    def run(client_socket):
+        connections.inc()
+        try:
+            handle_client(client_socket)
+        finally:
+            connections.dec()
+            slots.release()
+
+    while True:
+        client_socket, addr = server.accept()
+        if not slots.acquire(blocking=False):
+            client_socket.close()  # 超过连接上限
+            continue
+        protocol.configure_socket(client_socket)
+        client_handler = threading.Thread(target=run, args=(client_socket,))
+        client_handler.daemon = True
+        client_handler.start()
+
+
+class BufferedPayload:
+    def __init__(self, data):
+        """_summary_: 已完整读入内存的帧数据, 接口与 protocol.Payload 一致
+
+        Args:
+            data (bytes):   数据
+        """
+        self.data = data
+        self.length = len(data)
+        self.remaining = self.length
+
+    def read(self):
+        self.remaining = 0
+        return self.data
+
+    def read_into(self, view):
+        view[:self.length] = self.data
+        self.remaining = 0
+        return view[:self.length]
+
+    def copy_to(self, file, hasher=None, forward=None, count=None):
+        start = self.length - self.remaining
+        count = self.remaining if count is None else count
+        if count > self.remaining:
+            raise protocol.ProtocolError("Block extends past the end of the frame")
+        view = memoryview(self.data)[start:start + count]
+        for offset in range(0, count, protocol.CHUNK_SIZE):
+            chunk = view[offset:offset + protocol.CHUNK_SIZE]
+            if forward is not None:
+                forward(chunk)
+            file.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+        self.remaining -= count
+        return count
+
+    def drain(self):
+        self.remaining = 0
+
+
+class AsyncServer:
+    def __init__(self, address, handlers, handle_legacy, options, registry=None):
+        """_summary_: 基于 asyncio 事件循环的服务器
+
+        网络 I/O 全部在事件循环中完成, 处理函数(可能阻塞于磁盘或 fsync)
+        在大小固定的线程池中执行.
+
+        Args:
+            address (tuple):    监听地址
+            handlers (dict):    操作码 -> 处理函数(meta, payload) -> Response
+            handle_legacy (callable):   处理旧文本命令的连接 (阻塞套接字)
+            options (RuntimeOptions):   运行时配置
+            registry (metrics.Registry, optional):  记录当前连接数的指标. Defaults to None.
+        """
+        self.address = address
+        self.handlers = handlers
+        self.handle_legacy = handle_legacy
+        self.options = options
+        self.executor = ThreadPoolExecutor(options.io_workers)
+        self.connections = 0
+        (registry or metrics.Registry()).gauge('dfs_connections', "Open client connections",
+                                               function=lambda: self.connections)
+        self.tasks = set()  # 事件循环只持有任务的弱引用, 这里保持强引用
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+    async def serve_forever(self):
+        loop = asyncio.get_running_loop()
+        server = create_listener(self.address, self.options.backlog)
+        server.setblocking(False)
+        while True:
+            client_socket, addr = await loop.sock_accept(server)
+            if self.connections >= self.options.max_connections:
+                client_socket.close()  # 超过连接上限
+                continue
+            self.connections += 1
+            task = asyncio.ensure_future(self._serve_connection(client_socket))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _is_framed(self, client_socket):
+        """_summary_    不消费数据地窥探前两个字节, 以区分二进制协议和旧文本命令
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                head = client_socket.recv(len(MAGIC), socket.MSG_PEEK)
+                if len(head) >= len(MAGIC) or not head:
+                    return head == MAGIC
+            except BlockingIOError:
+                pass
+            waiter = loop.create_future()
+            loop.add_reader(client_socket, lambda: waiter.done() or waiter.set_result(None))
+            try:
+                await waiter
+            finally:
+                loop.remove_reader(client_socket)
+
+    async def _serve_connection(self, client_socket):
+        loop = asyncio.get_running_loop()
+        try:
+            protocol.configure_socket(client_socket)  # 与线程模式使用相同的套接字选项
+            if not await self._is_framed(client_socket):
+                # 旧文本命令是短连接, 交给线程池以阻塞方式处理
+                client_socket.setblocking(True)
+                await loop.run_in_executor(self.executor, self.handle_legacy, client_socket)
+                client_socket.close()
+                return
+
+            reader, writer = await asyncio.open_connection(sock=client_socket)
+            try:
+                await self._serve_frames(reader, writer)
+            finally:
+                writer.close()
+        except (OSError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                logger.warning("Connection error: %s", e)
+            client_socket.close()
+        finally:
+            self.connections -= 1
+
+    async def _serve_frames(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                header = await reader.readexactly(HEADER.size)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise
+                return  # 对端正常关闭
+            magic, opcode, _flags, request_id, meta_len, data_len = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise protocol.ProtocolError("Bad frame magic")
+            if data_len > self.options.max_frame_size:
+                raise protocol.ProtocolError(f"Frame of {data_len} bytes exceeds limit")
+            meta = json.loads(await reader.readexactly(meta_len)) if meta_len else {}
+            payload = BufferedPayload(await reader.readexactly(data_len) if data_len else b'')
+
+            handler = self.handlers.get(opcode)
+            if handler is None:
+                response = Response.error(f"Unknown opcode {opcode}")
+            else:
+                try:
+                    if getattr(handler, 'nonblocking', False):
+                        response = handler(meta or {}, payload)
+                    else:
+                        response = await loop.run_in_executor(self.executor, handler, meta or {}, payload)
+                except Exception as e:
+                    response = Response.error(str(e))
+
+            await self._send_response(writer, request_id, response)
+
+    async def _send_response(self, writer, request_id, response):
+        loop = asyncio.get_running_loop()
+        meta_bytes = protocol.encode_meta(response.meta)
+        if response.file is None:
+            writer.write(HEADER.pack(MAGIC, response.opcode, 0, request_id, len(meta_bytes), len(response.data))
+                         + meta_bytes)
+            if response.data:
+                writer.write(response.data)
+            await writer.drain()
+            return
+
+        try:
+            writer.write(HEADER.pack(MAGIC, response.opcode, 0, request_id, len(meta_bytes), response.count)
+                         + meta_bytes)
+            await writer.drain()
+            if response.count:
+                await loop.sendfile(writer.transport, response.file, response.offset, response.count)
+        finally:
+            response.file.close()
+
@@ -0,0 +1,45 @@
+import configparser
+import zlib
+
+
+class ShardMap:
+    def __init__(self, addresses, names=None):
+        """_summary_: Master 分片表, 按 fileID 的哈希把命名空间划分到多个 Master 分片
+
+        分片数固定, 哈希对分片数取模; 改变分片数需要迁移元数据.
+
+        Args:
+            addresses (list):   各分片的 (host, port), 顺序即分片编号
+            names (list, optional): 各分片在配置文件中的名字. Defaults to None.
+        """
+        self.addresses = [(host, int(port)) for host, port in addresses]
+        self.names = names or [f"shard{i}" for i in range(len(self.addresses))]
+
+    @classmethod
+    def from_config(cls, config):
+        """_summary_    读取 [shards] 段; 没有该段时只有 [master] 一个分片
+
+        Args:
+            config (ConfigParser | str):    已加载的配置或配置文件路径
+        """
+        if isinstance(config, str):
+            path, config = config, configparser.ConfigParser()
+            config.read(path)
+        if config.has_section('shards'):
+            shards = config['shards']
+        else:
+            shards = {'master': config['master']['server']}
+        return cls([address.split(':') for address in shards.values()], list(shards))
+
+    def shard_for(self, file_id):
+        # crc32 在所有进程和 Python 版本中都稳定, 不受 hash() 随机化影响
+        return self.addresses[zlib.crc32(file_id.encode('utf-8')) % len(self.addresses)]
+
+    def owns(self, address, file_id):
+        return len(self.addresses) == 1 or self.shard_for(file_id) == tuple(address)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return iter(self.addresses)
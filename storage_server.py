@@ -1,29 +1,614 @@
-import socket
+import logging
+import io
 import threading
 import configparser
 import time
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import checksum
+import metrics
+import protocol
+from cache import LRUCache
+from checksum import ChecksumError
+from dedup import is_chunk
+from inventory import BlockInventory, encode_names
+from packing import is_container
+from protocol import Op, Response, block_name, nonblocking
+from server_runtime import RuntimeOptions, configure_logging, serve
+from sharding import ShardMap
+
+logger = logging.getLogger(__name__)
+CHECKSUM_SUFFIX = '.crc'
 
 
 class StorageServer:
-    def __init__(self, host, port, master_host, master_port, storage_path):
+    def __init__(self, host, port, master_host, master_port, storage_path, runtime=None,
+                 scrub_rate=8*1024*1024, scrub_interval=3600, cache_size=64*1024*1024, read_ahead=4, shards=None,
+                 tracer=None, report_interval=60, full_report_interval=3600):
         """_summary_: 存储服务器类
 
         Args:
             host (str, optional): 服务器地址
             port (int, optional): 服务器端口
+            runtime (RuntimeOptions, optional): 运行时配置. Defaults to None.
+            scrub_rate (int, optional): 后台巡检的读取速率上限(字节/秒). Defaults to 8MiB.
+            scrub_interval (int, optional): 两轮巡检之间的间隔(秒). Defaults to 3600.
+            cache_size (int, optional): 热点块读缓存的字节预算, 0 表示不缓存. Defaults to 64MiB.
+            read_ahead (int, optional): 顺序读时预读的范围(之后的块ID数), 0 表示不预读. Defaults to 4.
+            shards (ShardMap, optional):    Master 分片表, 心跳发给所有分片. Defaults to None (只有一个 Master).
+            tracer (metrics.Tracer, optional):  逐请求的跟踪日志. Defaults to None (不记录).
+            report_interval (int, optional):    向 Master 报告块清单增量的间隔(秒). Defaults to 60.
+            full_report_interval (int, optional):   全量块报告的间隔(秒). Defaults to 3600.
         """
         self.server_address = (host, port)
+        self.runtime = runtime or RuntimeOptions()
         self.master_address = (master_host, master_port)
         self.storage_path = storage_path
         os.makedirs(self.storage_path, exist_ok=True)
 
         self.heartbeat_interval = 5
+        self.scrub_rate = scrub_rate
+        self.scrub_interval = scrub_interval
+        self.shards = shards or ShardMap([self.master_address])
+        self.masters = {address: protocol.Connection(address, timeout=self.heartbeat_interval)
+                        for address in self.shards}
+
+        # 块清单报告走单独的连接, 全量报告的核对可能比心跳超时更久
+        self.report_interval = report_interval
+        self.full_report_interval = full_report_interval
+        self.reporters = {address: protocol.Connection(address, timeout=60) for address in self.shards}
+        self.inventory = BlockInventory(self.shards)
+        # 启动时没有进行中的写入, 残留的临时文件是崩溃前未完成的写入
+        for entry in os.scandir(self.storage_path):
+            if entry.is_file() and entry.name.endswith(('.tmp', '.tmp' + CHECKSUM_SUFFIX)):
+                os.remove(entry.path)
+
+        self.registry = metrics.Registry({"role": "storage", "server": f"{host}:{port}"})
+        self.inflight = 0  # 正在处理的请求数, 随心跳上报供 Master 做负载感知放置
+        self.inflight_lock = threading.Lock()
+        handlers = {op: self._track(handler) for op, handler in {
+            Op.STORE_BLOCK: self._handle_store_block,
+            Op.RETRIEVE_BLOCK: self._handle_retrieve_block,
+            Op.DELETE_BLOCK: self._handle_delete_block,
+            Op.REPLICATE_BLOCK: self._handle_replicate_block,
+            Op.APPEND_BLOCK: self._handle_append_block,
+        }.items()}
+        handlers[Op.STATS] = self._handle_stats
+        self.handlers = metrics.instrument(handlers, self.registry, tracer)
+        self.peers = protocol.ConnectionPool(timeout=60)  # 到其他存储服务器的连接, 用于链式复制和副本修复
+
+        # 已校验的热点块: 块名 -> (数据, 校验和), 命中时不读磁盘也不重复校验
+        self.block_cache = LRUCache(cache_size, sizeof=lambda entry: len(entry[0]))
+        # 整块校验过的块: 块名 -> 校验时块文件的 (inode, mtime, 大小); 文件未变时范围读取不再重新校验整个块
+        self.verified = LRUCache(100000)
+        self.cache_generation = 0  # 每次写入/删除块时递增, 防止并发读把旧数据放回缓存
+        self.cache_lock = threading.Lock()
+        self.read_ahead = read_ahead
+        self.last_read = LRUCache(4096)  # 文件名 -> 最近读取的块ID, 用于识别顺序读
+        self.prefetching = set()
+        self.prefetcher = ThreadPoolExecutor(max_workers=2)
+        self.prefetches = 0
+
+        self.write_seconds = self.registry.histogram('dfs_block_write_seconds',
+                                                     "Time to receive, checksum and persist one block")
+        self.read_seconds = self.registry.histogram('dfs_block_read_seconds',
+                                                    "Time to read and verify one block from disk")
+        self.registry.gauge('dfs_disk_free_bytes', "Free space on the storage volume",
+                            function=lambda: shutil.disk_usage(self.storage_path).free)
+        self.registry.counter('dfs_cache_hits_total', "Block cache hits", function=lambda: self.block_cache.hits)
+        self.registry.counter('dfs_cache_misses_total', "Block cache misses",
+                              function=lambda: self.block_cache.misses)
+        self.registry.counter('dfs_cache_evictions_total', "Block cache evictions",
+                              function=lambda: self.block_cache.evictions)
+        self.registry.gauge('dfs_cache_bytes', "Bytes held in the block cache", function=lambda: self.block_cache.size)
+        self.registry.counter('dfs_prefetches_total', "Blocks read ahead into the cache",
+                              function=lambda: self.prefetches)
+
+    def _track(self, handler):
+        def tracked(meta, payload):
+            with self.inflight_lock:
+                self.inflight += 1
+            try:
+                return handler(meta, payload)
+            finally:
+                with self.inflight_lock:
+                    self.inflight -= 1
+        return tracked
+
+    def stats(self):
+        return {"free": shutil.disk_usage(self.storage_path).free, "inflight": self.inflight}
+
+    @nonblocking
+    def _handle_stats(self, meta, payload):
+        return Response(dict(self.stats(), cache=dict(self.block_cache.stats(), prefetches=self.prefetches)))
 
     def handle_client(self, client_socket):
+        """_summary_    处理客户端连接, 二进制帧走长连接, 旧的文本命令走兼容层
+
+        Args:
+            client_socket (_type_): 客户端套接字
+        """
+        try:
+            if protocol.is_framed(client_socket):
+                protocol.serve_connection(client_socket, self.handlers)
+            else:
+                self.handle_legacy(client_socket)
+        except (OSError, protocol.ProtocolError) as e:
+            logger.warning("Connection error: %s", e)
+        finally:
+            client_socket.close()
+
+    def _block_path(self, block):
+        return os.path.join(self.storage_path, block)
+
+    def _read_checksum(self, block_file):
+        # 校验和保存在块文件旁的 .crc 文件中, 旧版本写入的块没有校验和
+        try:
+            with open(block_file + CHECKSUM_SUFFIX, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _file_identity(self, file):
+        # 块写入是新文件原子替换, 追加会修改 mtime, 所以 (inode, mtime, 大小) 不变就说明内容没有经过本服务器修改
+        stat = os.fstat(file.fileno())
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _is_verified(self, block, file):
+        identity = self.verified.get(block)
+        return identity is not None and identity == self._file_identity(file)
+
+    def _verify_block_file(self, block_file, expected):
+        """_summary_    以流式读取校验块文件, 通过后记录为已校验
+
+        Raises:
+            ChecksumError:  校验失败
+        """
+        hasher = checksum.new_hasher(expected)
+        if hasher is None:
+            return
+        with open(block_file, 'rb') as file:
+            identity = self._file_identity(file)
+            while (chunk := file.read(protocol.CHUNK_SIZE)):
+                hasher.update(chunk)
+        if checksum.format_checksum(hasher) != expected:
+            raise ChecksumError(f"Block {os.path.basename(block_file)} is corrupt")
+        self.verified.put(os.path.basename(block_file), identity)
+
+    def _write_block(self, block, expected, payload, forward, count=None):
+        """_summary_    把帧中的一个块经固定缓冲区边收边写到临时文件, 校验后原子替换, 读者不会看到半个块
+
+        Args:
+            block (str):    块名
+            expected (str): 客户端计算的校验和, 可为 None
+            payload (Payload):  帧数据
+            forward (callable): 每收到一段数据就调用一次, 用于链式转发
+            count (int, optional):  块的字节数, 缺省为帧中剩余的全部数据. Defaults to None.
+
+        Raises:
+            ChecksumError:  收到的数据与客户端的校验和不符 (块的数据已全部读出, 帧中后续的块不受影响)
+
+        Returns:
+            tuple:  (块长度, 校验和)
+        """
+        start = time.perf_counter()
+        block_file = self._block_path(block)
+        tmp_file = block_file + '.tmp'
+        hasher = checksum.new_hasher(expected) or checksum.new_hasher()
+        try:
+            with open(tmp_file, 'wb') as file:
+                length = payload.copy_to(file, hasher, forward, count)
+            actual = checksum.format_checksum(hasher)
+            if expected and expected.split(':', 1)[0] == hasher.name and actual != expected:
+                raise ChecksumError(f"Checksum mismatch for block {block}")
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+        with open(tmp_file + CHECKSUM_SUFFIX, 'w') as f:
+            f.write(actual)
+        created = not os.path.exists(block_file)
+        os.replace(tmp_file + CHECKSUM_SUFFIX, block_file + CHECKSUM_SUFFIX)
+        os.replace(tmp_file, block_file)
+        if created:
+            self.inventory.add(block)
+        self._invalidate(block)
+        # 校验和就是按收到的数据算出的, 新写入的块无需再校验
+        with open(block_file, 'rb') as file:
+            self.verified.put(block, self._file_identity(file))
+        self.write_seconds.observe(time.perf_counter() - start)
+        return length, actual
+
+    def _handle_store_block(self, meta, payload):
+        """_summary_    存储块; meta 中带 pipeline 时边写本地边把数据逐段转发给链上的下一台服务器
+
+        meta 中带 blocks 时一帧携带多个块 (小文件批量写入), 数据按 blocks 的顺序首尾相接.
+
+        Returns:
+            Response:   stored 为链上成功写入的服务器, failed 为未写入的服务器
+        """
+        def write(forward):
+            result, errors = {}, {}
+            if "blocks" in meta:
+                result["blocks"] = []
+                for block in meta["blocks"]:
+                    try:
+                        length, actual = self._write_block(block["block"], block.get("checksum"), payload, forward,
+                                                           block["length"])
+                        result["blocks"].append({"block": block["block"], "length": length, "checksum": actual})
+                    except ChecksumError as e:
+                        errors[block["block"]] = str(e)  # 只影响这一个块, 继续接收后面的块
+            else:
+                result["length"], result["checksum"] = self._write_block(meta["block"], meta.get("checksum"),
+                                                                         payload, forward)
+            return result, errors
+
+        return self._chain(Op.STORE_BLOCK, meta, payload, write)
+
+    def _handle_append_block(self, meta, payload):
+        """_summary_    在容器块的 offset 处写入一段数据 (小文件打包), 并沿 pipeline 转发
+
+        容器块只追加: Master 为每个文件预留互不重叠的区间, 并发的写入各写各的区间,
+        已写入的区间不会再被修改. 容器块没有整块校验和, 每个文件的校验和记录在 Master 上.
+        小文件的数据先收进内存并校验, 校验通过才写入共享的容器, 损坏的数据不会落到其他文件旁边.
+
+        Returns:
+            Response:   stored 为链上成功写入的服务器, failed 为未写入的服务器
+        """
+        def write(forward):
+            block_file = self._block_path(meta["block"])
+            hasher = checksum.new_hasher(meta.get("checksum")) or checksum.new_hasher()
+            buffer = io.BytesIO()
+            length = payload.copy_to(buffer, hasher, forward)
+            actual = checksum.format_checksum(hasher)
+            if meta.get("checksum") and actual != meta["checksum"]:
+                raise ChecksumError(f"Checksum mismatch for {meta['block']} at offset {meta['offset']}")
+            created = not os.path.exists(block_file)
+            # O_CREAT 不截断, 并发创建同一个容器是安全的
+            fd = os.open(block_file, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, buffer.getbuffer(), meta["offset"])
+            finally:
+                os.close(fd)
+            if created:
+                self.inventory.add(meta["block"])
+            if os.path.exists(block_file + CHECKSUM_SUFFIX):
+                os.remove(block_file + CHECKSUM_SUFFIX)  # 副本修复复制来的整块校验和在追加后失效
+            self._invalidate(meta["block"])
+            return {"length": length, "checksum": actual}, {}
+
+        return self._chain(Op.APPEND_BLOCK, meta, payload, write)
+
+    def _chain(self, opcode, meta, payload, write):
+        """_summary_    链式复制: 本地写入的同时把数据逐段转发给 pipeline 中的下一台服务器, 再等待下游确认
+
+        Args:
+            opcode (Op):    转发给下游时使用的操作码
+            write (callable):   write(forward) 写入本地并返回 (结果, 出错的块名 -> 错误)
+
+        Returns:
+            Response:   结果附带 stored/failed (及批量写入时的 errors)
+        """
+        pipeline = meta.get("pipeline") or []
+        downstream = self._open_downstream(opcode, meta, pipeline, payload.length)
+
+        def forward(chunk):
+            nonlocal downstream
+            if downstream is None:
+                return
+            try:
+                downstream.write(chunk)
+            except OSError as e:
+                logger.warning("Pipeline to %s:%s broken: %s", pipeline[0]['host'], pipeline[0]['port'], e)
+                downstream = None  # 下游断开不影响本地写入, 由客户端补写
+
+        try:
+            result, errors = write(forward)
+        except BaseException:
+            if downstream is not None:
+                downstream.abort()
+            raise
+
+        # 等待下游确认, 确认沿链条逐级返回
+        stored, failed = [{"host": self.server_address[0], "port": self.server_address[1]}], pipeline
+        if downstream is not None:
+            try:
+                response, _ = downstream.finish()
+                stored, failed = stored + response["stored"], response["failed"]
+                errors.update(response.get("errors", {}))
+            except (OSError, protocol.ProtocolError) as e:
+                logger.warning("Pipeline to %s:%s failed: %s", pipeline[0]['host'], pipeline[0]['port'], e)
+        if "blocks" in meta:
+            result["errors"] = errors
+        return Response(dict(result, stored=stored, failed=failed))
+
+    def _open_downstream(self, opcode, meta, pipeline, length):
+        if not pipeline:
+            return None
+        target = pipeline[0]
+        try:
+            return self.peers.stream((target["host"], target["port"]), opcode,
+                                     dict(meta, pipeline=pipeline[1:]), length)
+        except OSError as e:
+            logger.warning("Pipeline to %s:%s unavailable: %s", target['host'], target['port'], e)
+            return None
+
+    def _invalidate(self, block):
+        with self.cache_lock:
+            self.cache_generation += 1
+            self.block_cache.pop(block)
+        self.verified.pop(block)
+
+    def _load_block(self, block):
+        """_summary_    读取并校验整个块, 放入读缓存
+
+        Raises:
+            FileNotFoundError:  块不存在
+            ChecksumError:  校验失败
+
+        Returns:
+            tuple:  (数据, 校验和)
+        """
+        generation = self.cache_generation
+        start = time.perf_counter()
+        block_file = self._block_path(block)
+        with open(block_file, 'rb') as file:
+            identity = self._file_identity(file)
+            data = file.read()
+        stored = self._read_checksum(block_file)
+        if stored:
+            checksum.verify(data, stored)
+            self.verified.put(block, identity)
+        self.read_seconds.observe(time.perf_counter() - start)
+        with self.cache_lock:
+            if generation == self.cache_generation:
+                self.block_cache.put(block, (data, stored))
+        return data, stored
+
+    def _read_ahead(self, block):
+        """_summary_    同一文件的块ID递增时视为顺序读, 在后台把本机上的下一个块读入缓存
+
+        块按放置策略分散在各服务器上, 下一个块ID不一定在本机, 因此在之后
+        read_ahead 个块ID中寻找第一个本机存在的块.
+        """
+        filename, _, block_id = block.rpartition('_block_')
+        if not self.read_ahead or not filename or not block_id.isdigit():
+            return
+        block_id = int(block_id)
+        previous = self.last_read.get(filename)
+        self.last_read.put(filename, block_id)
+        if previous is None or not previous < block_id:
+            return
+        for next_id in range(block_id + 1, block_id + 1 + self.read_ahead):
+            next_block = block_name(filename, next_id)
+            if next_block in self.block_cache or next_block in self.prefetching:
+                return
+            if os.path.exists(self._block_path(next_block)):
+                self.prefetching.add(next_block)
+                self.prefetcher.submit(self._prefetch, next_block)
+                return
+
+    def _prefetch(self, block):
+        try:
+            self._load_block(block)
+            self.prefetches += 1
+        except (OSError, ChecksumError):
+            pass  # 预读失败不影响前台, 真正读取时再处理
+        finally:
+            self.prefetching.discard(block)
+
+    def _handle_retrieve_block(self, meta, payload):
+        """_summary_    读取块; meta 中带 offset/length 时只返回块内的这一段
+
+        整个块校验过才发送: 读缓存中的块和已校验且文件未变的块不再重复校验 (之后的位腐烂由后台巡检发现).
+        范围读取的响应不带校验和 (客户端无法校验部分数据).
+        """
+        offset, length = meta.get("offset"), meta.get("length")
+        ranged = offset is not None or length is not None
+        if self.block_cache.capacity <= 0 or is_container(meta["block"].rsplit('_block_', 1)[0]):
+            # 容器一直在追加, 缓存整个容器会不断失效; 打包的文件由客户端按 Master 上的校验和校验
+            return self._send_block_file(meta["block"], offset, length)
+
+        entry = self.block_cache.get(meta["block"])
+        if entry is None:
+            try:
+                if os.path.getsize(self._block_path(meta["block"])) > self.block_cache.capacity // 4:
+                    # 大块文件的块会挤掉大量热点小块, 不进缓存也不预读, 校验后直接从页缓存发送
+                    return self._send_block_file(meta["block"], offset, length)
+                if ranged and meta["block"] in self.verified:
+                    # 已校验的块上的小范围读取 (如读文件头) 不必把整个块读进缓存
+                    return self._send_block_file(meta["block"], offset, length)
+                entry = self._load_block(meta["block"])
+            except FileNotFoundError:
+                return Response.error("Block not found")
+            except ChecksumError as e:
+                self._quarantine(meta["block"])
+                return Response.error(str(e))
+        self._read_ahead(meta["block"])
+        data, stored = entry
+        if offset is None and length is None:
+            return Response({"checksum": stored}, data)
+        start = offset or 0
+        end = len(data) if length is None else start + length
+        return Response({"length": len(data)}, memoryview(data)[start:end])
+
+    def _send_block_file(self, block, offset=None, length=None):
+        block_file = self._block_path(block)
+        try:
+            file = open(block_file, 'rb')
+        except FileNotFoundError:
+            return Response.error("Block not found")
+
+        stored = self._read_checksum(block_file)
+        if stored and not self._is_verified(block, file):
+            try:
+                self._verify_block_file(block_file, stored)
+            except ChecksumError as e:
+                file.close()
+                self._quarantine(block)
+                return Response.error(str(e))
+        # 由 sendfile 从页缓存直接发送, 不经过用户态缓冲区
+        size = os.fstat(file.fileno()).st_size
+        if offset is None and length is None:
+            return Response({"checksum": stored}, file=file, count=size)
+        start = min(offset or 0, size)
+        count = size - start if length is None else max(min(length, size - start), 0)
+        return Response({"length": size}, file=file, offset=start, count=count)
+
+    def _delete_block(self, block, before=None):
+        """_summary_    删除块及其校验和文件
+
+        Args:
+            block (str):    块名
+            before (float, optional):   只删除在此时间之前写入的块 (Master 回收孤立块时使用,
+                之后被重新写入的块不删除). Defaults to None.
+
+        Returns:
+            bool:   块是否被删除
+        """
+        block_file = self._block_path(block)
+        self._invalidate(block)
+        try:
+            if before is not None and os.path.getmtime(block_file) >= before:
+                return False
+            os.remove(block_file)
+        except FileNotFoundError:
+            return False
+        if os.path.exists(block_file + CHECKSUM_SUFFIX):
+            os.remove(block_file + CHECKSUM_SUFFIX)
+        self.inventory.discard(block)
+        return True
+
+    def _handle_delete_block(self, meta, payload):
+        if "blocks" in meta:
+            # 批量删除: 不存在(或在 before 之后被重写)的块不算错误, 只在响应中列出
+            missing = [block for block in meta["blocks"] if not self._delete_block(block, meta.get("before"))]
+            return Response({"deleted": len(meta["blocks"]) - len(missing), "missing": missing})
+        if not self._delete_block(meta["block"]):
+            return Response.error("Block not found")
+        return Response()
+
+    def _handle_replicate_block(self, meta, payload):
+        """_summary_    Master 发起的副本修复: 把本地块经固定缓冲区流式发送给目标存储服务器, 不把整个块读入内存
+
+        边读边校验; 目标服务器也按块的校验和校验收到的数据, 损坏的块不会被复制过去.
+        """
+        block_file = self._block_path(meta["block"])
+        stored = self._read_checksum(block_file)
+        try:
+            file = open(block_file, 'rb')
+        except FileNotFoundError:
+            return Response.error("Block not found")
+
+        target = meta["target"]
+        with file:
+            length = os.fstat(file.fileno()).st_size
+            hasher = checksum.new_hasher(stored) if stored else None
+            try:
+                request = self.peers.stream((target["host"], target["port"]), Op.STORE_BLOCK,
+                                            {"block": meta["block"], "checksum": stored}, length)
+            except OSError as e:
+                # 目标不可用时回复错误, 而不是断开与 Master 的连接 (断开会让 Master 重发整个复制)
+                return Response.error(f"Target {target['host']}:{target['port']} unavailable: {e}")
+            sent = 0
+            try:
+                while sent < length and (chunk := file.read(min(protocol.CHUNK_SIZE, length - sent))):
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    request.write(chunk)
+                    sent += len(chunk)
+            except OSError as e:
+                request.abort()
+                return Response.error(f"Failed to send {meta['block']} to {target['host']}:{target['port']}: {e}")
+            except BaseException:
+                request.abort()
+                raise
+            if sent != length:
+                request.abort()  # 块在发送期间被截断, 对端因数据不完整丢弃这个请求
+                return Response.error(f"Block {meta['block']} changed during replication")
+            if hasher is not None and checksum.format_checksum(hasher) != stored:
+                request.abort()
+                self._quarantine(meta["block"])
+                return Response.error(f"Block {meta['block']} is corrupt")
+            try:
+                request.finish()
+            except (OSError, protocol.ProtocolError) as e:
+                return Response.error(f"Target {target['host']}:{target['port']} failed to store {meta['block']}: {e}")
+        return Response({"length": length})
+
+    def _quarantine(self, block):
+        """_summary_    隔离损坏的块, 不再对外提供, 并报告给 Master 以便修复
+
+        Args:
+            block (str):    块文件名
+        """
+        block_file = self._block_path(block)
+        self._invalidate(block)
+        logger.error("Block %s failed checksum verification", block)
+        try:
+            os.replace(block_file, block_file + '.corrupt')
+            self.inventory.discard(block)
+        except FileNotFoundError:
+            pass
+        # 报告给负责该文件的 Master 分片; 去重块和容器属于创建它的分片, 无法由块名确定, 报告给所有分片
+        file_id = block.rsplit('_block_', 1)[0]
+        masters = (list(self.masters.values()) if is_chunk(file_id) or is_container(file_id)
+                   else [self.masters[self.shards.shard_for(file_id)]])
+        for master in masters:
+            try:
+                master.call(Op.REPORT_CORRUPT, {"block": block, "host": self.server_address[0],
+                                                "port": self.server_address[1]})
+            except Exception as e:
+                logger.warning("Failed to report corrupt block %s: %s", block, e)
+
+    def _block_entries(self):
+        # 目录中的块文件, 不含临时文件、被隔离的块和校验和文件
+        for entry in os.scandir(self.storage_path):
+            if entry.is_file() and not entry.name.endswith(('.tmp', '.corrupt', CHECKSUM_SUFFIX)):
+                yield entry
+
+    def scrub(self):
+        """_summary_    后台巡检: 以限定的速率周期性重新校验所有块
+        """
+        while True:
+            time.sleep(self.scrub_interval)
+            start = time.time()
+            scrubbed = 0
+            for entry in self._block_entries():
+                stored = self._read_checksum(entry.path)
+                hasher = checksum.new_hasher(stored) if stored else None
+                if hasher is None:
+                    continue
+                try:
+                    with open(entry.path, 'rb') as file:
+                        identity = self._file_identity(file)
+                        while (chunk := file.read(protocol.CHUNK_SIZE)):
+                            hasher.update(chunk)
+                            scrubbed += len(chunk)
+                            # 限速: 读取量超前于速率配额时休眠, 给前台 I/O 让路
+                            ahead = scrubbed / self.scrub_rate - (time.time() - start)
+                            if ahead > 0:
+                                time.sleep(ahead)
+                except FileNotFoundError:
+                    continue  # 巡检期间块被删除
+                if checksum.format_checksum(hasher) != stored:
+                    self._quarantine(entry.name)
+                else:
+                    self.verified.put(entry.name, identity)
+
+    def handle_legacy(self, client_socket):
+        """_summary_    兼容旧的 "COMMAND::block" 文本命令
+
+        Args:
+            client_socket (_type_): 客户端套接字
+        """
         request = client_socket.recv(1024).decode('utf-8')
-        print(f"Received request: {request}")
-        command, block_id = request.split('::')
+        if '::' not in request:
+            return
+        logger.debug("Received request: %s", request)
+        command, block_id = request.split('::', 1)
 
         if command.startswith("STORE_BLOCK"):
             client_socket.send("READY".encode('utf-8'))
@@ -33,27 +618,32 @@ class StorageServer:
                 1024).decode('utf-8'))  # 接收数据长度
             client_socket.send("LENGTH_RECEIVED".encode('utf-8'))
 
-            print(f"1 Storing block {block_id}")
-
             while len(data) < data_length:
                 packet = client_socket.recv(1024*256)
-                print("Received packet")
+                if not packet:
+                    break
                 data.extend(packet)
-            print("done")
 
             # 检查数据长度
             if len(data) != data_length:
                 client_socket.send("ERROR".encode('utf-8'))
-                print("Error storing block")
+                logger.warning("Error storing block")
                 return
 
-            with open(os.path.join(self.storage_path, block_id), 'wb') as file:
+            block_file = self._block_path(block_id)
+            created = not os.path.exists(block_file)
+            with open(block_file, 'wb') as file:
                 file.write(data)
+            with open(block_file + CHECKSUM_SUFFIX, 'w') as f:
+                f.write(checksum.compute(data))
+            if created:
+                self.inventory.add(block_id)
+            self._invalidate(block_id)
 
             client_socket.send("STORED".encode('utf-8'))
 
         elif command.startswith("RETRIEVE_BLOCK"):
-            block_file = os.path.join(self.storage_path, block_id)
+            block_file = self._block_path(block_id)
             if os.path.exists(block_file):
                 client_socket.send("READY".encode('utf-8'))
                 ack = client_socket.recv(1024).decode('utf-8')
@@ -65,47 +655,88 @@ class StorageServer:
                     if response == 'LENGTH_RECEIVED':
                         with open(block_file, 'rb') as file:
                             while (chunk := file.read(1024*256)):
-                                client_socket.send(chunk)
+                                client_socket.sendall(chunk)
             else:
                 client_socket.send("NOT_FOUND".encode('utf-8'))
 
         elif command.startswith("DELETE_BLOCK"):
-            block_file = os.path.join(self.storage_path, block_id)
-            if os.path.exists(block_file):
-                os.remove(block_file)
+            if self._delete_block(block_id):
                 client_socket.send("DELETED".encode('utf-8'))
             else:
                 client_socket.send("NOT_FOUND".encode('utf-8'))
 
-        client_socket.close()
-
     def send_heartbeat(self):
         while True:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect(self.master_address)
-                s.send(
-                    f"HEARTBEAT::{self.server_address[0]}::{self.server_address[1]}".encode('utf-8'))
-                s.close()
-            except Exception as e:
-                print(f"Failed to send heartbeat: {e}")
+            stats = self.stats()
+            for address, master in self.masters.items():
+                try:
+                    master.call(Op.HEARTBEAT, {"host": self.server_address[0], "port": self.server_address[1],
+                                               "stats": stats})
+                except Exception as e:
+                    logger.warning("Failed to send heartbeat to %s:%s: %s", address[0], address[1], e)
             time.sleep(self.heartbeat_interval)
 
+    def send_block_reports(self):
+        """_summary_    向每个 Master 分片报告块清单
+
+        平时每 report_interval 秒只发送自上次报告以来新增和删除的块, 以及块数和摘要;
+        启动后、每 full_report_interval 秒、以及 Master 要求时重新扫描目录, 发送全量报告.
+        """
+        full, last_full = True, 0
+        while True:
+            if full or time.time() - last_full >= self.full_report_interval:
+                try:
+                    scanned, partitions = self.inventory.scan(
+                        lambda: [entry.name for entry in self._block_entries()])
+                except OSError as e:
+                    logger.warning("Failed to scan blocks for the block report: %s", e)
+                    time.sleep(self.report_interval)
+                    continue
+                full, last_full = False, time.time()
+                for address, master in self.reporters.items():
+                    names, count, value = partitions[address]
+                    full = not self._send_block_report(address, master, {"full": True, "time": scanned},
+                                                       count, value, encode_names(names)) or full
+            else:
+                for address, master in self.reporters.items():
+                    reported = time.time()
+                    added, removed, count, value = self.inventory.take(address)
+                    data = encode_names(added)
+                    if not self._send_block_report(address, master, {"time": reported, "added_length": len(data)},
+                                                   count, value, data + encode_names(removed)):
+                        self.inventory.restore(address, added, removed)
+            time.sleep(self.report_interval)
+
+    def _send_block_report(self, address, master, meta, count, value, data):
+        """_summary_    发送一次块报告
+
+        Returns:
+            bool:   报告被接受; 发送失败或 Master 要求全量报告时为 False
+        """
+        try:
+            response, _ = master.call(Op.BLOCK_REPORT, dict(meta, host=self.server_address[0],
+                                                            port=self.server_address[1], count=count,
+                                                            digest=f"{value:016x}"), data)
+        except Exception as e:
+            logger.warning("Failed to send block report to %s:%s: %s", address[0], address[1], e)
+            return False
+        return not response.get("full")
+
     def start(self):
         heartbeat_thread = threading.Thread(target=self.send_heartbeat)
         heartbeat_thread.daemon = True
         heartbeat_thread.start()
 
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind(self.server_address)
-        server.listen(5)
-        print(f"Storage server listening on {self.server_address}")
+        scrub_thread = threading.Thread(target=self.scrub)
+        scrub_thread.daemon = True
+        scrub_thread.start()
 
-        while True:
-            client_socket, addr = server.accept()
-            client_handler = threading.Thread(
-                target=self.handle_client, args=(client_socket,))
-            client_handler.start()
+        report_thread = threading.Thread(target=self.send_block_reports)
+        report_thread.daemon = True
+        report_thread.start()
+
+        logger.info("Storage server listening on %s (%s mode)", self.server_address, self.runtime.mode)
+        serve(self.server_address, self.handlers, self.handle_client, self.handle_legacy, self.runtime, self.registry)
 
 
 def start_storage_servers(config_file):
@@ -114,20 +745,45 @@ def start_storage_servers(config_file):
 
     servers = config['servers']
     master = config['master']['server']
+    runtime = RuntimeOptions.from_config(config)
+    scrubber = config['scrubber'] if config.has_section('scrubber') else {}
+    scrub_rate = int(scrubber.get('bytes_per_sec', 8*1024*1024))
+    scrub_interval = int(scrubber.get('interval', 3600))
+    cache = config['cache'] if config.has_section('cache') else {}
+    cache_size = int(cache.get('size', 64*1024*1024))
+    read_ahead = int(cache.get('read_ahead', 4))
+    inventory = config['inventory'] if config.has_section('inventory') else {}
+    report_interval = int(inventory.get('report_interval', 60))
+    full_report_interval = int(inventory.get('full_report_interval', 3600))
+    shards = ShardMap.from_config(config)
+    telemetry = metrics.MetricsOptions.from_config(config)
+    tracer = metrics.Tracer(telemetry.trace_file)
+    registries = []
+    server_threads = []
     for server_name, address in servers.items():
         host, port = address.split(':')
         port = int(port)
         storage_path = config['paths'][server_name]
         storage_server = StorageServer(host, port, master.split(':')[
-                                       0], int(master.split(':')[1]), storage_path)
+                                       0], int(master.split(':')[1]), storage_path, runtime,
+                                       scrub_rate, scrub_interval, cache_size, read_ahead, shards,
+                                       tracer.bind(server=f"{host}:{port}"), report_interval, full_report_interval)
+        registries.append(storage_server.registry)
         server_thread = threading.Thread(target=storage_server.start)
         server_thread.daemon = True
         server_thread.start()
-        print(f"{server_name} started on {host}:{port}")
+        server_threads.append(server_thread)
+        logger.info("%s started on %s:%s", server_name, host, port)
+    if telemetry.storage_port:
+        # 一个进程内的所有存储服务器共用一个 /metrics 端点, 以 server 标签区分
+        metrics.serve_metrics(telemetry.storage_port, registries, telemetry.host)
+        logger.info("Storage metrics on %s:%s/metrics", telemetry.host, telemetry.storage_port)
+    return server_threads
 
 
 if __name__ == "__main__":
-    start_storage_servers('servers.conf')
-    # 保持主线程运行，以防子线程终止
-    while True:
-        pass
+    configure_logging('servers.conf')
+    server_threads = start_storage_servers('servers.conf')
+    # 保持主线程运行，以防子线程终止 (join 而不是空转占用 CPU)
+    for server_thread in server_threads:
+        server_thread.join()
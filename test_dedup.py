@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dedup import chunk_id
+from master_server import MasterServer
+from protocol import Op
+
+
+class ChunkCommitTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='dfs-dedup-test-')
+        config_file = os.path.join(self.workdir, 'servers.conf')
+        with open(config_file, 'w') as f:
+            f.write("[master]\nserver = localhost:5900\n\n"
+                    "[servers]\nserver1 = localhost:5901\nserver2 = localhost:5902\n")
+        self.master = MasterServer('localhost', 5900, config_file=config_file,
+                                   metadata_file=os.path.join(self.workdir, 'metadata.json'))
+        self.chunks = self.master.chunks
+
+    def tearDown(self):
+        self.master.metadata.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _store(self, filename, chunks):
+        self.chunks.allocate(filename, chunks)
+        self.chunks.commit(filename, chunks, {chunk["hash"]: "crc32:0000000a" for chunk in chunks})
+
+    def test_commit_with_unknown_chunk_changes_nothing(self):
+        known = [{"hash": "aa" * 32, "size": 10}]
+        self._store("first.bin", known)
+        self.assertEqual(self.master.metadata.get(chunk_id("aa" * 32))["refs"], 1)
+
+        chunks = known + [{"hash": "bb" * 32, "size": 10}]  # bb 既没有分配也没有上传
+        self.chunks.allocate("second.bin", known)
+        with self.assertRaises(ValueError):
+            self.chunks.commit("second.bin", chunks, {})
+
+        self.assertEqual(self.master.metadata.get(chunk_id("aa" * 32))["refs"], 1)
+        self.assertIsNone(self.master.metadata.get("second.bin"))
+        self.assertIn("second.bin", self.chunks.uploads)  # 上传仍在进行中, 块不会被回收
+
+    def test_commit_retry_after_upload(self):
+        chunks = [{"hash": "cc" * 32, "size": 10}]
+        self.chunks.allocate("retry.bin", chunks)
+        with self.assertRaises(ValueError):
+            self.chunks.commit("retry.bin", chunks, {})  # 块已分配但没有上传
+        self.chunks.commit("retry.bin", chunks, {"cc" * 32: "crc32:0000000a"})
+
+        self.assertEqual(self.master.metadata.get(chunk_id("cc" * 32))["refs"], 1)
+        self.assertEqual(self.master.metadata.get("retry.bin")["chunks"], chunks)
+        self.assertNotIn("retry.bin", self.chunks.uploads)
+
+    def test_store_rejects_reserved_prefix(self):
+        file_id = chunk_id("dd" * 32)
+        response = self.master._handle_store({"fileID": file_id, "size": 10}, None)
+        self.assertEqual(response.opcode, Op.ERROR)
+        response = self.master._handle_store_many({"files": [{"fileID": "ok.bin", "size": 10},
+                                                            {"fileID": "#pack-1", "size": 10}]}, None)
+        self.assertEqual(response.opcode, Op.ERROR)
+        self.assertIsNone(self.master.metadata.get(file_id))
+        self.assertIsNone(self.master.metadata.get("ok.bin"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,324 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import checksum
+from compression import compress, decompress, parse as parse_codec
+from erasure import ReedSolomon
+from protocol import block_name
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBudget:
+    def __init__(self, capacity):
+        """_summary_: 全局内存预算, 限制同时在途的块数据总字节数
+
+        Args:
+            capacity (int): 预算字节数
+        """
+        self.capacity = capacity
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        with self.cond:
+            # 单个超过预算的块在没有其他在途数据时也允许通过
+            while self.used and self.used + size > self.capacity:
+                self.cond.wait()
+            self.used += size
+
+    def release(self, size):
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+
+class TransferEngine:
+    def __init__(self, client, max_workers=32, per_server_inflight=4, memory_budget=64*1024*1024):
+        """_summary_: 并发块传输引擎
+
+        Args:
+            client (Client):    提供 store_block / retrieve_block 的客户端
+            max_workers (int, optional):    线程池大小. Defaults to 32.
+            per_server_inflight (int, optional):    每台存储服务器同时在途的块数. Defaults to 4.
+            memory_budget (int, optional):  在途块数据的内存预算(字节). Defaults to 64MiB.
+        """
+        self.client = client
+        self.max_workers = max_workers
+        self.per_server_inflight = per_server_inflight
+        self.budget = MemoryBudget(memory_budget)
+        self.server_slots = {}  # (host, port) -> 信号量
+        self.slots_lock = threading.Lock()
+
+    def _slot(self, server):
+        address = (server['host'], server['port'])
+        with self.slots_lock:
+            if address not in self.server_slots:
+                self.server_slots[address] = threading.BoundedSemaphore(self.per_server_inflight)
+            return self.server_slots[address]
+
+    def upload(self, filename, blocks, block_data, block_size=1024*1024, compression=None):
+        """_summary_    流式并发上传所有块, 每个块经主服务器链式复制到副本服务器
+
+        先占用内存预算再从 block_data 读取下一个块, 所以同时驻留内存的块数据
+        不超过预算, 与文件大小无关. 压缩和校验和在工作线程中计算 (zlib/lzma 会释放 GIL).
+
+        Args:
+            filename (str): 文件名
+            blocks (list):  Master 分配的块信息, 带 fileID 的块(去重块)按该名字存储
+            block_data (iterable):  与 blocks 顺序一致的块数据, 通常是生成器
+            block_size (int, optional): 块大小. Defaults to 1024*1024.
+            compression (str, optional):    块压缩算法 "算法[:级别]" 或 auto. Defaults to None (不压缩).
+
+        Returns:
+            tuple:  (每个块的校验和, 每个块的压缩算法); 校验和针对存储服务器上保存的数据, 未压缩的块算法为 None
+        """
+        if compression:
+            parse_codec(compression)  # 算法不可用时在上传之前报错
+        errors = []
+        checksums = [None] * len(blocks)
+        codecs = [None] * len(blocks)
+
+        def store(index, block, data):
+            # 链式复制: 块只发送给主服务器一次, 由它沿 primary -> replica... 逐段转发
+            block_id = block['blockID']
+            name = block.get('fileID', filename)
+            primary = block['primary']
+            try:
+                if compression:
+                    data, codecs[index] = compress(data, compression)
+                block_checksum = checksum.compute(data)  # 每个块只计算一次, 整条链共用
+                checksums[index] = block_checksum
+                try:
+                    with self._slot(primary):
+                        response = self.client.store_block(primary['host'], primary['port'], name, block_id,
+                                                           data, block_checksum, pipeline=block['replica'])
+                    stored = response.get('stored', [primary])
+                except Exception as e:
+                    errors.append(e)
+                    logger.warning("Failed to store block %s on %s:%s. Error: %s", block_id, primary['host'],
+                                   primary['port'], e)
+                    stored = []
+                # 链条中断时, 未写入的副本由客户端直接补写
+                for server in block['replica']:
+                    if server in stored:
+                        continue
+                    try:
+                        with self._slot(server):
+                            self.client.store_block(server['host'], server['port'], name, block_id, data,
+                                                    block_checksum)
+                    except Exception as e:
+                        errors.append(e)
+                        logger.warning("Failed to store block %s on %s:%s. Error: %s", block_id, server['host'],
+                                       server['port'], e)
+            finally:
+                self.budget.release(block_size)
+
+        block_data = iter(block_data)
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for index, block in enumerate(blocks):
+                self.budget.acquire(block_size)
+                executor.submit(store, index, block, next(block_data))  # 不在本线程保留对块数据的引用
+
+        if errors:
+            raise errors[0]
+        return checksums, codecs
+
+    def upload_batched(self, blocks, read, max_batch_bytes=4*1024*1024, max_batch_blocks=256, compression=None):
+        """_summary_    批量上传小文件的块: 复制链相同的块合并到一个 STORE_BLOCK 请求中
+
+        每个请求经主服务器链式复制, 与 upload 一样受内存预算和每服务器在途数限制.
+
+        Args:
+            blocks (list):  [(文件名, 块信息, 块大小), ...]
+            read (callable):    read(文件名, 块信息) 返回块数据
+            max_batch_bytes (int, optional):    每个请求的数据上限. Defaults to 4MiB.
+            max_batch_blocks (int, optional):   每个请求的块数上限. Defaults to 256.
+            compression (str, optional):    块压缩算法 "算法[:级别]" 或 auto. Defaults to None (不压缩).
+
+        Returns:
+            tuple:  (文件名 -> 按块ID排列的校验和列表, 文件名 -> 按块ID排列的压缩算法列表,
+                     文件名 -> 错误), 第三项为有块没能读取或写入的文件, 调用方不应提交这些文件
+        """
+        if compression:
+            parse_codec(compression)
+        failed = {}
+        checksums = {}
+        codecs = {}
+
+        def chain(block):
+            return tuple((server['host'], server['port']) for server in [block['primary']] + block['replica'])
+
+        def store(block, batch, size):
+            primary, replica = block['primary'], block['replica']
+            entries = [(filename, item['blockID'], data, block_checksum)
+                       for filename, item, data, block_checksum in batch]
+            filenames = {block_name(filename, item['blockID']): filename for filename, item, _, _ in batch}
+
+            def fail(error, names=filenames):
+                for name in names:
+                    failed.setdefault(filenames[name], error)
+
+            try:
+                try:
+                    with self._slot(primary):
+                        response = self.client.store_blocks(primary['host'], primary['port'], entries,
+                                                            pipeline=replica)
+                    stored = response.get('stored', [primary])
+                    for name, error in response.get('errors', {}).items():
+                        fail(IOError(f"Failed to store block {name}: {error}"), [name])
+                except Exception as e:
+                    fail(e)
+                    logger.warning("Failed to store %s blocks on %s:%s. Error: %s", len(batch), primary['host'],
+                                   primary['port'], e)
+                    stored = []
+                # 链条中断时, 未写入的副本由客户端直接补写
+                for server in replica:
+                    if server in stored:
+                        continue
+                    try:
+                        with self._slot(server):
+                            response = self.client.store_blocks(server['host'], server['port'], entries)
+                        for name, error in response.get('errors', {}).items():
+                            fail(IOError(f"Failed to store block {name}: {error}"), [name])
+                    except Exception as e:
+                        fail(e)
+                        logger.warning("Failed to store %s blocks on %s:%s. Error: %s", len(batch), server['host'],
+                                       server['port'], e)
+            finally:
+                self.budget.release(size)
+
+        # 攒批次时已占用预算, 批次不能超过预算的一半, 否则可能永远等不到预算
+        max_batch_bytes = min(max_batch_bytes, self.budget.capacity // 2)
+        # 按复制链排序, 同一条链的块连续出现, 每次只需攒一个批次
+        blocks = sorted(blocks, key=lambda item: chain(item[1]))
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            batch, batch_size = [], 0
+            for index, (filename, block, size) in enumerate(blocks):
+                self.budget.acquire(size)
+                try:
+                    data, codec = read(filename, block), None
+                except OSError as e:
+                    # 读不到的文件 (例如已被删除) 只影响它自己, 批次中的其他文件照常上传
+                    self.budget.release(size)
+                    failed.setdefault(filename, e)
+                    logger.warning("Failed to read %s. Error: %s", filename, e)
+                else:
+                    if compression:
+                        data, codec = compress(data, compression)
+                    block_checksum = checksum.compute(data)
+                    checksums.setdefault(filename, []).append(block_checksum)
+                    codecs.setdefault(filename, []).append(codec)
+                    batch.append((filename, block, data, block_checksum))
+                    batch_size += size
+                    del data
+                following = blocks[index + 1][1] if index + 1 < len(blocks) else None
+                if batch and (following is None or chain(following) != chain(block)
+                              or batch_size >= max_batch_bytes or len(batch) >= max_batch_blocks):
+                    executor.submit(store, block, batch, batch_size)
+                    batch, batch_size = [], 0
+
+        return checksums, codecs, failed
+
+    def download(self, filename, blocks, fd, block_size=1024*1024):
+        """_summary_    并发下载所有块, 到达后直接写入文件中对应的偏移
+
+        Args:
+            filename (str): 文件名
+            blocks (list):  Master 返回的块信息, 带 offset 的块(去重块)写入该偏移
+            fd (int):   输出文件描述符
+            block_size (int, optional): 块大小, 去重文件为最大块大小. Defaults to 1024*1024.
+                压缩的块在存储服务器上不超过这个大小, 到达后在工作线程中解压.
+        """
+        errors = []
+        # 块大小的接收缓冲区在工作线程间复用; 缓冲区个数不超过同时在途的块数 (受内存预算限制),
+        # 而不是线程数, 大块文件不会为每个线程各留一个缓冲区
+        buffers = []
+
+        def fetch(block):
+            block_id = block['blockID']
+            name = block.get('fileID', filename)
+            buffer = buffers.pop() if buffers else memoryview(bytearray(block_size))
+            try:
+                for server in [block['primary']] + block['replica']:
+                    try:
+                        with self._slot(server):
+                            data = self.client.retrieve_block(
+                                server['host'], server['port'], name, block_id, block_size, buffer,
+                                block.get('checksum'))
+                        break
+                    except Exception as e:
+                        logger.warning("Failed to retrieve block %s from %s:%s. Error: %s", block_id, server['host'],
+                                       server['port'], e)
+                else:
+                    raise IOError(f"Block {block_id} of {filename} is unavailable")
+                if block.get('codec'):
+                    data = decompress(data, block['codec'])
+                os.pwrite(fd, data, block.get('offset', block_id * block_size))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                buffers.append(buffer)
+                self.budget.release(block_size)
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for block in blocks:
+                self.budget.acquire(block_size)
+                executor.submit(fetch, block)
+
+        if errors:
+            raise errors[0]
+
+    def download_stripes(self, filename, file_info, fd):
+        """_summary_    并发下载纠删码文件: 每个条带取任意 k 个分片, 必要时解码重建数据
+
+        Args:
+            filename (str): 文件名
+            file_info (dict):   Master 返回的文件元数据, 含 erasure 参数
+            fd (int):   输出文件描述符
+        """
+        erasure = file_info['erasure']
+        codec = ReedSolomon(erasure['k'], erasure['m'])
+        fragment_size = erasure['fragment_size']
+        size = file_info.get('size', 0)
+        blocks = file_info['blocks']
+        stripe_bytes = codec.k * fragment_size
+        errors = []
+
+        def fetch(stripe):
+            try:
+                shards = {}
+                # 先取数据分片, 只有它们缺失时才去取校验分片
+                for index in range(codec.n):
+                    if len(shards) == codec.k:
+                        break
+                    block = blocks[stripe * codec.n + index]
+                    server = block['primary']
+                    try:
+                        with self._slot(server):
+                            shards[index] = bytes(self.client.retrieve_block(
+                                server['host'], server['port'], filename, block['blockID'],
+                                fragment_size, block_checksum=block.get('checksum')))
+                    except Exception as e:
+                        logger.warning("Failed to retrieve fragment %s from %s:%s. Error: %s", block['blockID'],
+                                       server['host'], server['port'], e)
+                if len(shards) < codec.k:
+                    raise IOError(f"Stripe {stripe} of {filename} has only {len(shards)} of {codec.k} "
+                                  f"fragments available")
+                offset = stripe * stripe_bytes
+                data = b''.join(codec.decode(shards))[:max(0, size - offset)]  # 去掉最后一个条带的补零
+                os.pwrite(fd, data, offset)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.budget.release(stripe_bytes)
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for stripe in range(len(blocks) // codec.n):
+                self.budget.acquire(stripe_bytes)
+                executor.submit(fetch, stripe)
+
+        if errors:
+            raise errors[0]